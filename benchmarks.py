@@ -0,0 +1,281 @@
+"""
+Benchmarks for the engine: building worlds, trying actions and looking things up, plus memory per object.
+
+    python benchmarks.py                        run everything and print the results
+    python benchmarks.py --quick                smaller sizes, for a quick check
+    python benchmarks.py -o results.json        also save the results
+    python benchmarks.py -b baseline.json       compare with earlier results; exits with 1 if anything got slower
+                                                (or bigger) by more than --threshold
+    python benchmarks.py --update-baseline      save the results as the baseline that's compared with by default
+
+The stored baseline (benchmark_baseline.json) is from one machine, so only compare with it on similar hardware, or
+make a new one before starting on a change.
+
+Each timing is the best of --repeat runs, and doesn't include setting up the world it runs in.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import loading
+import output
+import pyif
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+def blank_world():
+    w = pyif.make_blank_world()
+    w.set_output(output.NullSink())
+    pyif.title('Benchmark')
+    return w
+
+
+def timed(run, setup=None, repeat=3):
+    best = None
+    for _ in range(repeat):
+        arg = None if setup is None else setup()
+        start = time.perf_counter()
+        run(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_grid(size):
+    rooms = [[pyif.room('room {0} {1}'.format(x, y)) for x in range(size)] for y in range(size)]
+    for y in range(size):
+        for x in range(size):
+            if x:
+                pyif.make_map_connections(rooms[y][x], {'east_of': rooms[y][x - 1]})
+            if y:
+                pyif.make_map_connections(rooms[y][x], {'south_of': rooms[y - 1][x]})
+    return rooms
+
+
+def bench_blank_world(n, repeat):
+    return timed(lambda _: [blank_world() for _ in range(n)], repeat=repeat), n
+
+
+def bench_create(kind, n, repeat):
+    def run(_):
+        if kind == 'room':
+            for i in range(n):
+                pyif.room('room {0}'.format(i))
+        elif kind == 'thing':
+            for i in range(n):
+                pyif.thing('thing {0}'.format(i))
+        else:
+            for i in range(n):
+                pyif.make_object('{0} {1}'.format(kind, i), kind)
+    return timed(run, lambda: blank_world(), repeat), n
+
+
+def bench_load(n, repeat):
+    #the same as map_grid plus a thing in each room, but through the bulk loader
+    size = int(n ** 0.5)
+    rooms = [{'name': 'room {0} {1}'.format(x, y), 'id': 'r{0}_{1}'.format(x, y),
+              'east_of': 'r{0}_{1}'.format(x - 1, y) if x else None,
+              'south_of': 'r{0}_{1}'.format(x, y - 1) if y else None} for y in range(size) for x in range(size)]
+    things = [{'name': 'thing {0}'.format(i), 'location': room['id']} for i, room in enumerate(rooms)]
+
+    def run(w):
+        loading.load(w, {'room': rooms, 'thing': things})
+    return timed(run, lambda: blank_world(), repeat), 2 * len(rooms)
+
+
+def bench_grid(n, repeat):
+    size = int(n ** 0.5)
+    return timed(lambda _: make_grid(size), lambda: blank_world(), repeat), size * size
+
+
+def started_world(things=0):
+    w = blank_world()
+    hall = pyif.room('Hall')
+    pyif.room('Kitchen', map_connections={'north_of': hall})
+    for i in range(things):
+        pyif.thing('thing {0}'.format(i), location=hall)
+    w.go()
+    return w
+
+
+def bench_looking(n, repeat):
+    def run(w):
+        player = w.get_player()
+        for _ in range(n):
+            w.try_action(player, 'looking')
+    return timed(run, lambda: started_world(10), repeat), n
+
+
+def bench_going(n, repeat):
+    def run(w):
+        player = w.get_player()
+        north = [w.directions['north']]
+        south = [w.directions['south']]
+        for i in range(n // 2):
+            w.try_action(player, 'going', north)
+            w.try_action(player, 'going', south)
+    return timed(run, lambda: started_world(10), repeat), n // 2 * 2
+
+
+def bench_commands(n, repeat):
+    def run(w):
+        for i in range(n // 2):
+            w.try_command('n')
+            w.try_command('go south')
+    return timed(run, lambda: started_world(10), repeat), n // 2 * 2
+
+
+def bench_things(n, repeat):
+    #each query goes through every thing
+    queries = 100
+
+    def run(w):
+        for _ in range(queries):
+            for _, thing in w.things():
+                thing['lit']
+    return timed(run, lambda: started_world(n), repeat), queries * n
+
+
+def bench_routes(n, repeat):
+    size = int(n ** 0.5)
+
+    def setup():
+        blank_world()
+        return make_grid(size)
+
+    def run(rooms):
+        w = pyif.current_world()
+        target = rooms[-1][-1]
+        for row in rooms:
+            for room in row:
+                w.next_step(room, target)
+    return timed(run, setup, repeat), size * size
+
+
+def bench_memory(kind, n):
+    blank_world()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for i in range(n):
+            pyif.make_object('{0} {1}'.format(kind, i), kind)
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return {'bytes_per_object': retained / n, 'peak_bytes_per_object': peak / n, 'n': n}
+
+
+def run_all(scale=1.0, repeat=3, only=None):
+    def size(n):
+        return max(1, int(n * scale))
+
+    benchmarks = {
+        'make_blank_world': lambda: bench_blank_world(size(20), repeat),
+        'create_rooms': lambda: bench_create('room', size(20000), repeat),
+        'create_things': lambda: bench_create('thing', size(20000), repeat),
+        'create_containers': lambda: bench_create('container', size(20000), repeat),
+        'map_grid': lambda: bench_grid(size(10000), repeat),
+        'load_grid': lambda: bench_load(size(10000), repeat),
+        'looking': lambda: bench_looking(size(5000), repeat),
+        'going': lambda: bench_going(size(5000), repeat),
+        'commands': lambda: bench_commands(size(5000), repeat),
+        'things_query': lambda: bench_things(size(10000), repeat),
+        'routes': lambda: bench_routes(size(10000), repeat),
+    }
+    results = {}
+    for name, bench in benchmarks.items():
+        if only and name not in only:
+            continue
+        seconds, n = bench()
+        results[name] = {'seconds': seconds, 'n': n, 'per_second': n / seconds if seconds else None}
+    for kind in ('thing', 'container'):
+        name = 'memory_' + kind
+        if not only or name in only:
+            results[name] = bench_memory(kind, size(20000))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'scale': scale,
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    The lines of a comparison with baseline, and whether anything is worse by more than threshold (a fraction).
+    """
+    lines = []
+    regressed = False
+    for name, result in results['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if old is None:
+            continue
+        key = 'bytes_per_object' if 'bytes_per_object' in result else 'seconds'
+        if not old.get(key):
+            continue
+        #time is compared per operation, in case the sizes differ
+        now = result[key] / result['n'] if key == 'seconds' else result[key]
+        before = old[key] / old['n'] if key == 'seconds' else old[key]
+        change = now / before - 1
+        worse = change > threshold
+        regressed = regressed or worse
+        lines.append('{0:<20} {1:>+8.1%}{2}'.format(name, change, '  REGRESSION' if worse else ''))
+    return lines, regressed
+
+
+def report(results):
+    lines = []
+    for name, result in results['results'].items():
+        if 'seconds' in result:
+            lines.append('{0:<20} {1:>10.4f} s {2:>12.0f} /s  (n={3})'.format(
+                name, result['seconds'], result['per_second'], result['n']))
+        else:
+            lines.append('{0:<20} {1:>10.0f} bytes/object (peak {2:.0f})'.format(
+                name, result['bytes_per_object'], result['peak_bytes_per_object']))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the engine.')
+    parser.add_argument('--quick', action='store_true', help='run at a tenth of the normal sizes')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the sizes by this')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='the benchmarks to run')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('-b', '--baseline', default=BASELINE if os.path.exists(BASELINE) else None,
+                        help='JSON results to compare against (the stored baseline by default)')
+    parser.add_argument('--no-baseline', dest='baseline', action='store_const', const=None,
+                        help='don\'t compare with anything')
+    parser.add_argument('--update-baseline', action='store_true', help='save the results as the stored baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='how much worse counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_all(args.scale * (0.1 if args.quick else 1.0), args.repeat, args.only)
+    print('\n'.join(report(results)))
+    for path in (args.output, BASELINE if args.update_baseline else None):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+                f.write('\n')
+    if args.baseline and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressed = compare(results, baseline, args.threshold)
+        print('\ncompared with {0}:'.format(args.baseline))
+        print('\n'.join(lines))
+        if regressed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
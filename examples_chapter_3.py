@@ -13,8 +13,8 @@ class Chapter3(unittest.TestCase):
         print('========')
 
     def tearDown(self):
-        pyif._current_world.say('----------')
-        del pyif._current_world
+        pyif.current_world().say('----------')
+        pyif.set_current_world(None)
 
     def test_example2(self):
         def run_checks(world):
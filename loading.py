@@ -0,0 +1,260 @@
+"""
+Building worlds in bulk from rows of data, e.g. ones made procedurally or kept in a spreadsheet.
+
+    loader = Loader(world)
+    loader.rows('room', [{'name': 'Hall'}, {'name': 'Kitchen', 'north_of': 'Hall'}])
+    loader.csv('thing', 'things.csv')
+    loader.json_lines('more.jsonl')
+    loader.finish()
+
+Each row is a dictionary of properties. Columns are checked against the kind once, not for every row, and values are
+written straight into each new object. Anything that refers to another object - location, and the map connections
+given by a direction column ('north': the room to the north) or a direction_of column ('south_of': the room this one
+is south of, as in pyif.room) - can be an id or a name, and is only looked up by finish(), so rows can come in any
+order.
+"""
+import csv
+import io
+import json
+
+from world import Kind, LogicalError
+
+_true = {'true', 'yes', 'y', '1'}
+_false = {'false', 'no', 'n', '0'}
+
+
+def _boolean(cell):
+    if type(cell) is str:
+        cell = cell.strip().lower()
+        if cell in _true:
+            return True
+        if cell in _false:
+            return False
+        raise LogicalError('{0} isn\'t true or false'.format(cell))
+    return bool(cell)
+
+
+def _converter(default):
+    #turns the text from a CSV file into the same type as the property's default
+    if type(default) is bool:
+        return _boolean
+    if type(default) in (int, float):
+        kind = type(default)
+        return lambda cell: kind(cell) if type(cell) is str else cell
+    return None
+
+
+class Column:
+    __slots__ = ('key', 'prop', 'what', 'convert')
+
+    def __init__(self, key, prop, what, convert=None):
+        self.key = key
+        self.prop = prop
+        #'name', 'id', 'option', 'value', 'location', 'to' (a direction) or 'of' (direction_of)
+        self.what = what
+        self.convert = convert
+
+
+class Loader:
+    def __init__(self, w):
+        self.world = w
+        #(kind, columns) -> [Column]
+        self.plans = {}
+        #(object, reference) for locations, and (room, direction, reference, reversed) for map connections
+        self.locations = []
+        self.connections = []
+        self.loaded = []
+
+    def _plan(self, kind_name, kind, columns):
+        plan = self.plans.get((kind_name, columns))
+        if plan is not None:
+            return plan
+        template = kind.template()
+        directions = self.world.directions
+        plan = []
+        for key in columns:
+            prop = key.replace('_', ' ').strip()
+            if prop in ('name', 'id'):
+                plan.append(Column(key, prop, prop))
+            elif prop == 'kind':
+                continue
+            elif prop in template.options.bits:
+                plan.append(Column(key, prop, 'option', _boolean))
+            elif prop == 'location' and 'location' in template.properties:
+                plan.append(Column(key, prop, 'location'))
+            elif prop in directions and 'map connections' in template.properties:
+                plan.append(Column(key, prop, 'to'))
+            elif prop[-3:] == ' of' and prop[:-3] in directions and 'map connections' in template.properties:
+                plan.append(Column(key, prop[:-3], 'of'))
+            elif prop in template.properties:
+                plan.append(Column(key, prop, 'value', _converter(template.properties[prop])))
+            else:
+                raise LogicalError('a {0} doesn\'t have the property {1}'.format(kind_name, prop))
+        #the name comes first, as it's needed to make the object
+        plan.sort(key=lambda column: column.what != 'name')
+        if not plan or plan[0].what != 'name':
+            raise LogicalError('rows of {0}s need a name'.format(kind_name))
+        self.plans[(kind_name, columns)] = plan
+        return plan
+
+    def rows(self, kind_name, rows):
+        """
+        Make an object of kind_name for each row, then add them all to the world. Returns them in order.
+        """
+        w = self.world
+        kind = w.kinds.get(kind_name)
+        if kind is None:
+            raise LogicalError('Kind {0} does not exist'.format(kind_name))
+        is_room = 'room' in kind.kind_set()
+        made = []
+        plan = None
+        columns = None
+        for row in rows:
+            keys = tuple(row)
+            if keys != columns:
+                columns = keys
+                plan = self._plan(kind_name, kind, columns)
+            made.append(self._make(kind, plan, row, is_room))
+        w.add_all(made)
+        self.loaded.extend(made)
+        return made
+
+    def _make(self, kind, plan, row, is_room):
+        obj = kind(row[plan[0].key])
+        props = obj._properties
+        changed = []
+        for column in plan[1:]:
+            cell = row[column.key]
+            #a blank cell leaves the kind's default
+            if cell is None or cell == '':
+                continue
+            what = column.what
+            if what == 'value':
+                props[column.prop] = cell if column.convert is None or type(cell) is not str else column.convert(cell)
+            elif what == 'option':
+                changed.extend(obj._apply(column.prop, column.convert(cell)))
+            elif what == 'id':
+                props['id'] = cell
+            elif what == 'location':
+                #an object that's already there can be put in place when it's added, anything else waits for finish()
+                holder = cell if isinstance(cell, Kind) else self.world.objects.get(cell)
+                if holder is None:
+                    self.locations.append((obj, cell))
+                else:
+                    props['location'] = holder
+            else:
+                self.connections.append((obj, column.prop, cell, what == 'of'))
+        if changed:
+            obj._settle(changed)
+        if is_room and props['description'] == '':
+            props['description'] = 'It\'s the ' + props['name'] + '.'
+        return obj
+
+    def csv(self, kind_name, f, **kwargs):
+        """
+        Load the rows of a CSV file (a path or an open file) with a header line. If kind_name is None, there needs to be
+        a kind column.
+        """
+        if isinstance(f, str):
+            with open(f, newline='') as src:
+                return self.csv(kind_name, src, **kwargs)
+        return self._records(csv.DictReader(f, **kwargs), kind_name)
+
+    def json_lines(self, f, kind_name=None):
+        """
+        Load a JSON object from each line of f (a path, an open file or a string), using its kind key if kind_name is
+        None.
+        """
+        if isinstance(f, str):
+            if '\n' in f or f.lstrip().startswith('{'):
+                f = io.StringIO(f)
+            else:
+                with open(f) as src:
+                    return self.json_lines(src, kind_name)
+        return self._records((json.loads(line) for line in f if line.strip()), kind_name)
+
+    def _records(self, records, kind_name):
+        if kind_name is not None:
+            return self.rows(kind_name, records)
+        #keep runs of the same kind together, so each run goes through rows() in one go
+        made = []
+        run = []
+        run_kind = None
+        for record in records:
+            kind = record.get('kind')
+            if kind is None:
+                raise LogicalError('{0} doesn\'t say what kind it is'.format(record))
+            if kind != run_kind and run:
+                made.extend(self.rows(run_kind, run))
+                run = []
+            run_kind = kind
+            run.append(record)
+        if run:
+            made.extend(self.rows(run_kind, run))
+        return made
+
+    def _find(self, ref, names):
+        if isinstance(ref, Kind):
+            return ref
+        ref = str(ref)
+        obj = self.world.objects.get(ref)
+        if obj is None:
+            obj = names.get(ref.lower())
+        if obj is None:
+            raise LogicalError('there\'s nothing called {0}'.format(ref))
+        return obj
+
+    def finish(self):
+        """
+        Put everything loaded where it belongs and connect the rooms up. Returns the objects loaded.
+        """
+        w = self.world
+        names = {}
+        if self.locations or self.connections:
+            #names are only looked up if the reference isn't an id, so the first object with a name wins
+            for obj in reversed(list(w.objects.values())):
+                names[obj._properties['name'].lower()] = obj
+        for obj, ref in self.locations:
+            w.move(obj, self._find(ref, names))
+        #room -> {direction: room id} to add, and the same for the reverse connections, which don't replace anything
+        firm = {}
+        soft = {}
+        directions = w.directions
+        for room, direction, ref, reverse in self.connections:
+            room = self._find(room, names)
+            other = self._find(ref, names)
+            direction = directions[direction]
+            if reverse:
+                room, other = other, room
+            if not room.is_a('room') or not (other.is_a('room') or other.is_a('door')):
+                raise LogicalError('can only make connections from rooms to rooms or doors, not from {0} to {1}'
+                                   .format(room.type, other.type))
+            firm.setdefault(room, {})[direction.id] = other.id
+            opposite = direction._properties['opposite']
+            if other.is_a('room') and isinstance(opposite, Kind) and opposite is not Kind.nothing:
+                soft.setdefault(other, {})[opposite.id] = room.id
+        #in the order they were loaded, so anything watching sees the same story each time
+        rooms = dict.fromkeys(firm)
+        rooms.update(dict.fromkeys(soft))
+        for room in rooms:
+            conns = dict(soft.get(room, ()))
+            conns.update(room._properties['map connections'])
+            conns.update(firm.get(room, ()))
+            room['map connections'] = conns
+        loaded = self.loaded
+        self.locations = []
+        self.connections = []
+        self.loaded = []
+        return loaded
+
+
+def load(w, rows_by_kind=(), connections=()):
+    """
+    Load {kind name: rows} into w in one go, plus connections as (from, direction, to) rows, and finish.
+    """
+    loader = Loader(w)
+    for kind_name, rows in dict(rows_by_kind).items():
+        loader.rows(kind_name, rows)
+    for fro, direction, to in connections:
+        loader.connections.append((fro, direction, to, False))
+    return loader.finish()
@@ -0,0 +1,70 @@
+import sys
+
+
+class Sink:
+    """
+    Somewhere for the text a world says to go. The world buffers everything said during an action and hands it over
+    in one go when the action finishes.
+    """
+
+    def write(self, messages):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class StdoutSink(Sink):
+    def write(self, messages):
+        #looked up every time so that anything redirecting stdout still sees the output
+        sys.stdout.write(''.join(msg + '\n' for msg in messages))
+
+
+class BufferSink(Sink):
+    """
+    Keeps everything in memory, e.g. for tests.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def write(self, messages):
+        self.messages.extend(messages)
+
+    def text(self):
+        return ''.join(msg + '\n' for msg in self.messages)
+
+    def clear(self):
+        self.messages = []
+
+
+class FileSink(Sink):
+    def __init__(self, path, mode='a'):
+        self.file = open(path, mode)
+
+    def write(self, messages):
+        self.file.write(''.join(msg + '\n' for msg in messages))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class QueueSink(Sink):
+    """
+    Puts each turn's messages on a queue (a queue.Queue or asyncio.Queue) as one list, e.g. for a hosted session.
+    """
+
+    def __init__(self, queue=None):
+        if queue is None:
+            import queue as queue_module
+            queue = queue_module.Queue()
+        self.queue = queue
+
+    def write(self, messages):
+        self.queue.put_nowait(list(messages))
+
+
+class NullSink(Sink):
+    def write(self, messages):
+        pass
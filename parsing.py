@@ -0,0 +1,214 @@
+"""
+Understanding typed commands.
+
+Every phrase an action, direction or object can be understood as is compiled into a word trie: one for the verbs that
+start commands and one for the nouns after them. Objects are also understood by each word of their name, so "box" is
+enough for the red box. Parsing a command walks the tries a word at a time and only checks the objects that match
+against what the actor can see, so it doesn't depend on how many objects the world has.
+
+The tries are kept up to date as objects are added, renamed or given new 'understand as' phrases (replace the list
+rather than changing it in place, so the change is noticed).
+"""
+import string
+
+from world import ACTIONS, debug_enabled, debug_msg
+
+#words that don't change which object is meant
+ARTICLES = {'a', 'an', 'the', 'some'}
+#words that can come between the nouns of an action that applies to more than one
+PREPOSITIONS = {'in', 'into', 'inside', 'on', 'onto', 'to', 'with', 'at', 'from', 'under', 'about'}
+
+_punctuation = str.maketrans(string.punctuation.replace('\'', '').replace('-', ''), ' ' * (len(string.punctuation) - 2))
+
+
+class ParseError(Exception):
+    """
+    A command that couldn't be understood. The message is what to tell the player.
+    """
+    pass
+
+
+def tokenise(text):
+    return text.lower().translate(_punctuation).split()
+
+
+class Node:
+    __slots__ = ('children', 'ends')
+
+    def __init__(self):
+        self.children = {}
+        #id -> object for everything understood as the words leading here
+        self.ends = None
+
+
+class Trie:
+    def __init__(self):
+        self.root = Node()
+
+    def add(self, words, obj):
+        node = self.root
+        for word in words:
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = Node()
+            node = child
+        if node.ends is None:
+            node.ends = {}
+        node.ends[obj.id] = obj
+
+    def remove(self, words, obj):
+        node = self.root
+        for word in words:
+            node = node.children.get(word)
+            if node is None:
+                return
+        if node.ends is not None:
+            node.ends.pop(obj.id, None)
+
+    def matches(self, tokens, start):
+        """
+        Every (end, objects) where tokens[start:end] is a phrase in the trie, longest first.
+        """
+        found = []
+        node = self.root
+        for i in range(start, len(tokens)):
+            node = node.children.get(tokens[i])
+            if node is None:
+                break
+            if node.ends:
+                found.append((i + 1, node.ends))
+        found.reverse()
+        return found
+
+
+def phrases(obj):
+    """
+    The lists of words obj can be understood as.
+    """
+    understood = obj._properties.get('understand as')
+    if understood is None:
+        understood = []
+    elif type(understood) is str:
+        understood = [understood]
+    found = {tuple(tokenise(phrase)) for phrase in understood}
+    if not obj.is_a('action'):
+        name = tokenise(obj.name)
+        found.add(tuple(name))
+        found.update((word,) for word in name if word not in ARTICLES)
+    found.discard(())
+    return found
+
+
+class Parser:
+    def __init__(self, w):
+        self.world = w
+        self.rebuild()
+        w.watch('name', self._renamed)
+        w.watch('understand as', self._renamed)
+
+    def rebuild(self):
+        """
+        Index every object in the world again from scratch.
+        """
+        self.verbs = Trie()
+        self.nouns = Trie()
+        #id -> the phrases it was added to the tries with
+        self.indexed = {}
+        for obj in self.world.objects.values():
+            self.add(obj)
+
+    def add(self, obj):
+        trie = self.verbs if obj.is_a('action') else self.nouns
+        found = phrases(obj)
+        for words in found:
+            trie.add(words, obj)
+        self.indexed[obj.id] = found
+
+    def remove(self, obj):
+        trie = self.verbs if obj.is_a('action') else self.nouns
+        for words in self.indexed.pop(obj.id, ()):
+            trie.remove(words, obj)
+
+    def _renamed(self, obj, prop):
+        if obj.id in self.indexed:
+            self.remove(obj)
+            self.add(obj)
+
+    def scope(self, actor):
+        """
+        Everything actor can see, as id -> object. The directions can always be referred to as well.
+        """
+        return self.world.scope_of(actor).visible
+
+    def _in_scope(self, candidates, scope):
+        directions = self.world.directions
+        if len(candidates) <= len(scope) + len(directions):
+            return [obj for obj_id, obj in candidates.items() if obj_id in scope or obj_id in directions]
+        found = [obj for obj_id, obj in scope.items() if obj_id in candidates]
+        found.extend(obj for obj_id, obj in directions.items() if obj_id in candidates)
+        return found
+
+    def _noun(self, tokens, start, scope, ambiguous):
+        #(end, object) for each way a noun can start at tokens[start], longest first
+        while start < len(tokens) and tokens[start] in ARTICLES:
+            start += 1
+        found = []
+        for end, candidates in self.nouns.matches(tokens, start):
+            objs = self._in_scope(candidates, scope)
+            if len(objs) == 1:
+                found.append((end, objs[0]))
+            elif objs:
+                ambiguous.append(objs)
+        return found
+
+    def _nouns(self, tokens, start, count, scope, ambiguous):
+        #a way to read exactly count nouns from tokens[start:], or None
+        if count == 0:
+            return [] if start == len(tokens) else None
+        if start < len(tokens) and tokens[start] in PREPOSITIONS:
+            start += 1
+        for end, obj in self._noun(tokens, start, scope, ambiguous):
+            rest = self._nouns(tokens, end, count - 1, scope, ambiguous)
+            if rest is not None:
+                return [obj] + rest
+        return None
+
+    def parse(self, text, actor):
+        """
+        Work out which action text asks for and which objects it applies to, as (action, nouns). Raises a ParseError
+        if it can't.
+        """
+        tokens = tokenise(text)
+        if not tokens:
+            raise ParseError('I beg your pardon?')
+        ambiguous = []
+        verbs = self.verbs.matches(tokens, 0)
+        #only worked out if there are nouns to look for
+        scope = None if len(verbs) == 1 and verbs[0][0] == len(tokens) else self.scope(actor)
+        if not verbs:
+            #a direction on its own means going that way
+            for end, obj in self._noun(tokens, 0, scope, ambiguous):
+                if end == len(tokens) and obj.id in self.world.directions:
+                    return self.world.actions['going'], [obj]
+            raise ParseError('That\'s not a verb I recognise.')
+        understood = None
+        for end, actions in verbs:
+            for action in actions.values():
+                count = action._properties.get('applies to') or 0
+                if count and end == len(tokens):
+                    understood = 'You must supply a noun.'
+                    continue
+                nouns = self._nouns(tokens, end, count, scope, ambiguous)
+                if nouns is not None:
+                    if debug_enabled(ACTIONS):
+                        debug_msg('understood "{0}" as {1} {2}', text, action.id, [obj.name for obj in nouns],
+                                  subsystem=ACTIONS)
+                    return action, nouns
+                if understood is None:
+                    if count == 0:
+                        understood = 'I only understood you as far as wanting to {0}.'.format(' '.join(tokens[:end]))
+                    else:
+                        understood = 'You can\'t see any such thing.'
+        if ambiguous:
+            raise ParseError('Which do you mean, {0}?'.format(' or '.join('the ' + obj.name for obj in ambiguous[0])))
+        raise ParseError(understood)
@@ -0,0 +1,96 @@
+import time
+
+
+class RuleStats:
+    def __init__(self, rulebook, rule):
+        self.rulebook = rulebook
+        self.rule = rule
+        self.calls = 0
+        self.outcomes = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+
+
+class RulebookStats:
+    def __init__(self, rulebook):
+        self.rulebook = rulebook
+        self.follows = 0
+        self.depth = 0
+        self.total_time = 0.0
+
+
+class Profiler:
+    """
+    Records how often each rule is followed, how often it has an outcome and how long it takes (both in total and
+    excluding the rulebooks it follows itself). Turn it on with World.start_profiling().
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.rulebooks = {}
+        #collapsed stack -> self time, for flamegraphs
+        self.stacks = {}
+        #each frame is [stack, start time, time spent in children]
+        self._frames = []
+        self._depth = 0
+
+    def _push(self, label):
+        stack = label if not self._frames else self._frames[-1][0] + ';' + label
+        self._frames.append([stack, time.perf_counter(), 0.0])
+
+    def _pop(self):
+        stack, start, children = self._frames.pop()
+        elapsed = time.perf_counter() - start
+        if self._frames:
+            self._frames[-1][2] += elapsed
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + elapsed - children
+        return elapsed, children
+
+    def enter_rulebook(self, rulebook):
+        stats = self.rulebooks.get(rulebook.name)
+        if stats is None:
+            stats = self.rulebooks[rulebook.name] = RulebookStats(rulebook.name)
+        stats.follows += 1
+        self._depth += 1
+        stats.depth = max(stats.depth, self._depth)
+        self._push(rulebook.name)
+
+    def exit_rulebook(self, rulebook):
+        elapsed, _ = self._pop()
+        self._depth -= 1
+        self.rulebooks[rulebook.name].total_time += elapsed
+
+    def enter_rule(self, rule):
+        self._push(rule.name)
+
+    def exit_rule(self, rulebook, rule, result):
+        elapsed, children = self._pop()
+        key = (rulebook.name, rule.name)
+        stats = self.rules.get(key)
+        if stats is None:
+            stats = self.rules[key] = RuleStats(rulebook.name, rule.name)
+        stats.calls += 1
+        if result is not None:
+            stats.outcomes += 1
+        stats.total_time += elapsed
+        stats.self_time += elapsed - children
+
+    def table(self, sort='self_time', limit=None):
+        """
+        The rule statistics as a plain text table, slowest first.
+        """
+        rows = sorted(self.rules.values(), key=lambda s: getattr(s, sort), reverse=True)
+        if limit is not None:
+            rows = rows[:limit]
+        lines = ['{0:>8} {1:>8} {2:>12} {3:>12}  {4}'.format('calls', 'outcomes', 'total (ms)', 'self (ms)', 'rule')]
+        for s in rows:
+            lines.append('{0:>8} {1:>8} {2:>12.3f} {3:>12.3f}  {4} ({5}, depth {6})'.format(
+                s.calls, s.outcomes, s.total_time * 1000, s.self_time * 1000, s.rule, s.rulebook,
+                self.rulebooks[s.rulebook].depth))
+        return '\n'.join(lines)
+
+    def collapsed_stacks(self):
+        """
+        The self time of every rulebook/rule stack in microseconds, in the collapsed format flamegraph.pl reads.
+        """
+        return '\n'.join('{0} {1}'.format(stack, int(t * 1000000)) for stack, t in self.stacks.items())
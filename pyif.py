@@ -1,7 +1,11 @@
+import contextvars
+
+import relations
 import world
 
 
-_current_world = None
+#each thread/asyncio task (or session, see sessions.py) can have its own current world
+_world = contextvars.ContextVar('world', default=None)
 
 
 def current_world():
@@ -9,20 +13,31 @@ def current_world():
     Get the current world.
     """
 
-    return _current_world
+    return _world.get()
+
+
+def set_current_world(w):
+    """
+    Make w the world that the helpers here work on, in the current context.
+    """
+
+    _world.set(w)
 
 
-def make_blank_world():
+def make_blank_world(fresh=False):
     """
-    Make a blank world and populate it with the standard rules (directions, etc)
+    Make a blank world and populate it with the standard rules (directions, etc). It's a copy of a world with the
+    standard rules that's only built once, unless fresh is set.
     """
 
     import standard_rules
-    return standard_rules.create_standard_rules()
+    if fresh:
+        return standard_rules.create_standard_rules()
+    return standard_rules.standard_world()
 
 
 def title(t):
-    _current_world.set_title(t)
+    current_world().set_title(t)
 
 
 def default_rule():
@@ -30,7 +45,7 @@ def default_rule():
 
 
 def last_message():
-    return _current_world.last_message()
+    return current_world().last_message()
 
 
 #region Object Creation
@@ -40,24 +55,20 @@ def kind(name, properties=None, kindof=None):
     """
     Helper function to make a new kind (class).
     """
+    w = current_world()
     #quick check if it already exists
-    if name in _current_world.kinds:
+    if name in w.kinds:
         raise world.AlreadyExistsError('Kind {0} already exists'.format(name))
     if kindof is None:
         kind = world.Kind
     else:
-        if kindof not in _current_world.kinds:
+        if kindof not in w.kinds:
             raise world.UnknownKindError('Kind {0} does not exist'.format(kindof))
-        kind = _current_world.kinds[kindof]
-    #make a fancy init function that appends all the extra creation logic, if needed
-
-    def init(self, n, name_id=False):
-        kind.__init__(self, n, name_id)
-        if properties is not None:
-            properties(self)
-
-    newkind = type(name, (kind,), {'__init__': init})
-    _current_world.kinds[name] = newkind
+        kind = w.kinds[kindof]
+    #the extra creation logic is run once, when the kind's template is first built
+    newkind = type(name, (kind,), {'__slots__': (),
+                                   '_kind_properties': None if properties is None else staticmethod(properties)})
+    w.add_kind(name, newkind)
     return newkind
 
 
@@ -66,7 +77,7 @@ def direction(name, short_name=None):
     Helper function to make a new direction
     """
     dir = make_object(name, 'direction', name_id=True, **({} if short_name is None else {'understand as': short_name}))
-    #_current_world.dirs[name] = dir
+    #current_world().dirs[name] = dir
     return dir
 
 
@@ -99,14 +110,15 @@ def thing(name, *args, **kwargs):
     return make_object(name, 'thing', *args, **kwargs)
 
 
-def make_object(name, ty, name_id=False, *args, **kwargs):
-    obj = _current_world.kinds[ty](name, name_id)
+def make_object(name, ty, *args, name_id=False, **kwargs):
+    w = current_world()
+    obj = w.kinds[ty](name, name_id)
     for arg in args:
         obj[arg] = True
     for k, v in kwargs.items():
         k = str.replace(k, '_', ' ')
         obj[k] = v
-    _current_world.add(obj)
+    w.add(obj)
     return obj
 
 #endregion
@@ -126,8 +138,8 @@ def make_map_connections(fro, conns):
             #X is south of Y ---> Y has a connection south: X.
             #this implies Y is north of X, but there may be another thing there
             #if there is, ignore it and carry on
-            opposite = _current_world.directions[dir[:-3]].opposite
-            direction = _current_world.directions[dir[:-3]]
+            direction = current_world().directions[dir[:-3]]
+            opposite = direction.opposite
             add_map_connection(to, fro, direction)
             add_map_connection(fro, to, opposite, softly=True)
 
@@ -137,57 +149,107 @@ def add_map_connection(fro, to, direction, softly=False):
     Add a map connection between two rooms.
     If softly=True, it won't override any existing connections made
     """
-    if direction.type is 'direction':
+    if isinstance(direction, world.Kind) and direction.is_a('direction'):
         direction = direction.id
-    from_room = _current_world[fro]
-    to_room = _current_world[to]
-    if from_room.type is not 'room' or to_room.type is not 'room':
-        raise world.LogicalError('can only make connections between rooms, not between {0} and {1}'
+    w = current_world()
+    from_room = w[fro]
+    to_room = w[to]
+    if not from_room.is_a('room') or not (to_room.is_a('room') or to_room.is_a('door')):
+        raise world.LogicalError('can only make connections from rooms to rooms or doors, not from {0} to {1}'
                                  .format(from_room.type, to_room.type))
+    debugging = world.debug_enabled(world.MAP)
     if direction in from_room['map connections']:
         if softly:
-            world.debug_msg('{0} already has direction {1} going to {2}, softly failing to add {3}'.format(
-                from_room.name, direction, _current_world[from_room['map connections'][direction]], to
-            ))
+            if debugging:
+                world.debug_msg('{0} already has direction {1} going to {2}, softly failing to add {3}',
+                                from_room.name, direction, w[from_room['map connections'][direction]], to,
+                                subsystem=world.MAP)
             return
-        world.debug_msg('connection from {0} to {1} going {2} will overwrite the original destination {3}'
-                        .format(from_room.name, to, direction, from_room['map connections'][direction]))
+        if debugging:
+            world.debug_msg('connection from {0} to {1} going {2} will overwrite the original destination {3}',
+                            from_room.name, to, direction, from_room['map connections'][direction],
+                            subsystem=world.MAP)
 
-    from_room['map connections'][direction] = to
-    world.debug_msg('added connection from {0} ({3}) to {4} ({1}) going {2}'.format(from_room.name, to, direction,
-                                                                                    fro, to_room.name))
+    #replace the connections rather than changing them in place, as a forked world may be sharing them
+    conns = dict(from_room['map connections'])
+    conns[direction] = to
+    from_room['map connections'] = conns
+    if debugging:
+        world.debug_msg('added connection from {0} ({3}) to {4} ({1}) going {2}', from_room.name, to, direction, fro,
+                        to_room.name, subsystem=world.MAP)
 
 
 def add_rulebook(name, default=None):
-    if name in _current_world.rulebooks:
+    w = current_world()
+    if name in w.rulebooks:
         raise world.LogicalError('Rulebook {0} already exists'.format(name))
-    rules = world.Rulebook(name, _current_world, default)
-    _current_world.add_rulebook(name, rules)
+    rules = world.Rulebook(name, w, default)
+    w.add_rulebook(name, rules)
     return rules
 
 
-def when_play_begins(rule_name='', rule=default_rule, before=False):
-    add_rule('when play begins rules', rule_name, rule, before)
+def when_play_begins(rule_name='', rule=default_rule, before=False, after=None):
+    add_rule('when play begins rules', rule_name, rule, before, after)
 
 
-def add_rule(rulebook, name, rule, before=False):
-    _current_world.add_rule(rulebook, name, rule, before)
+def add_rule(rulebook, name, rule, before=False, after=None):
+    current_world().add_rule(rulebook, name, rule, before, after)
+
+
+def every_turn(rule_name, rule, before=False, after=None):
+    add_rule('every turn rules', rule_name, rule, before, after)
+
+
+def in_turns(turns, event):
+    """
+    Follow event turns turns from now (see World.schedule_in).
+    """
+    return current_world().schedule_in(turns, event)
+
+
+def at_time(when, event):
+    """
+    Follow event at a time of day, e.g. '5:00 PM'.
+    """
+    return current_world().schedule_at(when, event)
+
+
+def relation(name, kind=relations.MANY_TO_MANY, left=None, right=None):
+    """
+    Make a new relation, e.g. relation('knowing', relations.MANY_TO_MANY, 'person', 'thing'). left and right are the
+    kinds (or lists of kinds) allowed on each side, or None for anything.
+    """
+    w = current_world()
+    return w.add_relation(relations.Relation(w, name, kind, left, right))
 
 
 def now_player_carries(*args):
-    you = _current_world.get_player()
+    you = current_world().get_player()
     now_carries(you, *args)
 
 
 def now_carries(carrier, *args):
-    pass
+    carrying = current_world().relation('carrying')
+    for obj in args:
+        carrying.now(carrier, obj)
+
+
+def now_player_wears(*args):
+    now_wears(current_world().get_player(), *args)
+
+
+def now_wears(wearer, *args):
+    wearing = current_world().relation('wearing')
+    for obj in args:
+        wearing.now(wearer, obj)
 
 
 #region Actions
 def action(name, understand_as, applies_to=1):
     #make a new action and its three rulebooks
     #action = kind(name, understand_as=understand_as, applies_to=applies_to)
-    ac = make_object(name, 'action', True, understand_as=understand_as, applies_to=applies_to)
+    ac = make_object(name, 'action', name_id=True, understand_as=understand_as, applies_to=applies_to)
+    ac.set_action_variables_rules = add_rulebook('setting ' + name + ' action variables rules')
     ac.before_rules = add_rulebook('before '+name+' rules')
     ch = add_rulebook('check ' + name + ' rules')
     ca = add_rulebook('carry out ' + name + ' rules')
@@ -199,22 +261,29 @@ def action(name, understand_as, applies_to=1):
 
 
 def try_action(action, nouns=[], **kwargs):
-    you = _current_world.get_player()
+    you = current_world().get_player()
     actor_try_action(you, action, nouns, **kwargs)
 
 
 def actor_try_action(actor, action, nouns=[], **kwargs):
-    _current_world.try_action(actor, action, nouns, **kwargs)
+    current_world().try_action(actor, action, nouns, **kwargs)
+
+
+def try_command(text):
+    """
+    Have the player try a typed command, e.g. 'go north'.
+    """
+    current_world().try_command(text)
 
 #endregion
 
 
 def test_with_actions(actions):
+    w = current_world()
     for i, action in enumerate(actions):
-        _current_world.say('TEST {0}: {1}'.format(i, action if type(action) is str else (action[0] + ' ' +
-                                                                                         action[1][0].name)))
-        _current_world.say('---')
+        w.say('TEST {0}: {1}'.format(i, action if type(action) is str else (action[0] + ' ' + action[1][0].name)))
+        w.say('---')
         try_action(action if type(action) is str else action[0], [] if type(action) is str else action[1])
 
 def go():
-    _current_world.go()
+    current_world().go()
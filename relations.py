@@ -0,0 +1,274 @@
+"""
+Relations between objects, as in Inform: who carries what, which people know about which things, and so on.
+
+A relation is one-to-one, one-to-many, many-to-one or many-to-many, which says how many things each side can be
+related to; making a new pair replaces any pair it's not allowed alongside. Relations made by the story keep an index
+each way, the ids of what each object relates to and of what relates to it, so asking either way costs as much as the
+answer rather than a look through every object:
+
+    knowing = pyif.relation('knowing', relations.MANY_TO_MANY, 'person', 'thing')
+    knowing.now(detective, clue)
+    knowing.relating(clue)      -> everyone who knows about the clue
+
+The standard relations - containment, support, carrying and wearing - are another way of looking at where things are,
+so they're answered from the world's tables of what holds what, and making one of them true moves something.
+"""
+from world import Kind, LogicalError, OBJECTS, debug_enabled, debug_msg
+
+ONE_TO_ONE = 'one-to-one'
+ONE_TO_MANY = 'one-to-many'
+MANY_TO_ONE = 'many-to-one'
+MANY_TO_MANY = 'many-to-many'
+KINDS = (ONE_TO_ONE, ONE_TO_MANY, MANY_TO_ONE, MANY_TO_MANY)
+
+
+def _is(obj, kinds):
+    return kinds is None or any(obj.is_a(kind) for kind in kinds)
+
+
+def _kinds(kinds):
+    return None if kinds is None else (kinds,) if isinstance(kinds, str) else tuple(kinds)
+
+
+class Relation:
+    """
+    A relation kept by the story. Objects can be given as objects or ids; answers are lists of this world's objects.
+    """
+
+    def __init__(self, w, name, kind=MANY_TO_MANY, left=None, right=None):
+        if kind not in KINDS:
+            raise LogicalError('{0} isn\'t a kind of relation'.format(kind))
+        self.world = w
+        self.name = name
+        self.kind = kind
+        #the kinds of object allowed on each side, or None for any
+        self.left = _kinds(left)
+        self.right = _kinds(right)
+        #left id -> {right id: None}, and right id -> {left id: None}, in the order they were related
+        self.forward = {}
+        self.reverse = {}
+        self.count = 0
+        #set when the indexes are shared with the same relation in a forked world, and need copying to change
+        self._shared = False
+
+    def copy(self, w):
+        relation = Relation(w, self.name, self.kind, self.left, self.right)
+        relation.forward = self.forward
+        relation.reverse = self.reverse
+        relation.count = self.count
+        relation._shared = self._shared = True
+        return relation
+
+    def _own(self):
+        if self._shared:
+            self.forward = {key: related.copy() for key, related in self.forward.items()}
+            self.reverse = {key: related.copy() for key, related in self.reverse.items()}
+            self._shared = False
+
+    def _id(self, obj, kinds):
+        w = self.world
+        if not isinstance(obj, Kind):
+            obj = w[obj]
+        if w.objects.get(obj.id) is not obj:
+            raise LogicalError('{0} isn\'t part of the world, so can\'t be related by {1}'.format(obj.name, self.name))
+        if not _is(obj, kinds):
+            raise LogicalError('{0} (a {1}) can\'t be related by {2}'.format(obj.name, obj.type, self.name))
+        return obj.id
+
+    def _objects(self, ids):
+        objects = self.world.objects
+        return [objects[obj_id] for obj_id in ids]
+
+    def relates(self, a, b):
+        """
+        Whether a relates to b.
+        """
+        related = self.forward.get(a if type(a) is str else a.id)
+        return related is not None and (b if type(b) is str else b.id) in related
+
+    def __contains__(self, pair):
+        return self.relates(*pair)
+
+    def __len__(self):
+        return self.count
+
+    def now(self, a, b):
+        """
+        Make a relate to b, undoing whichever pairs that would be one too many for a one-to-something relation.
+        """
+        a_id = self._id(a, self.left)
+        b_id = self._id(b, self.right)
+        if self.relates(a_id, b_id):
+            return
+        self._own()
+        if self.kind in (ONE_TO_ONE, MANY_TO_ONE):
+            for old in list(self.forward.get(a_id, ())):
+                self._remove(a_id, old)
+        if self.kind in (ONE_TO_ONE, ONE_TO_MANY):
+            for old in list(self.reverse.get(b_id, ())):
+                self._remove(old, b_id)
+        related = self.forward.get(a_id)
+        if related is None:
+            related = self.forward[a_id] = {}
+        related[b_id] = None
+        related = self.reverse.get(b_id)
+        if related is None:
+            related = self.reverse[b_id] = {}
+        related[a_id] = None
+        self.count += 1
+        if debug_enabled(OBJECTS):
+            debug_msg('{0} now relates {1} to {2}', self.name, a_id, b_id, subsystem=OBJECTS)
+
+    def now_not(self, a, b):
+        a_id = a if type(a) is str else a.id
+        b_id = b if type(b) is str else b.id
+        if self.relates(a_id, b_id):
+            self._own()
+            self._remove(a_id, b_id)
+
+    def _remove(self, a_id, b_id):
+        related = self.forward[a_id]
+        del related[b_id]
+        if not related:
+            del self.forward[a_id]
+        related = self.reverse[b_id]
+        del related[a_id]
+        if not related:
+            del self.reverse[b_id]
+        self.count -= 1
+
+    def forget(self, obj):
+        """
+        Undo every pair obj is part of, on either side.
+        """
+        obj_id = obj if type(obj) is str else obj.id
+        if obj_id in self.forward or obj_id in self.reverse:
+            self._own()
+            for other in list(self.forward.get(obj_id, ())):
+                self._remove(obj_id, other)
+            for other in list(self.reverse.get(obj_id, ())):
+                self._remove(other, obj_id)
+
+    def clear(self):
+        self.forward = {}
+        self.reverse = {}
+        self.count = 0
+        self._shared = False
+
+    def related(self, a):
+        """
+        Everything a relates to.
+        """
+        return self._objects(self.forward.get(a if type(a) is str else a.id, ()))
+
+    def relating(self, b):
+        """
+        Everything that relates to b.
+        """
+        return self._objects(self.reverse.get(b if type(b) is str else b.id, ()))
+
+    def the_related(self, a):
+        """
+        The thing a relates to (the first, if there's more than one), or None.
+        """
+        related = self.forward.get(a if type(a) is str else a.id)
+        return None if not related else self.world.objects[next(iter(related))]
+
+    def the_relating(self, b):
+        related = self.reverse.get(b if type(b) is str else b.id)
+        return None if not related else self.world.objects[next(iter(related))]
+
+    def pairs(self):
+        objects = self.world.objects
+        for a_id, related in self.forward.items():
+            for b_id in related:
+                yield objects[a_id], objects[b_id]
+
+
+class LocationRelation:
+    """
+    One of the standard relations, which are where things are: a relates to b if a directly holds b, a and b are the
+    right kinds of thing, and (for carrying and wearing) b is worn or not.
+    """
+
+    kind = ONE_TO_MANY
+
+    def __init__(self, w, name, left, right='thing', worn=None):
+        self.world = w
+        self.name = name
+        self.left = _kinds(left)
+        self.right = _kinds(right)
+        self.worn = worn
+
+    def copy(self, w):
+        return LocationRelation(w, self.name, self.left, self.right, self.worn)
+
+    def _fits(self, obj):
+        return _is(obj, self.right) and (self.worn is None or obj['worn'] == self.worn)
+
+    def _get(self, obj):
+        return self.world[obj] if type(obj) is str else obj
+
+    def relates(self, a, b):
+        a = self._get(a)
+        b = self._get(b)
+        return self.world.holder_of(b) is a and _is(a, self.left) and self._fits(b)
+
+    def __contains__(self, pair):
+        return self.relates(*pair)
+
+    def now(self, a, b):
+        """
+        Move b to a, and put it on or take it off for wearing and carrying.
+        """
+        a = self._get(a)
+        b = self._get(b)
+        if not _is(a, self.left) or not _is(b, self.right):
+            raise LogicalError('{0} can\'t relate {1} (a {2}) to {3} (a {4})'.format(
+                self.name, a.name, a.type, b.name, b.type))
+        if self.world.holder_of(b) is not a:
+            self.world.move(b, a)
+        if self.worn is not None:
+            b['worn'] = self.worn
+
+    def now_not(self, a, b):
+        """
+        Take b out of play, if a relates to it.
+        """
+        if self.relates(a, b):
+            self.world.move(self._get(b), 'nowhere')
+
+    def related(self, a):
+        a = self._get(a)
+        if not _is(a, self.left):
+            return []
+        return [obj for obj in self.world.contents_of(a) if self._fits(obj)]
+
+    def relating(self, b):
+        b = self._get(b)
+        holder = self.world.holder_of(b)
+        return [holder] if holder is not None and _is(holder, self.left) and self._fits(b) else []
+
+    def the_related(self, a):
+        related = self.related(a)
+        return related[0] if related else None
+
+    def the_relating(self, b):
+        relating = self.relating(b)
+        return relating[0] if relating else None
+
+    def pairs(self):
+        w = self.world
+        for kind in self.left:
+            for holder in w.instances_of(kind).values():
+                for obj in w.contents_of(holder):
+                    if self._fits(obj):
+                        yield holder, obj
+
+
+def add_standard_relations(w):
+    for relation in (LocationRelation(w, 'containment', ('container', 'room')),
+                     LocationRelation(w, 'support', 'supporter'),
+                     LocationRelation(w, 'carrying', 'being', worn=False),
+                     LocationRelation(w, 'wearing', 'being', worn=True)):
+        w.add_relation(relation)
@@ -0,0 +1,229 @@
+"""
+Finding routes between rooms.
+
+Routes are worked out backwards from where they go to: the first time anything asks for a route to a room, one
+breadth-first search finds how far every room that can get there is from it and which way to go from each. That's
+kept, so after that finding the next step towards the room from anywhere is a dictionary lookup - which suits people
+who are all heading for a few places and move every turn.
+
+The finder watches the map. When a connection changes, only the routes that went through it (or that it makes
+shorter) are thrown away. A door leads from the room it's in to its other side, and back; doors are fixed in place,
+so moving one isn't noticed (call clear() after doing that).
+"""
+import collections
+
+from world import Kind, MAP, debug_enabled, debug_msg
+
+
+def _id(obj):
+    return obj.id if isinstance(obj, Kind) else obj
+
+
+class RouteTree:
+    """
+    The routes to one room: for every room that can get there, how many moves away it is and (apart from the room
+    itself) the direction to go in and the room that leads to.
+    """
+
+    __slots__ = ('dist', 'step')
+
+    def __init__(self, dist, step):
+        self.dist = dist
+        self.step = step
+
+
+class RouteFinder:
+    def __init__(self, w):
+        self.world = w
+        #room id -> {direction id: (connection, room id it leads to, door id or None)}
+        self.links = None
+        #room id -> [(room id, direction id, door id or None)] for every connection leading there
+        self.into = None
+        #(using doors, even locked, region id) -> {room id: RouteTree}
+        self.trees = {}
+        w.watch('map connections', self.connections_changed)
+        w.watch('other side', self._door_moved)
+        w.watch('locked', self._door_locked)
+        w.watch('unlocked', self._door_locked)
+        w.watch('map region', self._region_changed)
+
+    def clear(self):
+        """
+        Forget everything, e.g. after the whole map has changed.
+        """
+        self.links = None
+        self.into = None
+        self.trees = {}
+
+    def _leads_to(self, room_id, connection):
+        #the room a connection goes to, and the door it goes through (if any)
+        objects = self.world.objects
+        obj = objects.get(_id(connection))
+        if obj is None:
+            return None, None
+        if not obj.is_a('door'):
+            return obj.id, None
+        other = _id(obj._properties['other side'])
+        if other != room_id and other in objects:
+            return other, obj.id
+        holder = self.world.holder_of(obj)
+        if holder is not None and holder.id != room_id:
+            return holder.id, obj.id
+        return None, None
+
+    def _link(self, room_id, direction, connection):
+        to, door = self._leads_to(room_id, connection)
+        link = (connection, to, door)
+        self.links[room_id][direction] = link
+        if to is not None:
+            self.into[to].append((room_id, direction, door))
+        return link
+
+    def _unlink(self, room_id, direction):
+        connection, to, door = self.links[room_id].pop(direction)
+        if to is not None:
+            self.into[to].remove((room_id, direction, door))
+        return connection, to, door
+
+    def _build_index(self):
+        self.links = {}
+        self.into = collections.defaultdict(list)
+        for room_id, room in self.world.instances_of('room').items():
+            self.links[room_id] = {}
+            for direction, connection in room._properties['map connections'].items():
+                self._link(room_id, _id(direction), connection)
+
+    def connections_changed(self, room, prop='map connections'):
+        """
+        Bring the map up to date with room's connections, and throw away any routes the changes affect.
+        """
+        if self.links is None:
+            return
+        room_id = room.id
+        links = self.links.get(room_id)
+        if links is None:
+            links = self.links[room_id] = {}
+        conns = {_id(direction): connection for direction, connection in room._properties['map connections'].items()}
+        for direction in set(links) | set(conns):
+            old = links.get(direction)
+            connection = conns.get(direction)
+            if old is not None and old[0] == connection:
+                continue
+            if old is not None:
+                old = self._unlink(room_id, direction)
+            new = None if connection is None else self._link(room_id, direction, connection)
+            self._edge_changed(room_id, direction, old, new)
+
+    def _edge_changed(self, room_id, direction, old, new):
+        objects = self.world.objects
+        for key, trees in self.trees.items():
+            using_doors, even_locked, region = key
+            stale = []
+            for target, tree in trees.items():
+                #a route went this way
+                if old is not None and tree.step.get(room_id) == (direction, old[1]):
+                    stale.append(target)
+                    continue
+                if new is None or new[1] not in tree.dist:
+                    continue
+                door = new[2]
+                if door is not None and (not using_doors or not even_locked and objects[door]['locked']):
+                    continue
+                if region is not None and _id(objects[room_id]._properties['map region']) != region:
+                    continue
+                #or it's a shortcut
+                if tree.dist[new[1]] + 1 < tree.dist.get(room_id, len(objects)):
+                    stale.append(target)
+            for target in stale:
+                del trees[target]
+            if stale and debug_enabled(MAP):
+                debug_msg('going {0} from {1} changed the routes to {2}', direction, room_id, ', '.join(stale),
+                          subsystem=MAP)
+
+    def _door_moved(self, door, prop):
+        #where every connection through the door goes has changed
+        if door.is_a('door'):
+            self.clear()
+
+    def _door_locked(self, door, prop):
+        if door.is_a('door'):
+            for key in [key for key in self.trees if key[0] and not key[1]]:
+                del self.trees[key]
+
+    def _region_changed(self, room, prop):
+        for key in [key for key in self.trees if key[2] is not None]:
+            del self.trees[key]
+
+    def _search(self, target, key):
+        using_doors, even_locked, region = key
+        objects = self.world.objects
+        dist = {}
+        step = {}
+        if region is not None and _id(objects[target]._properties['map region']) != region:
+            return RouteTree(dist, step)
+        dist[target] = 0
+        into = self.into
+        queue = collections.deque([target])
+        while queue:
+            to = queue.popleft()
+            d = dist[to] + 1
+            for fro, direction, door in into.get(to, ()):
+                if fro in dist:
+                    continue
+                if door is not None and (not using_doors or not even_locked and objects[door]['locked']):
+                    continue
+                if region is not None and _id(objects[fro]._properties['map region']) != region:
+                    continue
+                dist[fro] = d
+                step[fro] = (direction, to)
+                queue.append(fro)
+        if debug_enabled(MAP):
+            debug_msg('found routes to {0} from {1} rooms', target, len(dist) - 1, subsystem=MAP)
+        return RouteTree(dist, step)
+
+    def tree(self, to, using_doors=False, even_locked=False, region=None):
+        """
+        The routes to room to, working them out if they aren't known.
+        """
+        if self.links is None:
+            self._build_index()
+        key = (using_doors, even_locked, _id(region))
+        trees = self.trees.get(key)
+        if trees is None:
+            trees = self.trees[key] = {}
+        to = _id(to)
+        tree = trees.get(to)
+        if tree is None:
+            tree = trees[to] = self._search(to, key)
+        return tree
+
+    def precompute(self, rooms=None, using_doors=False, even_locked=False, region=None):
+        """
+        Work out the routes to each of rooms (every room by default) now, rather than when they're first needed.
+        """
+        if rooms is None:
+            rooms = self.world.instances_of('room')
+        for room in rooms:
+            self.tree(room, using_doors, even_locked, region)
+
+    def _direction(self, direction):
+        return self.world.objects.get(direction, direction)
+
+    def distance(self, fro, to, using_doors=False, even_locked=False, region=None):
+        return self.tree(to, using_doors, even_locked, region).dist.get(_id(fro))
+
+    def next_step(self, fro, to, using_doors=False, even_locked=False, region=None):
+        step = self.tree(to, using_doors, even_locked, region).step.get(_id(fro))
+        return None if step is None else self._direction(step[0])
+
+    def route(self, fro, to, using_doors=False, even_locked=False, region=None):
+        tree = self.tree(to, using_doors, even_locked, region)
+        room = _id(fro)
+        if room not in tree.dist:
+            return None
+        route = []
+        step = tree.step
+        while room in step:
+            direction, room = step[room]
+            route.append(self._direction(direction))
+        return route
@@ -0,0 +1,344 @@
+"""
+Saving and restoring the state of a world.
+
+Only the state that changes during play is saved: each object's either/or bits and its value properties (including
+its location and map connections), the world's variables and the action variables (which are properties of the
+action objects). Everything else - kinds, rules, text made by the story - comes from running the story script again,
+so a save is restored into a freshly built world (pyif.make_blank_world() plus the script). Objects are referred to
+by id. The pairs in the story's relations are saved too.
+
+The format is a stream of tagged records. Strings (and the lists of property names objects have) are written once and
+referred to by number after that.
+"""
+import mmap
+import struct
+
+from relations import Relation
+from world import Kind, LogicalError
+
+MAGIC = b'PYIF'
+VERSION = 1
+
+#records
+OBJECT = 0x4f
+VARIABLE = 0x56
+RELATION = 0x52
+END = 0x45
+
+#values
+NONE = 0x00
+TRUE = 0x01
+FALSE = 0x02
+INT = 0x03
+FLOAT = 0x04
+STR = 0x05
+REF = 0x06
+LIST = 0x07
+TUPLE = 0x08
+DICT = 0x09
+
+#strings
+NEW_STRING = 0x00
+OLD_STRING = 0x01
+
+_double = struct.Struct('<d')
+#properties that are fixed by the story script
+_skipped = {'id', 'type'}
+
+
+class _Skip(Exception):
+    pass
+
+
+class Writer:
+    def __init__(self, f, w, chunk_size=1 << 16):
+        self.f = f
+        self.world = w
+        self.buf = bytearray()
+        self.chunk_size = chunk_size
+        self.strings = {}
+        #the same kinds of object tend to have the same properties, so each list of property names is written once
+        self.shapes = {}
+
+    def flush(self):
+        self.f.write(self.buf)
+        self.buf = bytearray()
+
+    def varint(self, n):
+        buf = self.buf
+        if n < 0x80:
+            buf.append(n)
+            return
+        while n > 0x7f:
+            buf.append((n & 0x7f) | 0x80)
+            n >>= 7
+        buf.append(n)
+
+    def string(self, s):
+        index = self.strings.get(s)
+        if index is not None:
+            self.buf.append(OLD_STRING)
+            self.varint(index)
+            return
+        self.strings[s] = len(self.strings)
+        data = s.encode('utf-8')
+        self.buf.append(NEW_STRING)
+        self.varint(len(data))
+        self.buf += data
+
+    def encode(self, val):
+        #to check a value can be saved before anything is written for it
+        if val is None or val is True or val is False or type(val) in (int, float, str):
+            return
+        if isinstance(val, Kind):
+            #only objects that are part of the world can be found again
+            if self.world.objects.get(val.id) is not val and val is not Kind.nothing:
+                raise _Skip()
+        elif type(val) in (list, tuple):
+            for v in val:
+                self.encode(v)
+        elif type(val) is dict:
+            for k, v in val.items():
+                self.encode(k)
+                self.encode(v)
+        else:
+            raise _Skip()
+
+    def value(self, val):
+        buf = self.buf
+        if val is None:
+            buf.append(NONE)
+        elif val is True:
+            buf.append(TRUE)
+        elif val is False:
+            buf.append(FALSE)
+        elif type(val) is int:
+            buf.append(INT)
+            #zigzag, so small negative numbers stay small
+            self.varint(val << 1 if val >= 0 else (-val << 1) - 1)
+        elif type(val) is float:
+            buf.append(FLOAT)
+            buf += _double.pack(val)
+        elif type(val) is str:
+            buf.append(STR)
+            self.string(val)
+        elif isinstance(val, Kind):
+            buf.append(REF)
+            self.string(val.id)
+        elif type(val) is dict:
+            buf.append(DICT)
+            self.varint(len(val))
+            for k, v in val.items():
+                self.value(k)
+                self.value(v)
+        else:
+            buf.append(LIST if type(val) is list else TUPLE)
+            self.varint(len(val))
+            for v in val:
+                self.value(v)
+
+    def obj(self, obj):
+        keys = []
+        vals = []
+        for key, val in obj._properties.items():
+            if key in _skipped:
+                continue
+            if key == 'location':
+                val = obj['location']
+            try:
+                self.encode(val)
+            except _Skip:
+                continue
+            keys.append(key)
+            vals.append(val)
+        self.buf.append(OBJECT)
+        self.string(obj._properties['id'])
+        self.varint(obj._state)
+        self.varint(obj._always)
+        self.varint(obj._never)
+        keys = tuple(keys)
+        shape = self.shapes.get(keys)
+        if shape is None:
+            self.varint(len(self.shapes))
+            self.shapes[keys] = len(self.shapes)
+            self.varint(len(keys))
+            for key in keys:
+                self.string(key)
+        else:
+            self.varint(shape)
+        for val in vals:
+            self.value(val)
+        if len(self.buf) >= self.chunk_size:
+            self.flush()
+
+    def variable(self, key, val):
+        try:
+            self.encode(val)
+        except _Skip:
+            return
+        self.buf.append(VARIABLE)
+        self.string(key)
+        self.value(val)
+
+    def relation(self, relation):
+        self.buf.append(RELATION)
+        self.string(relation.name)
+        self.varint(len(relation))
+        for a_id, related in relation.forward.items():
+            for b_id in related:
+                self.string(a_id)
+                self.string(b_id)
+        if len(self.buf) >= self.chunk_size:
+            self.flush()
+
+
+class Reader:
+    def __init__(self, data, w):
+        self.data = data
+        self.pos = 0
+        self.strings = []
+        self.shapes = []
+        self.world = w
+
+    def byte(self):
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def varint(self):
+        data = self.data
+        pos = self.pos
+        n = data[pos]
+        if n < 0x80:
+            self.pos = pos + 1
+            return n
+        n = 0
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return n
+
+    def string(self):
+        if self.byte() == OLD_STRING:
+            return self.strings[self.varint()]
+        length = self.varint()
+        s = bytes(self.data[self.pos:self.pos + length]).decode('utf-8')
+        self.pos += length
+        self.strings.append(s)
+        return s
+
+    def ref(self, obj_id):
+        obj = self.world.objects.get(obj_id)
+        if obj is None:
+            if obj_id == Kind.nothing.id:
+                return Kind.nothing
+            raise LogicalError('saved object {0} isn\'t in the world being restored'.format(obj_id))
+        return obj
+
+    def value(self):
+        tag = self.byte()
+        if tag == NONE:
+            return None
+        if tag == TRUE:
+            return True
+        if tag == FALSE:
+            return False
+        if tag == INT:
+            n = self.varint()
+            return n >> 1 if not n & 1 else -((n + 1) >> 1)
+        if tag == FLOAT:
+            val = _double.unpack_from(self.data, self.pos)[0]
+            self.pos += 8
+            return val
+        if tag == STR:
+            return self.string()
+        if tag == REF:
+            return self.ref(self.string())
+        if tag == DICT:
+            return {self.value(): self.value() for _ in range(self.varint())}
+        vals = [self.value() for _ in range(self.varint())]
+        return vals if tag == LIST else tuple(vals)
+
+    def read(self):
+        if bytes(self.data[:4]) != MAGIC:
+            raise LogicalError('not a saved world')
+        if self.data[4] != VERSION:
+            raise LogicalError('saved world is version {0}, expected {1}'.format(self.data[4], VERSION))
+        self.pos = 5
+        w = self.world
+        #the saved pairs replace whatever the story started with
+        for relation in w.relations.values():
+            if isinstance(relation, Relation):
+                relation.clear()
+        while True:
+            tag = self.byte()
+            if tag == END:
+                return
+            if tag == OBJECT:
+                obj = self.ref(self.string())
+                state = self.varint()
+                obj._always = self.varint()
+                obj._never = self.varint()
+                shape = self.varint()
+                if shape == len(self.shapes):
+                    self.shapes.append([self.string() for _ in range(self.varint())])
+                for key in self.shapes[shape]:
+                    val = self.value()
+                    if key != 'location':
+                        obj._write(key, val)
+                    elif w.holder_of(obj) is not val:
+                        w.move(obj, val)
+                #after moving it, which can change it (e.g. taking off what's worn)
+                obj._state = state
+            elif tag == VARIABLE:
+                key = self.string()
+                w.variables[key] = self.value()
+            elif tag == RELATION:
+                relation = w.relation(self.string())
+                for _ in range(self.varint()):
+                    a = self.ref(self.string())
+                    relation.now(a, self.ref(self.string()))
+            else:
+                raise LogicalError('corrupt saved world (unknown record {0})'.format(tag))
+
+
+def save(w, f):
+    """
+    Save the state of world w to f, a path or a binary file. It's written out in chunks as it goes.
+    """
+    if isinstance(f, str):
+        with open(f, 'wb') as out:
+            return save(w, out)
+    writer = Writer(f, w)
+    writer.buf += MAGIC
+    writer.buf.append(VERSION)
+    for obj in w.objects.values():
+        writer.obj(obj)
+    for key, val in w.variables.items():
+        writer.variable(key, val)
+    for relation in w.relations.values():
+        if isinstance(relation, Relation):
+            writer.relation(relation)
+    writer.buf.append(END)
+    writer.flush()
+
+
+def restore(w, f):
+    """
+    Restore state saved by save() into w, which should have been built by the same story. f is a path (which is
+    memory-mapped rather than read in), a binary file or a bytes-like object.
+    """
+    if isinstance(f, str):
+        with open(f, 'rb') as src:
+            with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                Reader(data, w).read()
+        return
+    if hasattr(f, 'read'):
+        f = f.read()
+    Reader(memoryview(f), w).read()
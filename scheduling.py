@@ -0,0 +1,141 @@
+"""
+Timed events.
+
+Events are rules (or functions, which are made into rules) to follow once, either a number of turns from now or at a
+time of day. They wait in two heaps, one ordered by turn and one by time, so at the end of each turn only the events
+that are due are looked at, however many are waiting.
+
+Times are minutes since midnight, like the 'time of day' variable: 9:00 AM is 540.
+"""
+import heapq
+import re
+
+from world import LogicalError, Rule, debug_enabled, debug_msg, RULES
+
+MINUTES_PER_DAY = 24 * 60
+
+_time = re.compile(r'^\s*(\d{1,2})(?::(\d\d))?\s*([ap])\.?\s*m\.?\s*$', re.IGNORECASE)
+
+
+def parse_time(when):
+    """
+    The time of day written as e.g. '5:00 PM' or '9 am', in minutes since midnight. Numbers are taken to be minutes
+    already.
+    """
+    if type(when) is int:
+        return when % MINUTES_PER_DAY
+    match = _time.match(when)
+    if match is None:
+        raise LogicalError('{0} isn\'t a time of day'.format(when))
+    hours, minutes, half = int(match.group(1)), int(match.group(2) or 0), match.group(3).lower()
+    if not 1 <= hours <= 12 or minutes > 59:
+        raise LogicalError('{0} isn\'t a time of day'.format(when))
+    return (hours % 12 + (12 if half == 'p' else 0)) * 60 + minutes
+
+
+def format_time(minutes):
+    hours, minutes = divmod(minutes % MINUTES_PER_DAY, 60)
+    return '{0}:{1:02} {2}'.format(hours % 12 or 12, minutes, 'PM' if hours >= 12 else 'AM')
+
+
+class Scheduler:
+    def __init__(self, w):
+        self.world = w
+        #(turn count, number, rule) and (minutes since the story started, number, rule)
+        self.turns = []
+        self.times = []
+        #the numbers of the events still to happen, and of those cancelled but still in a heap
+        self.pending = set()
+        self.cancelled = set()
+        self.count = 0
+        #how many times the time of day has gone past midnight
+        self.day = 0
+
+    def copy(self, w):
+        scheduler = Scheduler(w)
+        scheduler.turns = self.turns[:]
+        scheduler.times = self.times[:]
+        scheduler.pending = self.pending.copy()
+        scheduler.cancelled = self.cancelled.copy()
+        scheduler.count = self.count
+        scheduler.day = self.day
+        return scheduler
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _time_of_day(self):
+        return self.world.variables.get('time of day') or 0
+
+    def now(self):
+        """
+        Minutes since midnight on the day the story started.
+        """
+        return self.day * MINUTES_PER_DAY + self._time_of_day()
+
+    @staticmethod
+    def _rule(event):
+        return event if isinstance(event, Rule) else Rule(getattr(event, '__name__', 'event'), event)
+
+    def _push(self, heap, due, event):
+        self.count += 1
+        heapq.heappush(heap, (due, self.count, self._rule(event)))
+        self.pending.add(self.count)
+        return self.count
+
+    def in_turns(self, turns, event):
+        """
+        Follow event at the end of the turn that's turns turns from now. Returns a number to cancel it with.
+        """
+        return self._push(self.turns, self.world.variables.get('turn count', 0) + turns, event)
+
+    def in_minutes(self, minutes, event):
+        return self._push(self.times, self.now() + minutes, event)
+
+    def at(self, when, event):
+        """
+        Follow event at the next time it's when (e.g. '5:00 PM'), which is today unless that's already gone.
+        """
+        minutes = parse_time(when)
+        due = self.day * MINUTES_PER_DAY + minutes
+        if minutes < self._time_of_day():
+            due += MINUTES_PER_DAY
+        return self._push(self.times, due, event)
+
+    def cancel(self, number):
+        if number in self.pending:
+            self.pending.discard(number)
+            self.cancelled.add(number)
+
+    def _pop_due(self, heap, now):
+        while heap and heap[0][0] <= now:
+            _, number, rule = heapq.heappop(heap)
+            if number in self.cancelled:
+                self.cancelled.discard(number)
+                continue
+            self.pending.discard(number)
+            return rule
+        return None
+
+    def fire_due(self):
+        """
+        Follow every event that's due, soonest first.
+        """
+        w = self.world
+        turn = w.variables.get('turn count', 0)
+        for heap, now in ((self.turns, turn), (self.times, self.now())):
+            while True:
+                rule = self._pop_due(heap, now)
+                if rule is None:
+                    break
+                if debug_enabled(RULES):
+                    debug_msg('timed event {0} is happening', rule.name, subsystem=RULES)
+                rule._evaluate(w, {})
+
+    def advance(self, minutes=1):
+        """
+        Move the time of day on, into the next day if need be.
+        """
+        days, time = divmod(self._time_of_day() + minutes, MINUTES_PER_DAY)
+        self.day += days
+        self.world['time of day'] = time
@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+import contextvars
+
+import output
+import pyif
+
+
+class Session:
+    """
+    One story being played. The session has its own context, so the helpers in pyif always work on this session's
+    world while it's running something, however many other sessions there are in the process.
+    """
+
+    def __init__(self, session_id, build_story):
+        """
+        build_story is called (in the session's context) to make the world, e.g. by calling pyif.make_blank_world()
+        and then running the story script. It can return the world, or leave it as the current world.
+        """
+        self.id = session_id
+        self.context = contextvars.Context()
+        self.world = self.context.run(self._build, build_story)
+        self.output = output.BufferSink()
+        self.world.set_output(self.output)
+        self.lock = None
+        self._token = None
+
+    @staticmethod
+    def _build(build_story):
+        w = build_story()
+        if w is None:
+            w = pyif.current_world()
+        else:
+            pyif.set_current_world(w)
+        return w
+
+    def __enter__(self):
+        self._token = pyif._world.set(self.world)
+        return self
+
+    def __exit__(self, *exc):
+        pyif._world.reset(self._token)
+        self._token = None
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run func in this session's context.
+        """
+        return self.context.run(func, *args, **kwargs)
+
+    def start(self):
+        """
+        Start the story (the when play begins rules) and return the opening text.
+        """
+        self.run(self.world.go)
+        return self.take_output()
+
+    def command(self, action, nouns=()):
+        """
+        Play a turn with the player trying an action, and return everything that was said.
+        """
+        self.run(self.world.play_turn, action, list(nouns))
+        return self.take_output()
+
+    def input(self, text):
+        """
+        Play a turn with the player trying a typed command, and return everything that was said.
+        """
+        self.run(self.world.play_command, text)
+        return self.take_output()
+
+    def take_output(self):
+        messages = self.output.messages
+        self.output.clear()
+        return messages
+
+
+class SessionManager:
+    """
+    Hosts many sessions in one process and routes each command to the right world. Commands for the same session are
+    run one at a time; commands for different sessions don't affect each other.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+
+    def open(self, session_id, build_story):
+        if session_id in self.sessions:
+            raise KeyError('session {0} is already open'.format(session_id))
+        session = self.sessions[session_id] = Session(session_id, build_story)
+        return session
+
+    def close(self, session_id):
+        session = self.sessions.pop(session_id)
+        session.world.output.close()
+        return session
+
+    def __getitem__(self, session_id):
+        return self.sessions[session_id]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def command(self, session_id, action, nouns=()):
+        return self.sessions[session_id].command(action, nouns)
+
+    def input(self, session_id, text):
+        return self.sessions[session_id].input(text)
+
+    async def handle(self, session_id, action, nouns=()):
+        """
+        The asyncio version of command.
+        """
+        async with self._lock(session_id) as session:
+            return session.command(action, nouns)
+
+    async def handle_input(self, session_id, text):
+        """
+        The asyncio version of input.
+        """
+        async with self._lock(session_id) as session:
+            return session.input(text)
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, session_id):
+        session = self.sessions[session_id]
+        if session.lock is None:
+            session.lock = asyncio.Lock()
+        async with session.lock:
+            yield session
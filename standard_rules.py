@@ -1,4 +1,8 @@
+import threading
+
+import output
 import pyif
+import relations
 import world
 from world import Kind
 
@@ -19,6 +23,8 @@ def create_thing(thing):
     thing.can_be(['fixed in place', 'portable'], usually='portable')
     thing.can_be('scenery')
     thing.can_be('wearable')
+    #whether it's being worn by whoever holds it (see the wearing relation)
+    thing.can_be('worn')
     thing.has('description', '')
     thing.has('location', 'nowhere')
     thing.can_be('pushable between rooms', usually=True)
@@ -130,52 +136,83 @@ def create_base_rulebooks():
         story.say(story.title)
         story.say('-------\n')
 
-    def descend_processing(world, actor, action, nouns):
-        return world.rulebooks['specific action processing rules'].follow(actor=actor, action=action, nouns=nouns)
-
     def work_out_details(world, actor, action, nouns):
         pass
 
+    def basic_visibility(world, actor, action):
+        if action.requires_light and world.in_darkness(actor):
+            if actor is world.get_player():
+                world.say('It is pitch dark, and you can\'t see a thing.')
+            return False
+
+    def basic_accessibility(world, actor, action, nouns):
+        if not action.requires_touching:
+            return None
+        for noun in nouns:
+            if not world.can_touch(actor, noun):
+                if actor is world.get_player():
+                    barrier = world.get_visibility().barrier(actor, noun)
+                    world.say('You can\'t reach into the {0}.'.format(barrier.name) if barrier is not None
+                              else 'You can\'t reach the {0}.'.format(noun.name))
+                return False
+
+    def initial_room_description(world):
+        world.try_action(world.get_player(), 'looking')
+
     def position_player(world):
-        world.get_player().location = world.first_room_made
+        world.move(world.get_player(), world.first_room_made)
 
     begins = pyif.add_rulebook('when play begins rules')
     begins.add_rule_first('display banner rule', intro_text)
     begins.add_rule_first('position player in model world rule', position_player)
-    begins.add_rule_first('initial room description rule', lambda world: pyif.try_action('looking'))
+    begins.add_rule_first('initial room description rule', initial_room_description)
 
 
     pyif.add_rulebook('before rules')
     pyif.add_rulebook('instead rules')
 
+    def timed_events(world):
+        if world.scheduler is not None:
+            world.scheduler.fire_due()
+
+    def advance_time(world):
+        world['turn count'] += 1
+        world.get_scheduler().advance(1)
+
+    pyif.add_rulebook('every turn rules')
+    turns = pyif.add_rulebook('turn sequence rules')
+    turns.add_rule(world.FollowRule('every turn stage rule', 'every turn rules', passes=()))
+    turns.add_rule('timed events rule', timed_events)
+    turns.add_rule('advance time rule', advance_time)
+
     ap = pyif.add_rulebook('action processing rules')
     #announce multiple from list, set pronouns are skipped
     ap.add_rule_first('set action variables rule', set_action_vars)
-    ap.add_rule_first('before stage rule', lambda world: world.rulebooks['before rules'].follow())
+    ap.add_rule_first(world.FollowRule('before stage rule', 'before rules', passes=()))
     ap.add_rule('carrying requirements rule', None)
-    ap.add_rule('basic visibility rule', None)
-    ap.add_rule('basic accessibility rule', None)
+    ap.add_rule('basic visibility rule', basic_visibility)
+    ap.add_rule('basic accessibility rule', basic_accessibility)
 
-    ap.add_rule_last('instead stage rule', lambda world: world.rulebooks['instead rules'].follow())
+    ap.add_rule_last(world.FollowRule('instead stage rule', 'instead rules', passes=()))
     ap.add_rule_last('requested actions require persuasion rule', None)
     ap.add_rule_last('carry out requested actions rule', None)
-    ap.add_rule_last('descend to specific action processing rule', descend_processing)
+    ap.add_rule_last(world.FollowRule('descend to specific action processing rule',
+                                      'specific action processing rules'))
     ap.add_rule_last('end action processing rule', None)
 
     sap = pyif.add_rulebook('specific action processing rules')
     sap.add_rule_first('work out details of specific action processing rule', work_out_details)
     sap.add_rule('investigate player awareness before action rule', None)
-    sap.add_rule('check stage rule', lambda world, actor, action, nouns: action.check_rules.follow(action=action))
-    sap.add_rule('carry out stage rule', lambda world, actor, action, nouns: action.carry_out_rules.follow(action=action))
+    sap.add_rule(world.FollowRule('check stage rule', lambda action: action.check_rules, passes=['action']))
+    sap.add_rule(world.FollowRule('carry out stage rule', lambda action: action.carry_out_rules, passes=['action']))
     sap.add_rule('after stage rule', None)
     sap.add_rule('investigate player awareness after action rule', None)
-    sap.add_rule('report stage rule', lambda world, actor, action, nouns: action.report_rules.follow(action=action))
+    sap.add_rule(world.FollowRule('report stage rule', lambda action: action.report_rules, passes=['action']))
     sap.add_rule('last rule', lambda world: True)
 
 
 def create_action(action):
-    action.has('set action variables rules', world.Rulebook('setting ' + action.name + 'action variables rules',
-                                                               world))
+    action.has('set action variables rules')
     action.has('applies to')
     action.has('before rules')
     action.has('check rules')
@@ -183,6 +220,9 @@ def create_action(action):
     action.has('report rules')
     action.has('current actor', None)
     action.has('current nouns', None)
+    #whether the actor has to be able to see, and to touch the nouns
+    action.has('requires light', False)
+    action.has('requires touching', False)
 
 
 def create_base_actions():
@@ -194,22 +234,33 @@ def create_base_actions():
 def create_looking():
     def desc_heading_rule(world, action):
         w = world
+        if w.in_darkness(action.current_actor):
+            w.say('Darkness')
+            return
         w.say(action.current_actor.location.name + ' (current room)')
 
     def desc_body_rule(world, action):
         #world.say('(describing the room)')
+        if world.in_darkness(action.current_actor):
+            world.say('\nIt is pitch dark, and you can\'t see a thing.\n\n')
+            return
         world.say('\n'+action.current_actor.location.description+'\n\n')
 
+    def determine_ceiling(world, action):
+        scope = world.scope_of(action.current_actor)
+        action.visibility_ceiling = scope.ceiling
+        action.visibility_level_count = scope.levels if scope.lit else 0
+
     def check_arrival_rule(world, action):
-        if action.current_actor.location.type == 'room':
+        if action.current_actor.location.is_a('room'):
             action.current_actor.location.visited = True
 
-    look = pyif.action('looking', understand_as=['look'], applies_to=0)
+    look = pyif.action('looking', understand_as=['look', 'l'], applies_to=0)
     # what action was used to call look,
     look.has('room describing action', usually='look')
     look.has('visibility level count')
     look.has('visibility ceiling')
-    look['set action variables rules'].add_rule('determine visibility ceiling rule')
+    look['set action variables rules'].add_rule('determine visibility ceiling rule', determine_ceiling)
     look.carry_out_rules.add_rule('room description heading rule', desc_heading_rule)
     look.carry_out_rules.add_rule('room description body rule', desc_body_rule)
     look.carry_out_rules.add_rule('room description paragraphs about objects rule', desc_obj_rule)
@@ -230,10 +281,30 @@ def create_going():
 
     def determine_conn(world, action):
         target = None
-        if action.current_nouns[0].type == 'direction':
-            target = world[action.room_gone_from.map_connections[action.current_nouns[0].id]]
+        if action.current_nouns[0].is_a('direction'):
+            target = action.room_gone_from.map_connections.get(action.current_nouns[0].id)
+        target = None if target is None else world[target]
+        action.door_gone_through = None
+        if target is not None and target.is_a('door'):
+            #a door leads to its other side, or back to the room it's in from there (as in routes.py)
+            action.door_gone_through = target
+            other = target['other side']
+            if other is action.room_gone_from or not isinstance(other, Kind) or other is Kind.nothing:
+                other = world.holder_of(target)
+            target = None if other is action.room_gone_from else other
         action.room_gone_to = target
 
+    def cant_go_that_way(world, action):
+        if action.room_gone_to is None:
+            world.say('You can\'t go that way.')
+            return False
+
+    def cant_go_through_closed_doors(world, action):
+        door = action.door_gone_through
+        if door is not None and (door.closed or door.locked):
+            world.say('You can\'t, since the {0} is in the way.'.format(door.name))
+            return False
+
     def describe_new_room(world, action):
         #guessed at here https://www.intfiction.org/forum/viewtopic.php?f=7&t=2948&start=10
         if action.current_actor is world.player:
@@ -249,13 +320,40 @@ def create_going():
     going.has('thing gone with')
     going['set action variables rules'].add_rule('standard set going variables rule', set_going)
     going.check_rules.add_rule('determine map connection rule', determine_conn)
+    going.check_rules.add_rule('can\'t go that way rule', cant_go_that_way)
+    going.check_rules.add_rule('can\'t go through closed doors rule', cant_go_through_closed_doors)
     going.carry_out_rules.add_rule('move player and vehicle rule', move_player_vehicle_rule)
 
     going.report_rules.add_rule('describe room gone into rule', describe_new_room)
 
 
 def desc_obj_rule(r, action):
-    pass
+    actor = action.current_actor
+    if r.in_darkness(actor):
+        return
+    listed = []
+    for obj in r.contents_of(actor.location):
+        if obj is actor or not obj.check_for_property('scenery') or obj.scenery or obj.undescribed:
+            continue
+        if obj.initial_appearance != '':
+            r.say(str(obj.initial_appearance))
+        else:
+            listed.append(obj)
+    if len(listed) > 0:
+        r.say('You can see {0} here.'.format(list_objects(listed)))
+
+
+def list_objects(objs):
+    names = []
+    for obj in objs:
+        if obj['proper-named']:
+            names.append(obj.name)
+        else:
+            article = obj.indefinite_article or ('an' if obj.name[:1].lower() in 'aeiou' else 'a')
+            names.append(article + ' ' + obj.name)
+    if len(names) == 1:
+        return names[0]
+    return ', '.join(names[:-1]) + ' and ' + names[-1]
 
 
 def other_people_looking(r, action):
@@ -264,7 +362,7 @@ def other_people_looking(r, action):
 
 def create_standard_rules():
     standard = world.World()
-    pyif._current_world = standard
+    pyif.set_current_world(standard)
 
     room = pyif.kind('room', create_room)
     room('test')
@@ -289,11 +387,12 @@ def create_standard_rules():
     being = pyif.kind('being', create_person, kindof='thing')
     being('test')
     person = pyif.kind('person', kindof='being')
-    yourself = pyif.person('yourself', 'undescribed')
+    yourself = pyif.person('yourself', 'undescribed', name_id=True)
     yourself.description = 'As good-looking as ever'
     yourself.is_now('proper-named')
 
     pyif.kind('region')
+    relations.add_standard_relations(standard)
     pyif.kind('action', create_action)
 
     man = pyif.kind('man', lambda m: m.is_always('male'), kindof='person')
@@ -307,7 +406,8 @@ def create_standard_rules():
     standard['player'] = Kind.nothing
     standard['location'] = Kind.nothing
     standard['turn count'] = 0
-    standard['time of day'] = None
+    #in minutes since midnight
+    standard['time of day'] = 9 * 60
     standard['command prompt'] = '>'
 
     create_base_rulebooks()
@@ -315,4 +415,26 @@ def create_standard_rules():
     return standard
 
 
+_standard = None
+_standard_lock = threading.Lock()
+
+
+def standard_world():
+    """
+    A world with the standard rules in it, ready for a story. The standard rules are only built once per process;
+    after that this hands out forks of that world, which cost next to nothing. A fork only copies an object's properties
+    when they might change, and objects got through properties (e.g. a direction's opposite) are the fork's own
+    (see World.fork), so nothing a story does to its world reaches the standard world or any other story's.
+    """
+    global _standard
+    if _standard is None:
+        with _standard_lock:
+            if _standard is None:
+                _standard = create_standard_rules()
+    w = _standard.fork()
+    w.set_output(output.StdoutSink())
+    pyif.set_current_world(w)
+    return w
+
+
 #create_standard_rules()
\ No newline at end of file
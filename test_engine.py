@@ -0,0 +1,1600 @@
+import asyncio
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+import benchmarks
+import loading
+import output
+import parsing
+import pyif
+import relations
+import scheduling
+import sessions
+import world
+from world import Kind
+
+
+def noop(w):
+    pass
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        world._debug = False
+        self.world = pyif.make_blank_world()
+        self.world.set_output(output.NullSink())
+        pyif.title('Test')
+
+    def tearDown(self):
+        pyif.set_current_world(None)
+
+
+class KindTemplates(EngineTest):
+
+    def test_properties_run_once(self):
+        calls = []
+
+        def create_widget(widget):
+            calls.append(widget)
+            widget.has('colour', 'grey')
+            widget.has('parts', [])
+            widget.can_be(['shiny', 'dull'], usually='dull')
+
+        pyif.kind('widget', create_widget, kindof='thing')
+        a = pyif.make_object('a', 'widget')
+        b = pyif.make_object('b', 'widget', 'shiny', colour='red')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((a.colour, b.colour), ('grey', 'red'))
+        self.assertTrue(a.dull)
+        self.assertTrue(b.shiny)
+        #thing's own properties come along too
+        self.assertEqual(a.description, '')
+        self.assertTrue(a.portable)
+        self.assertEqual(a.understand_as, ['a'])
+
+    def test_mutable_defaults_are_per_instance(self):
+        a = pyif.room('A')
+        b = pyif.room('B')
+        self.assertIsNot(a['map connections'], b['map connections'])
+        a['map connections']['north'] = b.id
+        self.assertEqual(b['map connections'], {})
+        self.assertEqual(pyif.room('C')['map connections'], {})
+
+    def test_subkinds(self):
+        pyif.kind('crate', lambda crate: crate.has('label', ''), kindof='container')
+        crate = pyif.make_object('crate', 'crate', label='FRAGILE')
+        self.assertTrue(crate.is_a('container'))
+        self.assertTrue(crate.open)
+        self.assertEqual(crate.carrying_capacity, 100)
+        self.assertEqual(crate.type, 'crate')
+        #the parent kind doesn't get the subkind's properties
+        with self.assertRaises(world.LogicalError):
+            pyif.make_object('box', 'container').label
+
+    def test_options_added_to_one_instance(self):
+        a = pyif.thing('a')
+        b = pyif.thing('b')
+        a.can_be(['humming', 'silent'], usually='silent')
+        a.now('humming')
+        self.assertTrue(a.humming)
+        self.assertFalse(b.check_for_property('humming'))
+        self.assertFalse(pyif.thing('c').check_for_property('humming'))
+
+
+class Options(EngineTest):
+
+    def test_one_option_of_a_value(self):
+        box = pyif.make_object('box', 'container')
+        self.assertTrue(box.open)
+        box.now('closed')
+        self.assertTrue(box.closed)
+        self.assertFalse(box.open)
+        box['closed'] = False
+        self.assertTrue(box.open)
+        box.open = False
+        self.assertTrue(box.closed)
+
+    def test_more_than_two_options(self):
+        bob = pyif.person('Bob')
+        self.assertTrue(bob.neuter)
+        bob.now('male')
+        self.assertEqual((bob.male, bob.female, bob.neuter), (True, False, False))
+        #the first option that's left takes over
+        bob['male'] = False
+        self.assertEqual((bob.male, bob.female, bob.neuter), (False, True, False))
+
+    def test_always_and_never(self):
+        door = pyif.make_object('door', 'door')
+        self.assertTrue(door['fixed in place'])
+        with self.assertRaises(world.LogicalError):
+            door.now('portable')
+        self.assertFalse(door['pushable between rooms'])
+        with self.assertRaises(world.LogicalError):
+            door['pushable between rooms'] = True
+        lamp = pyif.thing('lamp')
+        lamp.is_never('lit')
+        with self.assertRaises(world.LogicalError):
+            lamp.now('lit')
+        with self.assertRaises(world.LogicalError):
+            lamp.is_always('lit')
+
+    def test_state_is_per_object(self):
+        a = pyif.thing('a')
+        b = pyif.thing('b')
+        a.now('lit')
+        self.assertTrue(a.lit)
+        self.assertFalse(b.lit)
+        #the table of which bit is which is the kind's
+        self.assertIs(a._options, b._options)
+
+    def test_variables(self):
+        w = self.world
+        w['score'] = 3
+        self.assertEqual(w['score'], 3)
+        self.assertEqual(w.score, 3)
+        self.assertIs(w['yourself'], w.get_player())
+        rules = pyif.add_rulebook('test rules')
+        rules['count'] = 1
+        rules['count'] += 1
+        self.assertEqual(rules['count'], 2)
+
+
+class RuleSignatures(EngineTest):
+
+    def test_only_what_the_rule_takes(self):
+        seen = []
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('world rule', lambda w: seen.append(('world', w)))
+        rules.add_rule('action rule', lambda w, action: seen.append(('action', action)))
+        rules.add_rule('keyword rule', lambda w, *, nouns=None: seen.append(('nouns', nouns)))
+        rules.add_rule('everything rule', lambda w, **kwargs: seen.append(('all', sorted(kwargs))))
+        rules.follow(action='act', nouns=['noun'], actor='me')
+        self.assertEqual(seen, [('world', self.world), ('action', 'act'), ('nouns', ['noun']),
+                                ('all', ['action', 'actor', 'nouns'])])
+
+    def test_missing_variables(self):
+        seen = []
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('optional rule', lambda w, action=None: seen.append(action))
+        rules.follow()
+        self.assertEqual(seen, [None])
+
+    def test_errors_in_rules_arent_hidden(self):
+        def broken(w, action):
+            return len(action, 1)
+
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('broken rule', broken)
+        with self.assertRaises(TypeError):
+            rules.follow(action='act')
+
+
+class Pipelines(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.hall = pyif.room('Hall')
+        self.waving = pyif.action('waving', ['wave'], applies_to=0)
+        self.world.go()
+
+    def wave(self):
+        return self.world.try_action(self.world.get_player(), 'waving')
+
+    def test_same_as_following_the_rulebooks(self):
+        w = self.world
+        waving = self.waving
+        waving.check_rules.add_rule('can\'t wave in the dark rule', lambda w, action: False if w['dark'] else None)
+        waving.carry_out_rules.add_rule('wave rule', lambda w: w.say('You wave.'))
+        for dark in (False, True):
+            w['dark'] = dark
+            outcome = self.wave()
+            player = w.get_player()
+            self.assertEqual(w.get_ap_rulebook().follow(actor=player, action=waving, nouns=[]), outcome)
+        self.assertEqual(list(w.message_log).count('You wave.'), 2)
+
+    def test_rules_added_later(self):
+        w = self.world
+        self.wave()
+        pipeline = w.pipelines['waving']
+        self.assertIsNotNone(pipeline.steps)
+        self.waving.carry_out_rules.add_rule('wave rule', lambda w: w.say('You wave.'))
+        self.assertIsNone(pipeline.steps)
+        self.wave()
+        self.assertEqual(w.last_message(), 'You wave.')
+        self.waving.check_rules.add_rule('no waving rule', lambda w: False)
+        self.assertFalse(self.wave())
+
+    def test_placeholders_are_dropped(self):
+        self.wave()
+        steps = self.world.pipelines['waving'].steps
+        names = [rule.name for rule, _ in steps]
+        self.assertIn('basic visibility rule', names)
+        self.assertNotIn('carrying requirements rule', names)
+        self.assertFalse(any(isinstance(rule, world.FollowRule) for rule, _ in steps))
+
+
+class RuleOrder(EngineTest):
+
+    def order(self, rulebook):
+        return [rule.name for rule in rulebook.ordered_rules()]
+
+    def test_before_and_after(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop)
+        rules.add_rule('b rule', noop)
+        rules.add_rule('c rule', noop, before='a rule')
+        rules.add_rule('d rule', noop, after='a rule')
+        rules.add_rule('e rule', noop, before=True)
+        self.assertEqual(self.order(rules), ['e rule', 'c rule', 'a rule', 'd rule', 'b rule'])
+
+    def test_before_one_and_after_another(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop, before='c rule')
+        rules.add_rule('b rule', noop)
+        rules.add_rule('c rule', noop, after='b rule')
+        order = self.order(rules)
+        self.assertLess(order.index('a rule'), order.index('c rule'))
+        self.assertLess(order.index('b rule'), order.index('c rule'))
+
+    def test_listed_before_a_rule_added_later(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop, before='b rule')
+        rules.add_rule('b rule', noop)
+        self.assertEqual(self.order(rules), ['a rule', 'b rule'])
+
+    def test_segments(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule_last('z rule', noop)
+        rules.add_rule('m rule', noop)
+        rules.add_rule_first('a rule', noop)
+        self.assertEqual(self.order(rules), ['a rule', 'm rule', 'z rule'])
+
+    def test_replace(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop)
+        rules.add_rule('b rule', noop)
+        rules.add_rule('c rule', noop)
+        rules.replace_rule('b rule', 'new b rule', noop)
+        self.assertEqual(self.order(rules), ['a rule', 'new b rule', 'c rule'])
+        self.assertEqual(rules.get_rule('b rule').name, 'new b rule')
+
+    def test_replace_before_it_is_added(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.replace_rule('b rule', 'new b rule', noop)
+        rules.add_rule('a rule', noop)
+        rules.add_rule('b rule', noop)
+        self.assertEqual(self.order(rules), ['a rule', 'new b rule'])
+
+    def test_remove(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.remove_rule('b rule')
+        rules.add_rule('a rule', noop)
+        rules.add_rule('b rule', noop)
+        rules.add_rule('c rule', noop, after='b rule')
+        self.assertEqual(self.order(rules), ['a rule', 'c rule'])
+        with self.assertRaises(KeyError):
+            rules.get_rule('b rule')
+
+    def test_changes_after_following(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop)
+        rules.follow()
+        rules.add_rule('b rule', noop, before='a rule')
+        self.assertEqual(self.order(rules), ['b rule', 'a rule'])
+
+    def test_cycle(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop, before='b rule')
+        rules.add_rule('b rule', noop, before='a rule')
+        with self.assertRaises(world.LogicalError):
+            rules.ordered_rules()
+
+    def test_missing_rule(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop, after='no such rule')
+        with self.assertRaises(world.LogicalError):
+            rules.ordered_rules()
+
+    def test_duplicate(self):
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('a rule', noop)
+        with self.assertRaises(world.LogicalError):
+            rules.add_rule('a rule', noop)
+
+    def test_unnamed(self):
+        said = []
+        pyif.room('Hall')
+        pyif.when_play_begins(rule=lambda w: said.append('first'))
+        pyif.when_play_begins(rule=lambda w: said.append('second'))
+        self.world.go()
+        self.assertEqual(said, ['first', 'second'])
+        rules = pyif.add_rulebook('test rules')
+        rules.add_rule('', noop)
+        rules.add_rule('unnamed rule 2', noop)
+        rules.add_rule('', noop)
+        self.assertEqual(len(set(self.order(rules))), 3)
+
+
+class KindIndexes(EngineTest):
+
+    def test_instances_of(self):
+        w = self.world
+        hall = pyif.room('Hall')
+        lamp = pyif.thing('lamp')
+        box = pyif.make_object('box', 'container')
+        self.assertEqual(w.instances_of('room'), {hall.id: hall})
+        things = w.instances_of('thing')
+        self.assertIs(things[lamp.id], lamp)
+        self.assertIs(things[box.id], box)
+        self.assertNotIn(box.id, w.instances_of('supporter'))
+        self.assertEqual(list(w.instances_of('container')), [box.id])
+        self.assertIn('yourself', w.instances_of('person'))
+        self.assertIn('yourself', w.instances_of('being'))
+        self.assertEqual(w.instances_of('unicorn'), {})
+        self.assertEqual(dict(w.things())[lamp.id], lamp)
+
+    def test_new_kinds(self):
+        w = self.world
+        pyif.kind('crate', kindof='container')
+        self.assertEqual(w.instances_of('crate'), {})
+        crate = pyif.make_object('crate', 'crate')
+        self.assertIs(w.instances_of('crate')[crate.id], crate)
+        self.assertIs(w.instances_of('container')[crate.id], crate)
+        self.assertIn('crate', w.kind_descendants('container'))
+        self.assertIn('crate', w.kind_descendants('thing'))
+        self.assertNotIn('crate', w.kind_descendants('supporter'))
+        self.assertEqual(w.kind_ancestors('crate'), ('container', 'thing'))
+
+    def test_forks_index_their_own_objects(self):
+        lamp = pyif.thing('lamp')
+        fork = self.world.fork()
+        self.assertIs(fork.instances_of('thing')[lamp.id], fork[lamp.id])
+        self.assertIsNot(fork[lamp.id], lamp)
+
+
+class Formatted:
+    #counts how many times it's been turned into text
+    count = 0
+
+    def __format__(self, spec):
+        Formatted.count += 1
+        return 'formatted'
+
+
+class DebugMessages(unittest.TestCase):
+
+    def tearDown(self):
+        world.set_debug_level(False)
+        world._levels.clear()
+
+    def shown(self, *args, **kwargs):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            world.debug_msg(*args, **kwargs)
+        return out.getvalue()
+
+    def test_formatted_only_when_shown(self):
+        Formatted.count = 0
+        world.set_debug_level(False)
+        self.assertEqual(self.shown('{0}', Formatted()), '')
+        self.assertEqual(Formatted.count, 0)
+        world.set_debug_level(world.DEFAULT)
+        self.assertEqual(self.shown('it was {0}', Formatted()), 'DEBUG: it was formatted\n')
+        self.assertEqual(Formatted.count, 1)
+
+    def test_levels(self):
+        world.set_debug_level(world.DEFAULT)
+        self.assertEqual(self.shown('more', verbose=world.VERBOSE), '')
+        world.set_debug_level(world.VERBOSE, world.MAP)
+        self.assertEqual(self.shown('more', subsystem=world.MAP, verbose=world.VERBOSE), 'DEBUG: more\n')
+        world.set_debug_level(False, world.RULES)
+        self.assertEqual(self.shown('rule', subsystem=world.RULES), '')
+        self.assertTrue(world.debug_enabled(world.ACTIONS))
+        self.assertFalse(world.debug_enabled(world.RULES))
+
+    def test_old_call_style(self):
+        world.set_debug_level(world.DEFAULT)
+        self.assertEqual(self.shown('moved', 'lamp', 3), 'DEBUG: moved lamp 3\n')
+        self.assertEqual(self.shown('a {0} b', 'x'), 'DEBUG: a x b\n')
+        self.assertEqual(self.shown('{not a field}'), 'DEBUG: {not a field}\n')
+
+
+class Profiling(EngineTest):
+
+    def test_rule_stats(self):
+        w = self.world
+        inner = pyif.add_rulebook('inner rules')
+        inner.add_rule('inner rule', noop)
+        outer = pyif.add_rulebook('outer rules')
+        outer.add_rule(world.FollowRule('follow inner rule', 'inner rules'))
+        outer.add_rule('stop rule', lambda w: True)
+        outer.add_rule('never reached rule', noop)
+        profiler = w.start_profiling()
+        outer.follow()
+        outer.follow()
+        self.assertIs(w.stop_profiling(), profiler)
+        self.assertIsNone(w.profiler)
+        outer.follow()
+        stats = profiler.rules
+        self.assertEqual(stats[('outer rules', 'stop rule')].calls, 2)
+        self.assertEqual(stats[('outer rules', 'stop rule')].outcomes, 2)
+        self.assertEqual(stats[('inner rules', 'inner rule')].outcomes, 0)
+        self.assertNotIn(('outer rules', 'never reached rule'), stats)
+        follow = stats[('outer rules', 'follow inner rule')]
+        self.assertLessEqual(follow.self_time, follow.total_time)
+        self.assertEqual(profiler.rulebooks['inner rules'].depth, 2)
+        self.assertEqual(profiler.rulebooks['outer rules'].follows, 2)
+        self.assertIn('stop rule (outer rules, depth 1)', profiler.table())
+        self.assertEqual(len(profiler.table(limit=1).splitlines()), 2)
+        stacks = dict(line.rsplit(' ', 1) for line in profiler.collapsed_stacks().splitlines())
+        self.assertIn('outer rules;follow inner rule;inner rules;inner rule', stacks)
+
+    def test_actions(self):
+        w = self.world
+        pyif.room('Hall')
+        w.go()
+        profiler = w.start_profiling()
+        w.try_action(w.get_player(), 'looking')
+        w.stop_profiling()
+        self.assertEqual(profiler.rules[('carry out looking rules', 'room description heading rule')].calls, 1)
+        self.assertIn('action processing rules', profiler.rulebooks)
+
+
+class Output(EngineTest):
+
+    def test_one_write_per_action(self):
+        w = self.world
+        writes = []
+        sink = output.BufferSink()
+        sink.write = writes.append
+        w.set_output(sink)
+        pyif.room('Hall')
+        pyif.room('Kitchen', map_connections={'north_of': w['hall1']})
+        w.go()
+        self.assertEqual(len(writes), 1)
+        w.try_command('n')
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(writes[1][0], 'You head north.\n')
+        self.assertEqual(writes[1][1], 'Kitchen (current room)')
+        w.say('{0} and {1}', 'this', 'that')
+        self.assertEqual(writes[2], ['this and that'])
+
+    def test_message_log(self):
+        w = world.World(message_log_size=3)
+        w.set_output(output.NullSink())
+        self.assertEqual(w.last_message(), '')
+        for i in range(5):
+            w.say('message {0}', i)
+        self.assertEqual(list(w.message_log), ['message 2', 'message 3', 'message 4'])
+        self.assertEqual(w.last_message(), 'message 4')
+
+    def test_sinks(self):
+        sink = output.BufferSink()
+        sink.write(['a', 'b'])
+        self.assertEqual(sink.text(), 'a\nb\n')
+        sink.clear()
+        self.assertEqual(sink.messages, [])
+        queued = output.QueueSink()
+        queued.write(('a', 'b'))
+        self.assertEqual(queued.queue.get_nowait(), ['a', 'b'])
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'transcript.txt')
+            sink = output.FileSink(path)
+            sink.write(['a'])
+            sink.write(['b'])
+            sink.close()
+            with open(path) as f:
+                self.assertEqual(f.read(), 'a\nb\n')
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            output.StdoutSink().write(['a', 'b'])
+        self.assertEqual(out.getvalue(), 'a\nb\n')
+
+    def test_changing_sink_sends_whats_waiting(self):
+        w = self.world
+        first = output.BufferSink()
+        w.set_output(first)
+        w._output_depth += 1
+        w.say('waiting')
+        self.assertEqual(first.messages, [])
+        second = output.BufferSink()
+        w.set_output(second)
+        w._output_depth -= 1
+        self.assertEqual(first.messages, ['waiting'])
+        w.say('after')
+        self.assertEqual(second.messages, ['after'])
+
+
+def build_story(name):
+    def build():
+        pyif.make_blank_world()
+        pyif.title(name)
+        hall = pyif.room('Hall')
+        pyif.room('Kitchen', map_connections={'north_of': hall})
+    return build
+
+
+class Sessions(EngineTest):
+
+    def test_sessions_have_their_own_worlds(self):
+        manager = sessions.SessionManager()
+        a = manager.open('a', build_story('A'))
+        b = manager.open('b', build_story('B'))
+        self.assertIs(pyif.current_world(), self.world)
+        self.assertIsNot(a.world, b.world)
+        self.assertEqual(a.start()[1], 'A')
+        self.assertEqual(b.start()[1], 'B')
+        self.assertIn('You head north.\n', manager.input('a', 'n'))
+        self.assertEqual(manager.command('b', 'looking')[0], 'Hall (current room)')
+        self.assertEqual(a.world.get_player().location.name, 'Kitchen')
+        self.assertEqual(b.world.get_player().location.name, 'Hall')
+        self.assertEqual(a.world['turn count'], 1)
+        self.assertIs(a.run(pyif.current_world), a.world)
+        with b:
+            self.assertIs(pyif.current_world(), b.world)
+        self.assertIs(pyif.current_world(), self.world)
+        with self.assertRaises(KeyError):
+            manager.open('a', build_story('A'))
+        self.assertIs(manager.close('a'), a)
+        self.assertEqual(len(manager), 1)
+
+    def test_asyncio(self):
+        manager = sessions.SessionManager()
+        for name in ('a', 'b'):
+            manager.open(name, build_story(name)).start()
+
+        async def play():
+            return await asyncio.gather(manager.handle_input('a', 'n'), manager.handle('b', 'looking'),
+                                        manager.handle_input('a', 's'))
+
+        going, looking, back = asyncio.run(play())
+        self.assertEqual(going[0], 'You head north.\n')
+        self.assertEqual(looking[0], 'Hall (current room)')
+        self.assertEqual(back[0], 'You head south.\n')
+        self.assertEqual(manager['a'].world['turn count'], 2)
+
+    def test_threads(self):
+        seen = {}
+
+        def run(name):
+            build_story(name)()
+            seen[name] = pyif.current_world()
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIsNot(seen['a'], seen['b'])
+        self.assertEqual(seen['a']['title'], 'a')
+        self.assertIs(pyif.current_world(), self.world)
+
+
+class Ids(EngineTest):
+
+    def story(self):
+        return [pyif.room('Hall'), pyif.room('Hall'), pyif.thing('a very long name'), pyif.thing('lamp')]
+
+    def test_the_same_each_time(self):
+        ids = [obj.id for obj in self.story()]
+        self.assertEqual(ids, ['hall1', 'hall2', 'averyl1', 'lamp1'])
+        self.world = pyif.make_blank_world()
+        self.assertEqual([obj.id for obj in self.story()], ids)
+
+    def test_handles(self):
+        w = self.world
+        objs = self.story()
+        for obj in objs:
+            self.assertIs(w.handles[obj._handle], obj)
+        self.assertEqual([obj._handle for obj in objs], list(range(objs[0]._handle, objs[0]._handle + 4)))
+
+    def test_ids_given_by_the_story(self):
+        w = self.world
+        pyif.thing('Lamp', name_id=True)
+        loading.load(w, {'room': [{'name': 'Cellar', 'id': 'hall1'}]})
+        #made ids skip the ones that are taken
+        self.assertEqual(pyif.room('Hall').id, 'hall2')
+
+    def test_taken_ids(self):
+        w = self.world
+        hall = pyif.room('Hall')
+        with self.assertRaises(world.AlreadyExistsError):
+            loading.load(w, {'room': [{'name': 'Cellar', 'id': 'hall1'}]})
+        self.assertIs(w['hall1'], hall)
+        self.assertEqual(list(w.instances_of('room').values()), [hall])
+        with self.assertRaises(world.AlreadyExistsError):
+            pyif.thing('north', name_id=True)
+        self.assertTrue(w['north'].is_a('direction'))
+        with self.assertRaises(world.AlreadyExistsError):
+            w.add(hall)
+
+
+class Visibility(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.hall = pyif.room('Hall')
+        self.kitchen = pyif.room('Kitchen', map_connections={'north_of': self.hall})
+        self.box = pyif.make_object('box', 'container', location=self.hall)
+        self.coin = pyif.thing('coin', location=self.box)
+        self.spoon = pyif.thing('spoon', location=self.kitchen)
+        self.world.go()
+        self.player = self.world.get_player()
+
+    def test_kept_until_something_nearby_changes(self):
+        w = self.world
+        scope = w.scope_of(self.player)
+        self.assertIs(w.scope_of(self.player), scope)
+        #nothing in the kitchen matters here
+        self.spoon.now('lit')
+        self.kitchen.now('dark')
+        self.assertIs(w.scope_of(self.player), scope)
+        self.box.now('closed')
+        self.assertIsNot(w.scope_of(self.player), scope)
+        self.assertFalse(w.can_see(self.player, self.coin))
+        self.box.now('transparent')
+        self.assertTrue(w.can_see(self.player, self.coin))
+        self.assertFalse(w.can_touch(self.player, self.coin))
+        self.assertIs(w.get_visibility().barrier(self.player, self.coin), self.box)
+        self.box.now('open')
+        self.assertTrue(w.can_touch(self.player, self.coin))
+
+    def test_arriving_and_leaving(self):
+        w = self.world
+        self.assertFalse(w.can_see(self.player, self.spoon))
+        w.try_command('n')
+        self.assertTrue(w.can_see(self.player, self.spoon))
+        self.assertFalse(w.can_see(self.player, self.coin))
+        w.move(self.coin, self.kitchen)
+        self.assertTrue(w.can_see(self.player, self.coin))
+        w.move(self.spoon, 'nowhere')
+        self.assertFalse(w.can_see(self.player, self.spoon))
+
+    def test_darkness(self):
+        w = self.world
+        self.hall.now('dark')
+        self.assertTrue(w.in_darkness(self.player))
+        self.assertFalse(w.can_see(self.player, self.box))
+        w.move(self.coin, self.player)
+        self.assertTrue(w.can_see(self.player, self.coin))
+        lamp = pyif.thing('lamp', 'lit', location=self.box)
+        self.assertFalse(w.in_darkness(self.player))
+        self.assertTrue(w.can_see(self.player, lamp))
+        lamp.now('unlit')
+        self.assertTrue(w.in_darkness(self.player))
+
+    def test_ceiling(self):
+        w = self.world
+        self.box.now('enterable')
+        w.move(self.player, self.box)
+        self.assertIs(w.visibility_ceiling(self.player), self.hall)
+        self.box.now('closed')
+        self.assertIs(w.visibility_ceiling(self.player), self.box)
+        #it's dark in a closed box, unless there's a light in there too
+        self.assertTrue(w.in_darkness(self.player))
+        pyif.thing('torch', 'lit', location=self.box)
+        self.assertTrue(w.can_see(self.player, self.coin))
+        self.assertFalse(w.can_see(self.player, self.hall))
+
+
+class Text(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.hall = pyif.room('Hall')
+        self.lamp = pyif.thing('lamp', location=self.hall, description='A brass lamp.')
+
+    def text(self, string, *args, **kwargs):
+        return world.LazyString(string, *args, story=self.world, **kwargs)
+
+    def test_substitutions(self):
+        w = self.world
+        self.lamp['proper-named'] = False
+        text = self.text('[The lamp] in [the Hall]: [description of lamp] [bracket]turn [turn count][close bracket] '
+                         '[if lamp is lit]It glows.[otherwise]It\'s dark.[end if]')
+        self.assertEqual(str(text), 'The lamp in the Hall: A brass lamp. [turn 0] It\'s dark.')
+        self.lamp.now('lit')
+        w['turn count'] = 2
+        self.assertEqual(str(text), 'The lamp in the Hall: A brass lamp. [turn 2] It glows.')
+        self.lamp.description = 'A dented lamp.'
+        self.assertEqual(str(text), 'The lamp in the Hall: A dented lamp. [turn 2] It glows.')
+        self.hall.name = 'Great Hall'
+        self.assertEqual('> ' + text, '> The lamp in the Great Hall: A dented lamp. [turn 2] It glows.')
+        with self.assertRaises(world.LogicalError):
+            str(self.text('[if lamp is lit]no end'))
+
+    def test_kept_until_something_it_read_changes(self):
+        text = self.text('[description of lamp]')
+        self.assertEqual(str(text), 'A brass lamp.')
+        self.assertIsNotNone(text._text)
+        pyif.thing('cup', location=self.hall)
+        self.assertEqual(str(text), 'A brass lamp.')
+        self.lamp.description = 'A dented lamp.'
+        self.assertEqual(str(text), 'A dented lamp.')
+
+    def test_format_options_arent_kept(self):
+        w = self.world
+        pyif.thing('cup', location=self.hall)
+        things = self.text('{count} things in [Hall]',
+                           {'count': lambda story: len(story.contents_of(story['hall1']))})
+        self.assertEqual(str(things), '2 things in Hall')
+        pyif.thing('plate', location=self.hall)
+        self.assertEqual(str(things), '3 things in Hall')
+        counted = self.text('[count]', {'count': lambda story: len(story.contents_of(story['hall1']))})
+        self.assertEqual(str(counted), '3')
+        w.move(self.lamp, 'nowhere')
+        self.assertEqual(str(counted), '2')
+
+    def test_pure_format_options(self):
+        calls = []
+
+        def lit(story):
+            calls.append(story)
+            return 'lit' if story['lamp1'].lit else 'unlit'
+
+        text = self.text('The lamp is {state}.', {'state': lit}, pure=True)
+        self.assertEqual(str(text), 'The lamp is unlit.')
+        self.assertEqual(str(text), 'The lamp is unlit.')
+        self.assertEqual(len(calls), 1)
+        self.lamp.now('lit')
+        self.assertEqual(str(text), 'The lamp is lit.')
+        self.assertEqual(len(calls), 2)
+
+    def test_text_inside_text(self):
+        rng = random.Random(18)
+        self.lamp.description = self.text('It says {number}.', {'number': lambda story: rng.randrange(1000000)},
+                                          pure=True, volatile=True)
+        outer = self.text('[description of lamp]')
+        self.assertNotEqual(str(outer), str(outer))
+        self.lamp.description = self.text('It\'s [if lamp is lit]on[otherwise]off[end if].')
+        self.assertEqual(str(outer), 'It\'s off.')
+        self.lamp.now('lit')
+        self.assertEqual(str(outer), 'It\'s on.')
+
+
+class KindHierarchy(EngineTest):
+
+    def test_is_a(self):
+        pyif.kind('crate', kindof='container')
+        crate = pyif.make_object('crate', 'crate')
+        hall = pyif.room('Hall')
+        self.assertEqual(type(crate).kind_names(), ('crate', 'container', 'thing'))
+        self.assertEqual(type(crate).kind_set(), {'crate', 'container', 'thing'})
+        for kind in ('crate', 'container', 'thing', self.world.kinds['container']):
+            self.assertTrue(crate.is_a(kind))
+        self.assertFalse(crate.is_a('room'))
+        self.assertFalse(crate.is_a('supporter'))
+        self.assertFalse(hall.is_a('crate'))
+        self.assertTrue(hall.is_a(type(hall)))
+
+    def test_tree(self):
+        w = self.world
+        self.assertEqual(w.kind_parents['container'], 'thing')
+        self.assertIsNone(w.kind_parents['thing'])
+        self.assertEqual(w.kind_ancestors('container'), ('thing',))
+        self.assertIn('container', w.kind_descendants('thing'))
+        self.assertNotIn('thing', w.kind_descendants('thing'))
+        self.assertEqual(w.kind_descendants('no such kind'), frozenset())
+        #adding a kind shows up in the tree straight away
+        crate = pyif.kind('crate', kindof='container')
+        self.assertEqual(w.kind_parents['crate'], 'container')
+        self.assertEqual(w.kind_ancestors(crate), ('container', 'thing'))
+        self.assertIn('crate', w.kind_descendants('thing'))
+        self.assertIn('crate', w.kind_descendants(w.kinds['container']))
+
+    def test_forks_keep_their_own_kinds(self):
+        fork = self.world.fork()
+        pyif.set_current_world(fork)
+        pyif.kind('crate', kindof='container')
+        self.assertIn('crate', fork.kind_descendants('thing'))
+        self.assertNotIn('crate', self.world.kinds)
+        self.assertNotIn('crate', self.world.kind_parents)
+        self.assertNotIn('crate', self.world.kind_descendants('thing'))
+
+
+class Scheduling(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.happened = []
+        pyif.room('Hall')
+        self.world.go()
+
+    def event(self, name):
+        def event(w):
+            self.happened.append((name, w['turn count']))
+        return event
+
+    def turns(self, n):
+        for _ in range(n):
+            self.world.end_turn()
+
+    def test_times(self):
+        self.assertEqual(scheduling.parse_time('5:00 PM'), 17 * 60)
+        self.assertEqual(scheduling.parse_time('9 am'), 9 * 60)
+        self.assertEqual(scheduling.parse_time('12:30 a.m.'), 30)
+        self.assertEqual(scheduling.parse_time(25 * 60), 60)
+        for bad in ('13:00 PM', '9:60 AM', 'noon'):
+            with self.assertRaises(world.LogicalError):
+                scheduling.parse_time(bad)
+        self.assertEqual(scheduling.format_time(0), '12:00 AM')
+        self.assertEqual(scheduling.format_time(17 * 60 + 5), '5:05 PM')
+
+    def test_turn_cycle(self):
+        w = self.world
+        pyif.every_turn('counting rule', self.event('every turn'))
+        self.assertEqual((w['turn count'], w['time of day']), (0, 9 * 60))
+        self.turns(2)
+        self.assertEqual(self.happened, [('every turn', 0), ('every turn', 1)])
+        self.assertEqual((w['turn count'], w['time of day']), (2, 9 * 60 + 2))
+
+    def test_in_turns(self):
+        pyif.in_turns(2, self.event('later'))
+        pyif.in_turns(1, self.event('soon'))
+        cancelled = pyif.in_turns(1, self.event('cancelled'))
+        self.world.cancel_event(cancelled)
+        self.assertEqual(len(self.world.scheduler), 2)
+        self.turns(4)
+        self.assertEqual(self.happened, [('soon', 1), ('later', 2)])
+        self.assertEqual(len(self.world.scheduler), 0)
+
+    def test_at_time(self):
+        w = self.world
+        pyif.at_time('9:02 AM', self.event('9:02'))
+        #a time that's already gone today is tomorrow
+        pyif.at_time('8:00 AM', self.event('8:00'))
+        self.turns(3)
+        self.assertEqual(self.happened, [('9:02', 2)])
+        w['time of day'] = scheduling.parse_time('11:59 PM')
+        self.turns(1)
+        self.assertEqual(w['time of day'], 0)
+        self.assertEqual(w.scheduler.day, 1)
+        w['time of day'] = scheduling.parse_time('8:00 AM')
+        self.turns(1)
+        self.assertEqual(self.happened, [('9:02', 2), ('8:00', 4)])
+
+    def test_forks_have_their_own_events(self):
+        pyif.in_turns(1, self.event('shared'))
+        fork = self.world.fork()
+        fork.schedule_in(1, self.event('fork only'))
+        self.turns(2)
+        self.assertEqual(self.happened, [('shared', 1)])
+        fork.end_turn()
+        fork.end_turn()
+        self.assertEqual(self.happened, [('shared', 1), ('shared', 1), ('fork only', 1)])
+
+    def test_commands_take_turns(self):
+        w = self.world
+        w.play_command('look')
+        self.assertEqual(w['turn count'], 1)
+        w.play_command('xyzzy')
+        self.assertEqual(w['turn count'], 1)
+
+
+class Benchmarks(EngineTest):
+
+    def test_run_all(self):
+        results = benchmarks.run_all(scale=0.001, repeat=1)
+        self.assertIn('make_blank_world', results['results'])
+        for name, result in results['results'].items():
+            self.assertGreater(result['n'], 0, name)
+            self.assertIn('bytes_per_object' if name.startswith('memory_') else 'seconds', result)
+        only = benchmarks.run_all(scale=0.001, repeat=1, only=['looking'])
+        self.assertEqual(list(only['results']), ['looking'])
+        self.assertTrue(benchmarks.report(only)[0].startswith('looking'))
+
+    def test_compare(self):
+        baseline = {'results': {'going': {'seconds': 1.0, 'n': 100}, 'memory_thing': {'bytes_per_object': 1000},
+                                'gone': {'seconds': 1.0, 'n': 10}}}
+        #twice the operations in 1.5 times the time is faster per operation
+        results = {'results': {'going': {'seconds': 1.5, 'n': 200}, 'memory_thing': {'bytes_per_object': 1100},
+                               'new': {'seconds': 1.0, 'n': 10}}}
+        lines, regressed = benchmarks.compare(results, baseline, 0.2)
+        self.assertFalse(regressed)
+        self.assertEqual(len(lines), 2)
+        results['results']['memory_thing']['bytes_per_object'] = 1300
+        lines, regressed = benchmarks.compare(results, baseline, 0.2)
+        self.assertTrue(regressed)
+        self.assertTrue(lines[1].endswith('REGRESSION'))
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'results.json')
+            args = ['--scale', '0.001', '--repeat', '1', '--only', 'looking']
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(benchmarks.main(args + ['--no-baseline', '-o', path]), 0)
+                self.assertEqual(benchmarks.main(args + ['-b', path, '--threshold', '1000']), 0)
+                with open(path) as f:
+                    saved = json.load(f)
+                saved['results']['looking']['seconds'] /= 10000
+                with open(path, 'w') as f:
+                    json.dump(saved, f)
+                self.assertEqual(benchmarks.main(args + ['-b', path]), 1)
+
+
+class StandardWorlds(EngineTest):
+
+    def test_changes_stay_in_their_world(self):
+        w = self.world
+        self.assertIs(pyif.current_world(), w)
+        south = w.directions['north'].opposite
+        self.assertIs(south, w.directions['south'])
+        south.name = 'southward'
+        south['understand as'] = 'sw'
+        pyif.every_turn('leaky rule', noop)
+        pyif.kind('crate', kindof='container')
+        hall = pyif.room('Hall')
+        w.go()
+        w.get_player().understand_as.append('me')
+        w['turn count'] = 5
+
+        fresh = pyif.make_blank_world()
+        self.assertIsNot(fresh, w)
+        self.assertIs(pyif.current_world(), fresh)
+        south = fresh.directions['north'].opposite
+        self.assertEqual((south.name, south.understand_as), ('south', 's'))
+        self.assertNotIn('leaky rule', fresh.rulebooks['every turn rules']._placements)
+        self.assertNotIn('crate', fresh.kinds)
+        self.assertNotIn(hall.id, fresh.objects)
+        self.assertEqual(fresh['turn count'], 0)
+        fresh.set_output(output.NullSink())
+        pyif.title('Test')
+        pyif.room('Hall')
+        fresh.go()
+        self.assertNotIn('me', fresh.get_player().understand_as)
+
+    def test_fresh(self):
+        fresh = pyif.make_blank_world(fresh=True)
+        self.assertIs(pyif.current_world(), fresh)
+        self.assertEqual(sorted(fresh.directions), sorted(self.world.directions))
+        self.assertIsNot(fresh.directions['north'], self.world.directions['north'])
+        self.assertIs(fresh.directions['north'].opposite, fresh.directions['south'])
+
+
+class Forks(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.hall = pyif.room('Hall')
+        self.kitchen = pyif.room('Kitchen')
+        self.door = pyif.make_object('oak door', 'door', 'open', location=self.hall, other_side=self.kitchen)
+        pyif.add_map_connection(self.hall.id, self.door.id, 'north')
+        pyif.add_map_connection(self.kitchen.id, self.door.id, 'south')
+        self.lamp = pyif.thing('lamp', location=self.hall, description='A lamp.')
+        self.world.go()
+
+    def test_changes_stay_on_their_own_side(self):
+        w = self.world
+        fork = w.fork()
+        lamp = fork[self.lamp.id]
+        self.assertIsNot(lamp, self.lamp)
+        lamp.description = 'A dented lamp.'
+        lamp.now('lit')
+        fork.move(lamp, fork.get_player())
+        fork['turn count'] = 5
+        self.assertEqual(self.lamp.description, 'A lamp.')
+        self.assertFalse(self.lamp.lit)
+        self.assertIs(self.lamp.location, self.hall)
+        self.assertEqual(w['turn count'], 0)
+        self.assertIs(lamp.location, fork.get_player())
+        self.assertEqual(list(fork.contents_of(fork.get_player())), [lamp])
+        self.lamp.description = 'A shiny lamp.'
+        self.assertEqual(lamp.description, 'A dented lamp.')
+
+    def test_values_changed_in_place(self):
+        w = self.world
+        fork = w.fork()
+        lamp = fork[self.lamp.id]
+        lamp['understand as'].append('light')
+        fork[self.hall.id]['map connections']['west'] = self.kitchen.id
+        self.assertEqual(self.lamp['understand as'], ['lamp'])
+        self.assertEqual(self.hall['map connections'], {'north': self.door.id})
+        self.lamp['understand as'].append('lantern')
+        self.assertEqual(lamp['understand as'], ['lamp', 'light'])
+        w['notes'] = ['first']
+        other = w.fork()
+        other['notes'].append('second')
+        self.assertEqual(w['notes'], ['first'])
+
+    def test_only_what_changes_is_copied(self):
+        w = self.world
+        fork = w.fork()
+        #apart from the actions, which are given the fork's rulebooks
+        copied = [obj_id for obj_id, obj in w.objects.items() if obj._properties is not fork[obj_id]._properties]
+        self.assertEqual(sorted(copied), sorted(w.actions))
+        lamp = fork[self.lamp.id]
+        lamp.description
+        lamp.name
+        self.assertIs(lamp._properties, self.lamp._properties)
+        lamp['understand as']
+        self.assertIsNot(lamp._properties, self.lamp._properties)
+        self.assertIs(fork[self.hall.id]._properties, self.hall._properties)
+
+    def test_objects_in_properties(self):
+        w = self.world
+        fork = w.fork()
+        door = fork[self.door.id]
+        kitchen = fork[self.kitchen.id]
+        self.assertIs(door.other_side, kitchen)
+        self.assertIs(fork.directions['north'].opposite, fork.directions['south'])
+        fork.try_command('n')
+        self.assertIs(fork.get_player().location, kitchen)
+        self.assertTrue(kitchen.visited)
+        self.assertIs(w.get_player().location, self.hall)
+        self.assertFalse(self.kitchen.visited)
+        self.assertIs(self.door.other_side, self.kitchen)
+        #and again from a fork of the fork
+        again = fork.fork()
+        self.assertIs(again[self.door.id].other_side, again[self.kitchen.id])
+        again.try_command('s')
+        self.assertIs(again.get_player().location, again[self.hall.id])
+        self.assertIs(fork.get_player().location, kitchen)
+
+    def test_rulebooks(self):
+        w = self.world
+        fork = w.fork()
+        said = []
+        fork.rulebooks['every turn rules'].add_rule('fork rule', lambda w: said.append('fork'))
+        fork.end_turn()
+        w.end_turn()
+        self.assertEqual(said, ['fork'])
+        self.assertEqual((fork['turn count'], w['turn count']), (1, 1))
+        self.assertIs(fork.actions['going'].check_rules, fork.rulebooks['check going rules'])
+        self.assertIsNot(fork.actions['going'].check_rules, w.rulebooks['check going rules'])
+
+    def test_output(self):
+        fork = self.world.fork()
+        fork.try_command('look')
+        self.assertEqual(fork.output.messages[0], 'Hall (current room)')
+
+
+class SaveRestore(EngineTest):
+
+    def story(self):
+        #the same story each time, so a save from one run can be restored into another
+        hall = pyif.room('Hall')
+        kitchen = pyif.room('Kitchen', map_connections={'north_of': hall})
+        pyif.thing('lamp', 'lit', location=hall, description='A brass lamp.')
+        pyif.thing('hat', 'wearable', location=hall)
+        pyif.make_object('box', 'container', location=kitchen)
+        pyif.make_object('Bob', 'person', location=kitchen)
+        pyif.relation('knowing', relations.MANY_TO_MANY, 'person', 'thing')
+        self.world.go()
+        return self.world
+
+    def fresh(self):
+        self.world = pyif.make_blank_world()
+        self.world.set_output(output.NullSink())
+        pyif.title('Test')
+        return self.story()
+
+    def test_round_trip(self):
+        w = self.story()
+        player = w.get_player()
+        lamp = w['lamp1']
+        hat = w['hat1']
+        w.try_command('n')
+        w.move(lamp, w['box1'])
+        lamp['description'] = 'A dented lamp.'
+        lamp.now('unlit')
+        pyif.now_player_wears(hat)
+        w.relation('knowing').now(w['bob1'], lamp)
+        w.relation('knowing').now(player, hat)
+        w['turn count'] = 7
+        saved = io.BytesIO()
+        w.save(saved)
+
+        restored = self.fresh()
+        restored.relation('knowing').now(restored['bob1'], restored['hat1'])
+        restored.restore(saved.getvalue())
+        player = restored.get_player()
+        lamp = restored['lamp1']
+        hat = restored['hat1']
+        self.assertIs(player.location, restored['kitchen1'])
+        self.assertIs(lamp.location, restored['box1'])
+        self.assertEqual([obj.name for obj in restored.contents_of(restored['box1'])], ['lamp'])
+        self.assertEqual(lamp['description'], 'A dented lamp.')
+        self.assertTrue(lamp.unlit)
+        self.assertFalse(lamp.lit)
+        self.assertTrue(hat.worn)
+        self.assertEqual(restored.relation('wearing').related(player), [hat])
+        self.assertEqual(restored['turn count'], 7)
+        knowing = restored.relation('knowing')
+        self.assertEqual(knowing.relating(lamp), [restored['bob1']])
+        self.assertEqual(knowing.related(player), [hat])
+        #the pair made before restoring isn't in the save
+        self.assertEqual(knowing.relating(hat), [player])
+        self.assertEqual(len(knowing), 2)
+        self.assertEqual(restored['kitchen1']['map connections'], {'south': 'hall1'})
+
+    def test_restore_from_other_story(self):
+        w = self.story()
+        pyif.thing('extra')
+        saved = io.BytesIO()
+        w.save(saved)
+        restored = self.fresh()
+        with self.assertRaises(world.LogicalError):
+            restored.restore(saved.getvalue())
+
+    def test_not_a_save(self):
+        with self.assertRaises(world.LogicalError):
+            self.story().restore(b'nonsense')
+
+
+class Routes(EngineTest):
+
+    def bfs(self, fro, to):
+        #plain breadth first search over the map connections, to check the route finder against
+        w = self.world
+        dist = {fro.id: 0}
+        queue = collections.deque([fro.id])
+        while queue:
+            room = queue.popleft()
+            if room == to.id:
+                return dist[room]
+            for connection in w[room]['map connections'].values():
+                if connection not in dist and w[connection].is_a('room'):
+                    dist[connection] = dist[room] + 1
+                    queue.append(connection)
+        return None
+
+    def check_all(self, rooms):
+        w = self.world
+        for fro in rooms:
+            for to in rooms:
+                self.assertEqual(w.route_distance(fro, to), self.bfs(fro, to), (fro.name, to.name))
+
+    def test_against_search_as_the_map_changes(self):
+        w = self.world
+        rng = random.Random(15)
+        rooms = [pyif.room('room {0}'.format(i)) for i in range(12)]
+        directions = list(w.directions)
+        for _ in range(20):
+            pyif.add_map_connection(rng.choice(rooms).id, rng.choice(rooms).id, rng.choice(directions))
+        self.check_all(rooms)
+        for _ in range(30):
+            room = rng.choice(rooms)
+            conns = dict(room['map connections'])
+            if conns and rng.random() < 0.4:
+                del conns[rng.choice(list(conns))]
+            else:
+                conns[rng.choice(directions)] = rng.choice(rooms).id
+            room['map connections'] = conns
+            self.check_all(rooms)
+
+    def test_route(self):
+        w = self.world
+        a = pyif.room('A')
+        b = pyif.room('B', map_connections={'east_of': a})
+        c = pyif.room('C', map_connections={'south_of': b})
+        self.assertEqual(w.best_route(a, c), [w.directions['east'], w.directions['south']])
+        self.assertIs(w.next_step(c, a), w.directions['north'])
+        self.assertEqual(w.route_distance(a, a), 0)
+        self.assertEqual(w.best_route(a, a), [])
+        d = pyif.room('D')
+        self.assertIsNone(w.best_route(a, d))
+        self.assertIsNone(w.next_step(a, d))
+
+    def test_region(self):
+        w = self.world
+        wing = pyif.make_object('Wing', 'region')
+        a = pyif.room('A', map_region=wing)
+        b = pyif.room('B', map_region=wing, map_connections={'east_of': a})
+        c = pyif.room('C', map_region=wing, map_connections={'east_of': b})
+        e = pyif.room('E', map_region=wing, map_connections={'east_of': c})
+        #a shortcut outside the region
+        pyif.room('D', map_connections={'north_of': a, 'west_of': e})
+        self.assertEqual(w.route_distance(a, e), 2)
+        self.assertEqual(w.route_distance(a, e, region=wing), 3)
+        self.assertIsNone(w.route_distance(a, w['d1'], region=wing))
+        b['map region'] = Kind.nothing
+        self.assertIsNone(w.route_distance(a, e, region=wing))
+
+    def doors(self):
+        w = self.world
+        hall = pyif.room('Hall')
+        kitchen = pyif.room('Kitchen')
+        door = pyif.make_object('oak door', 'door', location=hall, other_side=kitchen)
+        pyif.add_map_connection(hall.id, door.id, 'north')
+        pyif.add_map_connection(kitchen.id, door.id, 'south')
+        return w, hall, kitchen, door
+
+    def test_doors(self):
+        w, hall, kitchen, door = self.doors()
+        self.assertIsNone(w.route_distance(hall, kitchen))
+        self.assertEqual(w.route_distance(hall, kitchen, using_doors=True), 1)
+        self.assertEqual(w.route_distance(kitchen, hall, using_doors=True), 1)
+        door.now('locked')
+        self.assertIsNone(w.route_distance(hall, kitchen, using_doors=True))
+        self.assertEqual(w.route_distance(hall, kitchen, using_doors=True, even_locked=True), 1)
+        door.now('unlocked')
+        self.assertEqual(w.route_distance(hall, kitchen, using_doors=True), 1)
+
+    def test_going_through_doors(self):
+        w, hall, kitchen, door = self.doors()
+        w.go()
+        player = w.get_player()
+        w.try_command('n')
+        self.assertIs(player.location, hall)
+        self.assertEqual(w.last_message(), 'You can\'t, since the oak door is in the way.')
+        door.now('open')
+        w.try_command('n')
+        self.assertIs(player.location, kitchen)
+        w.try_command('s')
+        self.assertIs(player.location, hall)
+        w.try_command('w')
+        self.assertIs(player.location, hall)
+        self.assertEqual(w.last_message(), 'You can\'t go that way.')
+
+
+class Parser(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.examining = pyif.action('examining', ['examine', 'x', 'look at'])
+        self.putting = pyif.action('putting it in', ['put'], applies_to=2)
+        self.hall = pyif.room('Hall')
+        self.kitchen = pyif.room('Kitchen', map_connections={'north_of': self.hall})
+        self.red = pyif.thing('red box', location=self.hall)
+        self.blue = pyif.thing('blue box', location=self.hall)
+        self.bag = pyif.make_object('bag', 'container', 'openable', 'open', location=self.hall)
+        self.coin = pyif.thing('gold coin', location=self.bag)
+        self.spoon = pyif.thing('spoon', location=self.kitchen)
+        self.world.go()
+
+    def parse(self, text):
+        action, nouns = self.world.parse(text)
+        return action.id, [obj.name for obj in nouns]
+
+    def error(self, text):
+        with self.assertRaises(parsing.ParseError) as raised:
+            self.world.parse(text)
+        return str(raised.exception)
+
+    def test_nouns(self):
+        self.assertEqual(self.parse('examine the red box'), ('examining', ['red box']))
+        self.assertEqual(self.parse('x red'), ('examining', ['red box']))
+        self.assertEqual(self.parse('look at the coin'), ('examining', ['gold coin']))
+        self.assertEqual(self.parse('put coin in red box'), ('putting it in', ['gold coin', 'red box']))
+        self.assertEqual(self.parse('LOOK.'), ('looking', []))
+
+    def test_directions(self):
+        self.assertEqual(self.parse('n'), ('going', ['north']))
+        self.assertEqual(self.parse('go north'), ('going', ['north']))
+
+    def test_ambiguity(self):
+        self.assertEqual(self.error('x box'), 'Which do you mean, the red box or the blue box?')
+        #"box" on its own is ambiguous, but "red box" isn't
+        self.assertEqual(self.parse('put red box in bag'), ('putting it in', ['red box', 'bag']))
+        self.assertEqual(self.error('put box in bag'), 'Which do you mean, the red box or the blue box?')
+        self.world.move(self.blue, self.kitchen)
+        self.assertEqual(self.parse('x box'), ('examining', ['red box']))
+
+    def test_scope(self):
+        self.assertEqual(self.error('x spoon'), 'You can\'t see any such thing.')
+        self.bag.now('closed')
+        self.assertEqual(self.error('x coin'), 'You can\'t see any such thing.')
+        self.bag.now('open')
+        self.assertEqual(self.parse('x coin'), ('examining', ['gold coin']))
+        self.world.try_command('n')
+        self.assertEqual(self.parse('x spoon'), ('examining', ['spoon']))
+        self.assertEqual(self.error('x coin'), 'You can\'t see any such thing.')
+
+    def test_darkness(self):
+        self.hall.now('dark')
+        self.assertEqual(self.error('x red box'), 'You can\'t see any such thing.')
+        pyif.thing('torch', 'lit', location=self.hall)
+        self.assertEqual(self.parse('x red box'), ('examining', ['red box']))
+
+    def test_errors(self):
+        self.assertEqual(self.error(''), 'I beg your pardon?')
+        self.assertEqual(self.error('dance'), 'That\'s not a verb I recognise.')
+        self.assertEqual(self.error('examine'), 'You must supply a noun.')
+        self.assertEqual(self.error('look wibble'), 'I only understood you as far as wanting to look.')
+        self.assertEqual(self.error('x wibble'), 'You can\'t see any such thing.')
+
+    def test_vocabulary_changes(self):
+        self.red['name'] = 'crimson box'
+        self.assertEqual(self.parse('x crimson'), ('examining', ['crimson box']))
+        self.assertEqual(self.error('x red'), 'You can\'t see any such thing.')
+        self.blue['understand as'] = ['cube']
+        self.assertEqual(self.parse('x cube'), ('examining', ['blue box']))
+        pyif.thing('green box', location=self.hall)
+        self.assertEqual(self.parse('x green'), ('examining', ['green box']))
+
+
+def create_gadget(gadget):
+    gadget.can_be('charged')
+    gadget.can_be('working')
+    gadget.can_be('warm')
+    gadget.can_be('broken')
+    gadget.implication(if_property='charged', then={'usually': 'working'})
+    gadget.implication(if_property='working', then={'always': 'warm'})
+    gadget.implication(if_property='broken', then={'never': 'working'})
+
+
+class Implications(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        pyif.kind('gadget', create_gadget, kindof='thing')
+
+    def gadget(self, name='gadget', *args):
+        return pyif.make_object(name, 'gadget', *args)
+
+    def test_chain(self):
+        gadget = self.gadget()
+        self.assertFalse(gadget.warm)
+        gadget.now('charged')
+        self.assertTrue(gadget.working)
+        self.assertTrue(gadget.warm)
+        with self.assertRaises(world.LogicalError):
+            gadget['warm'] = False
+
+    def test_usually_gives_way(self):
+        gadget = self.gadget()
+        gadget.now('broken')
+        gadget.now('charged')
+        self.assertTrue(gadget.charged)
+        self.assertFalse(gadget.working)
+        self.assertFalse(gadget.warm)
+
+    def test_conflicts(self):
+        gadget = self.gadget()
+        gadget.is_always('working')
+        with self.assertRaises(world.LogicalError):
+            gadget.now('broken')
+        other = self.gadget('other')
+        other.now('broken')
+        with self.assertRaises(world.LogicalError):
+            other.now('working')
+        with self.assertRaises(world.LogicalError):
+            other.is_always('working')
+
+    def test_batch(self):
+        w = self.world
+        gadgets = [self.gadget('gadget {0}'.format(i)) for i in range(3)]
+        warmed = []
+        w.watch('warm', lambda obj, prop: warmed.append(obj.name))
+        with w.batch():
+            for gadget in gadgets:
+                gadget.now('charged')
+                gadget.is_now('charged')
+            #implications are followed when the batch ends
+            self.assertFalse(gadgets[0].working)
+            self.assertEqual(warmed, [])
+        self.assertTrue(all(gadget.working and gadget.warm for gadget in gadgets))
+        self.assertEqual(warmed, [gadget.name for gadget in gadgets])
+
+    def test_nested_batch(self):
+        w = self.world
+        gadget = self.gadget()
+        with w.batch():
+            with w.batch():
+                gadget.now('charged')
+            self.assertFalse(gadget.working)
+        self.assertTrue(gadget.working)
+
+
+class Loading(EngineTest):
+
+    def named(self, name):
+        return [obj for obj in self.world.objects.values() if obj.name == name][0]
+
+    def test_deferred_references(self):
+        w = self.world
+        loader = loading.Loader(w)
+        #everything refers to things that come later
+        loader.rows('thing', [{'name': 'coin', 'location': 'Purse'}])
+        loader.rows('container', [{'name': 'Purse', 'location': 'cellar', 'open': True}])
+        loader.rows('room', [{'name': 'Hall', 'south_of': 'Kitchen'},
+                             {'name': 'Kitchen', 'id': 'kitchen'},
+                             {'name': 'Cellar', 'id': 'cellar', 'down': 'kitchen'}])
+        loaded = loader.finish()
+        self.assertEqual([obj.name for obj in loaded], ['coin', 'Purse', 'Hall', 'Kitchen', 'Cellar'])
+        coin, purse, hall, kitchen, cellar = loaded
+        self.assertIs(coin.location, purse)
+        self.assertIs(purse.location, cellar)
+        self.assertEqual(list(w.contents_of(purse)), [coin])
+        self.assertEqual(list(w.contents_of(cellar)), [purse])
+        self.assertEqual(kitchen['map connections'], {'south': hall.id})
+        self.assertEqual(hall['map connections'], {'north': 'kitchen'})
+        self.assertEqual(cellar['map connections'], {'down': 'kitchen'})
+        self.assertEqual(w.route_distance(cellar, hall), 2)
+
+    def test_reverse_connections_are_soft(self):
+        loader = loading.Loader(self.world)
+        loader.rows('room', [{'name': 'A', 'id': 'a', 'east': 'c'},
+                             {'name': 'B', 'id': 'b', 'west_of': 'c'},
+                             {'name': 'C', 'id': 'c'}])
+        loader.finish()
+        w = self.world
+        #going west from C was given for B, so the way back from A doesn't replace it
+        self.assertEqual(w['a']['map connections'], {'east': 'c'})
+        self.assertEqual(w['c']['map connections'], {'west': 'b'})
+        self.assertEqual(w['b']['map connections'], {'east': 'c'})
+
+    def test_csv_and_json_lines(self):
+        w = self.world
+        loader = loading.Loader(w)
+        loader.rows('room', [{'name': 'Hall', 'id': 'hall'}])
+        loader.csv('thing', io.StringIO('name,location,lit,portable,description\n'
+                                        'lamp,hall,yes,,A lamp.\n'
+                                        'statue,Hall,,no,\n'))
+        loader.json_lines('{"kind": "supporter", "name": "table", "location": "hall"}\n'
+                          '\n'
+                          '{"kind": "thing", "name": "cup", "location": "table"}\n')
+        loader.finish()
+        lamp = self.named('lamp')
+        statue = self.named('statue')
+        self.assertTrue(lamp.lit)
+        self.assertTrue(lamp.portable)
+        self.assertEqual(lamp.description, 'A lamp.')
+        self.assertFalse(statue.lit)
+        self.assertFalse(statue.portable)
+        self.assertEqual(statue.description, '')
+        self.assertIs(self.named('cup').location, self.named('table'))
+
+    def test_blank_cells_leave_defaults(self):
+        loader = loading.Loader(self.world)
+        rooms = loader.csv('room', io.StringIO('name,lighted,description\nA,,\nB,no,Dark.\n'))
+        self.assertTrue(rooms[0].lighted)
+        self.assertEqual(rooms[0].description, 'It\'s the A.')
+        self.assertFalse(rooms[1].lighted)
+
+    def test_errors(self):
+        loader = loading.Loader(self.world)
+        with self.assertRaises(world.LogicalError):
+            loader.rows('thing', [{'name': 'x', 'colour': 'red'}])
+        with self.assertRaises(world.LogicalError):
+            loader.rows('thing', [{'location': 'nowhere'}])
+        with self.assertRaises(world.LogicalError):
+            loader.rows('unicorn', [{'name': 'x'}])
+        with self.assertRaises(world.LogicalError):
+            loader.csv('thing', io.StringIO('name,lit\nx,maybe\n'))
+        loader = loading.Loader(self.world)
+        loader.rows('thing', [{'name': 'x', 'location': 'Atlantis'}])
+        with self.assertRaises(world.LogicalError):
+            loader.finish()
+
+    def test_load(self):
+        w = self.world
+        loading.load(w, {'room': [{'name': 'A', 'id': 'a'}, {'name': 'B', 'id': 'b'}]}, [('a', 'west', 'b')])
+        self.assertEqual(w['a']['map connections'], {'west': 'b'})
+        self.assertEqual(w['b']['map connections'], {'east': 'a'})
+
+
+class Relations(EngineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.hall = pyif.room('Hall')
+        self.people = [pyif.make_object(name, 'person', location=self.hall) for name in ('Ann', 'Bob', 'Cy')]
+        self.things = [pyif.thing(name, location=self.hall) for name in ('hat', 'key', 'map')]
+
+    def test_many_to_many(self):
+        ann, bob, cy = self.people
+        hat, key, _ = self.things
+        knowing = pyif.relation('knowing', relations.MANY_TO_MANY, 'person', 'thing')
+        knowing.now(ann, hat)
+        knowing.now(bob, hat)
+        knowing.now(bob, key)
+        knowing.now(bob, key)
+        self.assertEqual(knowing.relating(hat), [ann, bob])
+        self.assertEqual(knowing.related(bob), [hat, key])
+        self.assertEqual(knowing.related(cy), [])
+        self.assertTrue(knowing.relates(ann, hat))
+        self.assertIn((bob.id, key.id), knowing)
+        self.assertEqual(len(knowing), 3)
+        knowing.now_not(ann, hat)
+        self.assertEqual(knowing.relating(hat), [bob])
+        knowing.forget(bob)
+        self.assertEqual(len(knowing), 0)
+        self.assertEqual(list(knowing.pairs()), [])
+
+    def test_one_to_many(self):
+        ann, bob, _ = self.people
+        hat, key, _ = self.things
+        owning = pyif.relation('owning', relations.ONE_TO_MANY, 'person', 'thing')
+        owning.now(ann, hat)
+        owning.now(ann, key)
+        owning.now(bob, hat)
+        self.assertEqual(owning.related(ann), [key])
+        self.assertIs(owning.the_relating(hat), bob)
+        self.assertEqual(len(owning), 2)
+
+    def test_many_to_one(self):
+        ann, bob, _ = self.people
+        hat, key, _ = self.things
+        wanting = pyif.relation('wanting', relations.MANY_TO_ONE, 'person', 'thing')
+        wanting.now(ann, hat)
+        wanting.now(bob, hat)
+        wanting.now(ann, key)
+        self.assertIs(wanting.the_related(ann), key)
+        self.assertEqual(wanting.relating(hat), [bob])
+
+    def test_one_to_one(self):
+        ann, bob, cy = self.people
+        marriage = pyif.relation('marriage', relations.ONE_TO_ONE, 'person', 'person')
+        marriage.now(ann, bob)
+        marriage.now(cy, bob)
+        self.assertIsNone(marriage.the_related(ann))
+        self.assertIs(marriage.the_relating(bob), cy)
+        marriage.now(cy, ann)
+        self.assertIsNone(marriage.the_relating(bob))
+        self.assertEqual(list(marriage.pairs()), [(cy, ann)])
+
+    def test_kinds_and_names(self):
+        ann = self.people[0]
+        hat = self.things[0]
+        knowing = pyif.relation('knowing', relations.MANY_TO_MANY, 'person', 'thing')
+        with self.assertRaises(world.LogicalError):
+            knowing.now(hat, ann)
+        with self.assertRaises(world.LogicalError):
+            pyif.relation('knowing')
+        with self.assertRaises(world.LogicalError):
+            pyif.relation('liking', 'some-to-some')
+        with self.assertRaises(world.LogicalError):
+            self.world.relation('hating')
+
+    def test_forks(self):
+        ann, bob, _ = self.people
+        hat = self.things[0]
+        knowing = pyif.relation('knowing', relations.MANY_TO_MANY, 'person', 'thing')
+        knowing.now(ann, hat)
+        fork = self.world.fork()
+        forked = fork.relation('knowing')
+        forked.now(bob.id, hat.id)
+        self.assertEqual(forked.relating(hat.id), [fork[ann.id], fork[bob.id]])
+        self.assertEqual(knowing.relating(hat), [ann])
+        knowing.now_not(ann, hat)
+        self.assertEqual(len(forked), 2)
+
+    def test_standard_relations(self):
+        w = self.world
+        ann, bob, _ = self.people
+        hat, key, map_ = self.things
+        box = pyif.make_object('box', 'container', location=self.hall)
+        table = pyif.make_object('table', 'supporter', location=self.hall)
+        carrying = w.relation('carrying')
+        wearing = w.relation('wearing')
+        wearing.now(ann, hat)
+        carrying.now(ann, key)
+        self.assertTrue(hat.worn)
+        self.assertEqual(wearing.related(ann), [hat])
+        self.assertEqual(carrying.related(ann), [key])
+        self.assertIs(carrying.the_relating(key), ann)
+        self.assertEqual(carrying.relating(hat), [])
+        #giving something worn to someone else means they carry it
+        carrying.now(bob, hat)
+        self.assertFalse(hat.worn)
+        self.assertEqual(carrying.related(bob), [hat])
+        wearing.now(bob, hat)
+        w.move(hat, ann)
+        self.assertFalse(hat.worn)
+        w.relation('containment').now(box, key)
+        w.relation('support').now(table, map_)
+        self.assertIs(key.location, box)
+        self.assertEqual(w.relation('support').related(table), [map_])
+        self.assertIn(box, w.relation('containment').related(self.hall))
+        self.assertTrue(w.relation('containment').relates(box, key))
+        w.relation('support').now_not(table, map_)
+        self.assertEqual(map_.location, 'nowhere')
+        with self.assertRaises(world.LogicalError):
+            carrying.now(box, hat)
+        pyif.now_wears(bob, map_)
+        pyif.now_carries(bob, key)
+        self.assertEqual(wearing.related(bob), [map_])
+        self.assertEqual(carrying.related(bob), [key])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+What people can see and touch.
+
+Sight goes up from a person through everything holding them until it reaches the room, or a closed opaque container
+they're inside; that's the visibility ceiling. From there they can see everything except what's in closed opaque
+containers, as long as there's light: the ceiling is a lighted room, or a lit thing can be seen. In the dark they can
+only see themselves and what they're carrying. Touch works the same way, except any closed container is in the way
+and the dark isn't.
+
+Working this out means going through everything in the room, so the answer is kept for each person. It's thrown away
+when something in the same room opens, closes, lights up, goes dark, arrives or leaves.
+"""
+from world import OBJECTS, VERBOSE, debug_enabled, debug_msg
+
+#properties that change who can see or touch what
+WATCHED = ('open', 'closed', 'opaque', 'transparent', 'lit', 'unlit', 'lighted', 'dark', 'location')
+
+
+def _is(obj, prop):
+    bit = obj._options.bits.get(prop)
+    return bit is not None and obj._state & bit != 0
+
+
+def blocks_sight(obj):
+    return _is(obj, 'closed') and _is(obj, 'opaque')
+
+
+def blocks_touch(obj):
+    return _is(obj, 'closed')
+
+
+class Scope:
+    """
+    What one person can see and touch, as id -> object dictionaries (don't change them).
+    """
+
+    __slots__ = ('actor', 'room', 'ceiling', 'levels', 'lit', 'visible', '_touchable')
+
+    def __init__(self, w, actor):
+        self.actor = actor
+        self.room = w.room_of(actor)
+        #how many things up the ceiling is
+        self.levels = 0
+        ceiling = actor
+        holder = w.holder_of(actor)
+        while holder is not None:
+            ceiling = holder
+            self.levels += 1
+            if blocks_sight(holder):
+                break
+            holder = w.holder_of(holder)
+        self.ceiling = ceiling
+        lit = _is(ceiling, 'lighted') or _is(ceiling, 'lit')
+        visible = {ceiling.id: ceiling}
+        stack = [ceiling]
+        while stack:
+            for obj in w.contents_of(stack.pop()):
+                visible[obj.id] = obj
+                if not lit and _is(obj, 'lit'):
+                    lit = True
+                if not blocks_sight(obj):
+                    stack.append(obj)
+        if not lit:
+            visible = {actor.id: actor}
+            stack = [actor]
+            while stack:
+                for obj in w.contents_of(stack.pop()):
+                    visible[obj.id] = obj
+                    if not blocks_sight(obj):
+                        stack.append(obj)
+        self.lit = lit
+        self.visible = visible
+        self._touchable = None
+
+    def touchable(self, w):
+        if self._touchable is None:
+            ceiling = self.actor
+            holder = w.holder_of(ceiling)
+            while holder is not None:
+                ceiling = holder
+                if blocks_touch(holder):
+                    break
+                holder = w.holder_of(holder)
+            touchable = {ceiling.id: ceiling}
+            stack = [ceiling]
+            while stack:
+                for obj in w.contents_of(stack.pop()):
+                    touchable[obj.id] = obj
+                    if not blocks_touch(obj):
+                        stack.append(obj)
+            self._touchable = touchable
+        return self._touchable
+
+
+class Visibility:
+    def __init__(self, w):
+        self.world = w
+        #actor id -> Scope, and room id -> ids of the actors whose scope was worked out there
+        self.scopes = {}
+        self.rooms = {}
+        for prop in WATCHED:
+            w.watch(prop, self._changed)
+
+    def clear(self):
+        self.scopes = {}
+        self.rooms = {}
+
+    def _changed(self, obj, prop):
+        self.invalidate(self.world.room_of(obj))
+
+    def invalidate(self, room):
+        """
+        Forget what everyone in room can see and touch.
+        """
+        actors = self.rooms.pop(room.id, None)
+        if actors:
+            if debug_enabled(OBJECTS, VERBOSE):
+                debug_msg('scope changed in {0} for {1}', room.name, ', '.join(actors), subsystem=OBJECTS)
+            for actor_id in actors:
+                self.scopes.pop(actor_id, None)
+
+    def scope(self, actor):
+        scope = self.scopes.get(actor.id)
+        if scope is None:
+            scope = self.scopes[actor.id] = Scope(self.world, actor)
+            actors = self.rooms.get(scope.room.id)
+            if actors is None:
+                actors = self.rooms[scope.room.id] = set()
+            actors.add(actor.id)
+        return scope
+
+    def barrier(self, actor, obj):
+        """
+        The closed container keeping actor from touching obj, or None if there isn't one.
+        """
+        w = self.world
+        #on the way in to obj
+        holder = w.holder_of(obj)
+        while holder is not None and holder is not actor and not w.encloses(holder, actor):
+            if blocks_touch(holder):
+                return holder
+            holder = w.holder_of(holder)
+        #or on the way out from actor
+        holder = w.holder_of(actor)
+        while holder is not None and holder is not obj and not w.encloses(holder, obj):
+            if blocks_touch(holder):
+                return holder
+            holder = w.holder_of(holder)
+        return None
@@ -1,4 +1,13 @@
-import uuid
+import collections
+import contextlib
+import contextvars
+import heapq
+import inspect
+import re
+import string
+import sys
+
+import output
 
 
 class AlreadyExistsError(Exception):
@@ -14,14 +23,58 @@ class LogicalError(Exception):
 
 
 class LazyString:
-    def __init__(self, string, format_options, story):
+    """
+    Text that's worked out each time it's shown, e.g. a description that changes. string can have {name} fields
+    (filled in by calling format_options[name](story)) and Inform-style [substitutions]:
+
+    - [name], for a format option, a story variable (e.g. [turn count]) or an object (its name; [the name] puts
+      'the' in front unless it's proper-named)
+    - [property of object], e.g. [description of the lamp]
+    - [if object is option]...[otherwise]...[end if], also with "is not", or [if name] for anything true
+    - [bracket] and [close bracket] for [ and ]
+
+    Objects can be given by id or name. The string is only parsed once. Every property and story variable read while
+    working it out is noted, and the text is kept until one of them changes. format_options can depend on anything,
+    so text that uses one is worked out every time, unless pure is set to say they only depend on what they read
+    from objects and the story. Set volatile if the text depends on anything else (like a random number).
+    """
+
+    def __init__(self, string, format_options=None, story=None, volatile=False, pure=False):
         self.string = string
-        self.format_options = format_options
+        self.format_options = {} if format_options is None else format_options
         self.story = story
+        self.volatile = volatile
+        self.pure = pure
+        self._parts = None
+        self._text = None
+        #(object or world, property, value it had)
+        self._depends = ()
 
     def __str__(self):
-        opts = {name: val(self.story) for name, val in self.format_options.items()}
-        return self.string.format(**opts)
+        outer = _reads.get()
+        if self._text is not None and self._unchanged():
+            if outer is not None:
+                outer.extend((holder, key) for holder, key, _ in self._depends)
+            return self._text
+        if self._parts is None:
+            self._parts = self._compile(self.string)
+        reads = []
+        token = _reads.set(reads)
+        try:
+            text = ''.join(self._render(self._parts))
+        finally:
+            _reads.reset(token)
+        if self.volatile:
+            reads.append(_untracked)
+        if outer is not None:
+            #text that this is part of depends on the same things
+            outer.extend(reads)
+        if _untracked not in reads:
+            self._depends = [(holder, key, _peek(holder, key)) for holder, key in dict.fromkeys(reads)]
+            self._text = text
+        else:
+            self._text = None
+        return text
 
     def __add__(self, other):
         return str(self)+other
@@ -29,17 +82,158 @@ class LazyString:
     def __radd__(self, other):
         return other+str(self)
 
+    def _unchanged(self):
+        for holder, key, val in self._depends:
+            now = _peek(holder, key)
+            if now is not val and now != val:
+                return False
+        return True
+
+    def _compile(self, string):
+        #a list of literal text and (kind of part, ...) tuples, with the [if]s nested
+        parts = []
+        stack = []
+        for literal, field, spec, conversion in _formatter.parse(string):
+            pos = 0
+            for match in _substitution.finditer(literal):
+                if match.start() > pos:
+                    parts.append(literal[pos:match.start()])
+                pos = match.end()
+                text = ' '.join(match.group(1).split())
+                words = text.lower()
+                if words.startswith('if '):
+                    cond = self._condition(text[3:])
+                    stack.append((parts, cond, None))
+                    parts = []
+                elif words in ('otherwise', 'else'):
+                    if not stack or stack[-1][2] is not None:
+                        raise LogicalError('[{0}] without an [if] in "{1}"'.format(text, string))
+                    outer, cond, _ = stack.pop()
+                    stack.append((outer, cond, parts))
+                    parts = []
+                elif words in ('end if', 'end'):
+                    if not stack:
+                        raise LogicalError('[{0}] without an [if] in "{1}"'.format(text, string))
+                    outer, cond, then = stack.pop()
+                    outer.append(('if', cond, parts if then is None else then, () if then is None else parts))
+                    parts = outer
+                elif words == 'bracket':
+                    parts.append('[')
+                elif words == 'close bracket':
+                    parts.append(']')
+                else:
+                    article = text[:4] if words.startswith('the ') else None
+                    parts.append(('value',) + self._reference(text) + (article,))
+            if pos < len(literal):
+                parts.append(literal[pos:])
+            if field is not None:
+                parts.append(('field', field, spec, conversion))
+        if stack:
+            raise LogicalError('[if] without an [end if] in "{0}"'.format(string))
+        return parts
+
+    def _reference(self, text):
+        #(property or None, what it's of)
+        name = text[4:] if text.lower().startswith('the ') else text
+        if name in self.format_options or self.story is None:
+            return None, name
+        if ' of ' in name:
+            prop, _, of = name.partition(' of ')
+            return prop, self._reference(of)[1]
+        if name in self.story.variables:
+            return None, name
+        return None, self._object(name)
+
+    def _object(self, name):
+        objects = self.story.objects
+        if name in objects:
+            return objects[name]
+        lower = name.lower()
+        for obj in objects.values():
+            if obj._properties['name'].lower() == lower:
+                return obj
+        return name
+
+    def _condition(self, text):
+        #(what, option or None, whether it should be the option)
+        what, sep, option = text.partition(' is ')
+        if not sep:
+            return self._reference(what)[1], None, True
+        if option.startswith('not '):
+            return self._reference(what)[1], option[4:], False
+        return self._reference(what)[1], option, True
+
+    def _lookup(self, what):
+        if isinstance(what, Kind):
+            return what
+        if what in self.format_options:
+            return self._option(what)
+        if self.story is not None:
+            return self.story[what]
+        raise LogicalError('can\'t work out [{0}] in "{1}"'.format(what, self.string))
+
+    def _option(self, name):
+        if not self.pure:
+            _reads.get().append(_untracked)
+        return self.format_options[name](self.story)
+
+    def _render(self, parts):
+        for part in parts:
+            if type(part) is str:
+                yield part
+            elif part[0] == 'field':
+                _, field, spec, conversion = part
+                key = _field_key.match(field).group(0)
+                val, _ = _formatter.get_field(field, (), {key: self._option(key)})
+                yield _formatter.format_field(_formatter.convert_field(val, conversion), spec)
+            elif part[0] == 'value':
+                _, prop, what, article = part
+                val = self._lookup(what)
+                if prop is not None:
+                    val = val[prop]
+                if not isinstance(val, Kind):
+                    yield str(val)
+                elif article is None or val['proper-named']:
+                    yield val['name']
+                else:
+                    yield article + val['name']
+            else:
+                _, (what, option, wanted), then, otherwise = part
+                val = self._lookup(what)
+                if option is not None:
+                    val = val[option]
+                yield from self._render(then if bool(val) == wanted else otherwise)
+
+
+_formatter = string.Formatter()
+_substitution = re.compile(r'\[([^\[\]]*)\]')
+_field_key = re.compile(r'[^.\[]*')
+#the properties read while a LazyString is being worked out, or None; each thread has its own, as it has its own world
+_reads = contextvars.ContextVar('reads', default=None)
+#noted as a read when text depends on something that can't be tracked, so neither it nor any text it's part of is kept
+_untracked = (None, None)
+
+
+def _peek(holder, key):
+    if isinstance(holder, Kind):
+        return holder._peek(key)
+    return holder.variables.get(key)
+
 
 class Value:
-    def __init__(self, ops, **kwargs):
-        #keep a dictionary of our options for this value and set them all to false
-        self.options = {}
-        self.implications = {}
-        self.always = None
-        self.never = None
+    """
+    An either/or property of a kind, e.g. open/closed. Each option is a bit in an object's state, and at most one
+    option of a value is set at once.
+    """
+
+    def __init__(self, ops, first_bit=0, **kwargs):
+        self.options = tuple(ops)
+        self.bits = {option: 1 << (first_bit + i) for i, option in enumerate(ops)}
+        self.mask = (1 << (first_bit + len(ops))) - (1 << first_bit)
+        #the options set (and fixed) by default, as a bitfield
+        self.default = 0
+        self.always = 0
 
-        for option in ops:
-            self.options[option] = False
         if len(kwargs) == 0:
             return
         if len(kwargs) > 1:
@@ -49,123 +243,388 @@ class Value:
         for key, val in kwargs.items():
             if val not in ops and len(ops) > 1:
                 raise LogicalError('Value with options {0} cannot be {1}'.format(ops, key))
-            #setattr(self, key, val)
             if key == 'usually' or key == 'always':
-                self.options[val] = True
+                self.default = self.bits[val]
             if key == 'always':
-                self.is_always(val)
+                self.always = self.bits[val]
 
-    def set(self, prop, val=True):
-        if self.never == prop and val:
-            print('raaaa')
-        elif self.always is not None and self.always != prop:
-            print('bbaaaa')
-        if val:
-            self.options = {key: (key == prop) for key, p in self.options.items()}
-        else:
-            self.options[prop] = False
-            #set the default being the first
-            for default in self.options:
-                if default == prop:
-                    continue
-                if len(self.options) > 2:
-                    print('warning, setting a default with multiple choices')
-                self.set(default)
-                return
-        for implication in self.implications:
-            #for each implication, if the implication is now true
-            if prop == implication and val:
-                #print('uh', prop, val)
-                self.update_implication(prop)
-
-    def update_implication(self, implied_by):
-        for rel, prop, val in self.implications[implied_by]:
-            #print('up', rel, prop, val)
-            if rel == 'usually':
-                prop.is_usually(val)
-            elif rel == 'always':
-                prop.is_always(val)
-            elif rel == 'never':
-                #print('here')
-                prop.is_never(val)
-
-    def implication(self, if_property, relation, implied_prop, val):
-        if if_property not in self.implications:
-            self.implications[if_property] = []
-        self.implications[if_property].append((relation, implied_prop, val))
-        #check if we have it on by default
-        if self.options[if_property]:
-            self.update_implication(if_property)
 
-    def is_always(self, prop):
-        self.always = prop
-        self.set(prop)
-
-    def is_never(self, prop):
-        self.never = prop
-        self.set(prop, False)
-
-    def is_usually(self, prop):
-        self.set(prop, True)
+class OptionTable:
+    """
+    The either/or properties of a kind: which bit each option lives in and which value (group of bits) it belongs to.
+    Tables are shared by every instance of a kind and copied if an instance adds options of its own.
+    """
 
-
-def generate_id(name):
-    return (name.lower()[:8] if len(name) > 8 else name.lower()).replace(' ', '') + uuid.uuid4().hex[:8]
+    def __init__(self):
+        self.values = {}
+        self.bits = {}
+        #option -> [(relation, option)]
+        self.implications = {}
+        self._graph = None
+        self.size = 0
+        self.shared = False
+
+    def copy(self):
+        table = OptionTable()
+        table.values = self.values.copy()
+        table.bits = self.bits.copy()
+        table.implications = {key: implied[:] for key, implied in self.implications.items()}
+        table.size = self.size
+        return table
+
+    def add(self, options, **kwargs):
+        value = Value(options, self.size, **kwargs)
+        self.size += len(value.options)
+        for option in value.options:
+            self.values[option] = value
+            self.bits[option] = value.bits[option]
+        self._graph = None
+        return value
+
+    def imply(self, if_property, relation, option):
+        self.implications.setdefault(if_property, []).append((relation, option))
+        self._graph = None
+
+    def graph(self):
+        """
+        The implications with everything needed to follow them looked up: option -> ((relation, option, bit, value)).
+        Built when it's first needed.
+        """
+        if self._graph is None:
+            self._graph = {prop: tuple((rel, option, self.bits[option], self.values[option]) for rel, option in implied)
+                           for prop, implied in self.implications.items()}
+        return self._graph
+
+
+def generate_id(name, number):
+    return (name.lower()[:8] if len(name) > 8 else name.lower()).replace(' ', '') + str(number)
+
+
+#property values that can be changed in place
+_mutable = (list, dict, set)
+
+
+class KindTemplate:
+    """
+    The resolved properties of a kind. It's built once, the first time the kind is used, and every new instance is
+    stamped out from it rather than re-running the whole chain of property callbacks.
+    """
+
+    def __init__(self, kind):
+        self.properties = kind._properties
+        self.options = kind._options
+        self.options.shared = True
+        self.state = kind._state
+        self.always = kind._always
+        self.never = kind._never
+        #mutable defaults (e.g. map connections) need to be unique to each instance
+        self.mutables = [key for key, val in self.properties.items() if isinstance(val, _mutable)]
+
+    def stamp(self, obj):
+        props = self.properties.copy()
+        for key in self.mutables:
+            props[key] = props[key].copy()
+        #straight into the slots, skipping Kind.__setattr__
+        setattr = object.__setattr__
+        setattr(obj, '_properties', props)
+        setattr(obj, '_options', self.options)
+        setattr(obj, '_state', self.state)
+        setattr(obj, '_always', self.always)
+        setattr(obj, '_never', self.never)
+        setattr(obj, '_world', None)
+        setattr(obj, '_handle', None)
+        setattr(obj, '_shared', False)
 
 
 class Kind:
+    #_shared is set when _properties is shared with the same object in a forked world, and needs copying to change
+    #_handle is the object's index in its world's tables
+    __slots__ = ('_properties', '_options', '_state', '_always', '_never', '_world', '_handle', '_shared')
+
     def __init__(self, name, name_id=False):
-        self._properties = {}
-        self.has('name', name)
-        self.has('id', name if name_id else generate_id(name))
-        self.has('indefinite article', '')
-        self.has('understand as', [name])
-        self.has('type', type(self).__name__)
-        self.can_be(['single-named', 'plural-named'], usually='plural-named')
-        self.can_be(['proper-named', 'improper-named'], usually='improper-named')
+        type(self).template().stamp(self)
+        self._properties['name'] = name
+        #otherwise the world gives it an id when it's added
+        self._properties['id'] = name if name_id else None
+        self._properties['understand as'] = [name]
+
+    @classmethod
+    def template(cls):
+        """
+        Get the template for this kind, building it if this is the first time the kind has been used.
+        """
+        template = cls.__dict__.get('_template')
+        if template is None:
+            template = cls._build_template()
+            cls._template = template
+        return template
+
+    @classmethod
+    def _build_template(cls):
+        #make a prototype instance and give it only the properties this kind adds on top of its parent
+        proto = cls.__new__(cls)
+        if cls is Kind:
+            proto._properties = {}
+            proto._options = OptionTable()
+            proto._state = proto._always = proto._never = 0
+            proto._world = None
+            proto._handle = None
+            proto._shared = False
+            proto.has('name', cls.__name__)
+            proto.has('id', None)
+            proto.has('indefinite article', '')
+            proto.has('understand as', None)
+            proto.has('type', None)
+            proto.can_be(['single-named', 'plural-named'], usually='plural-named')
+            proto.can_be(['proper-named', 'improper-named'], usually='improper-named')
+        else:
+            cls.__bases__[0].template().stamp(proto)
+            proto._options = proto._options.copy()
+            proto._properties['name'] = cls.__name__
+        proto._properties['type'] = cls.__name__
+        properties = cls.__dict__.get('_kind_properties')
+        if properties is not None:
+            properties(proto)
+        return KindTemplate(proto)
+
+    @classmethod
+    def kind_names(cls):
+        """
+        The names of this kind and all of the kinds it's a kind of.
+        """
+        names = cls.__dict__.get('_kind_names')
+        if names is None:
+            names = tuple(k.__name__ for k in cls.__mro__ if issubclass(k, Kind) and k is not Kind)
+            cls._kind_names = names
+        return names
+
+    @classmethod
+    def kind_set(cls):
+        """
+        The same as kind_names(), as a set to check against.
+        """
+        kinds = cls.__dict__.get('_kind_set')
+        if kinds is None:
+            kinds = cls._kind_set = frozenset(cls.kind_names())
+        return kinds
+
+    def is_a(self, kind):
+        """
+        Whether this is a kind (a name or a kind from pyif.kind) or a kind of it, e.g. a container is_a('thing').
+        """
+        return (kind if type(kind) is str else kind.__name__) in type(self).kind_set()
 
     def __getitem__(self, key):
+        reads = _reads.get()
+        if reads is not None:
+            #a LazyString is working out what it depends on
+            reads.append((self, key))
+        bit = self._options.bits.get(key)
+        if bit is not None:
+            return self._state & bit != 0
         try:
-            prop = self._properties[key]
-            if isinstance(prop, Value):
-                return prop.options[key]
-            else:
-                return prop
+            val = self._properties[key]
         except KeyError:
             raise LogicalError('{2} (a {0}) doesn\'t have the property {1}'.format(self.type, key, self.name))
+        world = self._world
+        if world is None:
+            return val
+        if key == 'location':
+            #go by the world's own objects, which matters in a forked world
+            holder = world.holders[self._handle]
+            return val if holder is None else holder
+        if isinstance(val, Kind):
+            return self._local(world, val)
+        if self._shared and isinstance(val, _mutable):
+            #whoever gets it could change it in place, so it has to be this object's own copy
+            self._own()
+            return self._properties[key]
+        return val
+
+    def _peek(self, key):
+        #what self[key] is, without it counting as a read
+        bit = self._options.bits.get(key)
+        if bit is not None:
+            return self._state & bit != 0
+        world = self._world
+        val = self._properties.get(key)
+        if world is not None:
+            if key == 'location':
+                holder = world.holders[self._handle]
+                if holder is not None:
+                    return holder
+            elif isinstance(val, Kind):
+                return self._local(world, val)
+        return val
+
+    @staticmethod
+    def _local(world, obj):
+        #an object stored before world was forked is the other world's; this world has its own with the same id
+        other = obj._world
+        if other is world or other is None:
+            return obj
+        return world.objects.get(obj._properties['id'], obj)
 
     def __setitem__(self, key, val):
         key = key.replace('_', ' ')
-        try:
-            prop = self._properties[key]
-        except KeyError:
-            raise LogicalError('{2} (a {0}) doesn\'t have the property {1}'.format(self.type, key, self.name))
-
-        item = prop
-        if isinstance(item, Value):
-            item.set(key, val)
+        if key in self._options.bits:
+            self._set_option(key, val)
+        elif key == 'location' and self._world is not None:
+            #the world keeps track of what's where, so moving has to go through it
+            self._world.move(self, val)
+        elif key in self._properties:
+            self._write(key, val)
+            world = self._world
+            if world is not None and key in world.watchers:
+                world._changed(self, key)
         else:
-            self._properties[key] = val
+            raise LogicalError('{2} (a {0}) doesn\'t have the property {1}'.format(self.type, key, self.name))
 
     def __getattr__(self, name):
+        if name[0] == '_':
+            raise AttributeError(name)
         return self[name.replace('_', ' ')]
 
     def __setattr__(self, key, value):
-        if key == '_properties' or key in self.__dict__:
-            super(Kind, self).__setattr__(key, value)
+        if key[0] == '_':
+            object.__setattr__(self, key, value)
         else:
             self[key] = value
 
     def __str__(self):
         return self.name
 
+    def _own_options(self):
+        #copy-on-write; the table is shared with the rest of the kind until an instance changes it
+        if self._options.shared:
+            self._options = self._options.copy()
+        return self._options
+
+    def _set_option(self, prop, val=True):
+        changed = self._apply(prop, val)
+        world = self._world
+        if world is not None and world._batch is not None:
+            world._batch.setdefault(self, []).extend(changed)
+            return
+        self._settle(changed)
+
+    def _apply(self, prop, val=True):
+        #change one option (and the others of its value) and return the options that changed, without following any
+        #implications
+        value = self._options.values[prop]
+        bit = value.bits[prop]
+        old = self._state
+        if val:
+            if self._never & bit:
+                raise LogicalError('{0} can never be {1}'.format(self.name, prop))
+            if self._always & value.mask & ~bit:
+                raise LogicalError('{0} is always {1}, so can\'t be {2}'.format(
+                    self.name, self._option_in(value, self._always), prop))
+            self._state = old & ~value.mask | bit
+        elif old & bit:
+            if self._always & bit:
+                raise LogicalError('{0} is always {1}'.format(self.name, prop))
+            self._state = old & ~bit
+            #set the default being the first
+            for default in value.options:
+                if default == prop or self._never & value.bits[default]:
+                    continue
+                if len(value.options) > 2 and debug_enabled(OBJECTS):
+                    debug_msg('{0} is no longer {1}, so it\'s now {2}', self.name, prop, default, subsystem=OBJECTS)
+                self._state |= value.bits[default]
+                break
+        flipped = (old ^ self._state) & value.mask
+        if not flipped:
+            return []
+        return [option for option in value.options if flipped & value.bits[option]]
+
+    @staticmethod
+    def _option_in(value, bits):
+        for option in value.options:
+            if bits & value.bits[option]:
+                return option
+
+    def _propagate(self, changed):
+        #follow the implications of the options in changed that are now set, to a fixpoint; each option's
+        #implications are only followed once. Returns everything that changed, including changed itself
+        graph = self._options.graph()
+        if not graph:
+            return changed
+        changed = list(changed)
+        bits = self._options.bits
+        work = collections.deque(prop for prop in changed if self._state & bits[prop] and prop in graph)
+        seen = set(work)
+        while work:
+            prop = work.popleft()
+            for rel, option, bit, value in graph[prop]:
+                if rel == 'always':
+                    if self._never & bit or self._always & value.mask & ~bit:
+                        raise LogicalError('{0} is {1}, which means it\'s always {2}, but it can\'t be'.format(
+                            self.name, prop, option))
+                    self._always |= bit
+                    new = self._apply(option)
+                elif rel == 'never':
+                    if self._always & bit:
+                        raise LogicalError('{0} is {1}, which means it\'s never {2}, but it\'s always {2}'.format(
+                            self.name, prop, option))
+                    self._never |= bit
+                    new = self._apply(option, False)
+                elif self._never & bit or self._always & value.mask & ~bit:
+                    #usually gives way to always and never
+                    continue
+                else:
+                    new = self._apply(option)
+                changed.extend(new)
+                for implied in new:
+                    if implied not in seen and implied in graph and self._state & bits[implied]:
+                        seen.add(implied)
+                        work.append(implied)
+        return changed
+
+    def _settle(self, changed):
+        changed = self._propagate(changed)
+        world = self._world
+        if world is not None and world.watchers:
+            for prop in dict.fromkeys(changed):
+                if prop in world.watchers:
+                    world._changed(self, prop)
+
+    def _write(self, key, val):
+        if self._shared:
+            self._own()
+        self._properties[key] = val
+
+    def _own(self):
+        #copy-on-write; lists, dicts and sets are copied too, as they can be changed in place
+        props = self._properties.copy()
+        for key, val in props.items():
+            if isinstance(val, _mutable):
+                props[key] = val.copy()
+        self._properties = props
+        self._shared = False
+
+    def _twin(self, world):
+        #the same object in a forked world, sharing everything until one of them sets a property or gets one that can
+        #be changed in place
+        twin = type(self).__new__(type(self))
+        twin._shared = self._shared = True
+        twin._properties = self._properties
+        twin._options = self._options
+        twin._state = self._state
+        twin._always = self._always
+        twin._never = self._never
+        twin._world = world
+        twin._handle = self._handle
+        self._options.shared = True
+        return twin
+
     def check_for_property(self, prop):
-        return prop in self._properties
+        return prop in self._properties or prop in self._options.bits
 
     def has(self, prop, usually=None):
-        if prop in self._properties:
+        if prop in self._properties or prop in self._options.bits:
             raise LogicalError('Kind {0} already has the property {1}'.format(self.name, prop))
-        self._properties[prop] = usually
+        self._write(prop, usually)
 
     def can_be(self, options, **kwargs):
         #e.g. can_be('scenery')
@@ -185,35 +644,62 @@ class Kind:
                     raise LogicalError('Value with options {0} cannot be {1}'.format(options, kwarg_key))
             else:
                 kwargs['usually'] = options[1]
-        value = Value(options, **kwargs)
         for option in options:
-            if option in self._properties:
+            if option in self._properties or option in self._options.bits:
                 raise LogicalError('Kind {0} already has the property {1}'.format(self.name, option))
-            self._properties[option] = value
+        value = self._own_options().add(options, **kwargs)
+        self._state |= value.default
+        self._always |= value.always
 
     def implication(self, if_property, then):
         #of the form 'if if_property is true, then the properties in then are also true'
         #e.g. scenery is usually fixed in place
-        prop = self._properties[if_property]
+        options = self._own_options()
         for key, val in then.items():
-            implied_prop = self._properties[val]
-            prop.implication(if_property, key, implied_prop, val)
+            if val not in options.bits:
+                raise LogicalError('Kind {0} doesn\'t have the property {1}'.format(self.name, val))
+            if key not in ('usually', 'always', 'never'):
+                raise LogicalError('{0} isn\'t usually, always or never'.format(key))
+            options.imply(if_property, key, val)
+        #check if we have it on by default
+        if self[if_property]:
+            self._settle([if_property])
 
     def is_now(self, prop):
-        p = self._properties[prop]
-        p.set(prop)
+        self._set_option(prop)
+
+    def now(self, *props):
+        """
+        Make this object all of props (options, e.g. 'closed', 'locked') together, following their implications once.
+        """
+        changed = []
+        for prop in props:
+            changed.extend(self._apply(prop))
+        world = self._world
+        if world is not None and world._batch is not None:
+            world._batch.setdefault(self, []).extend(changed)
+            return
+        self._settle(changed)
 
     def is_always(self, prop):
-        p = self._properties[prop]
-        p.is_always(prop)
+        value = self._options.values[prop]
+        bit = value.bits[prop]
+        if self._never & bit:
+            raise LogicalError('{0} can\'t always be {1}, as it\'s never {1}'.format(self.name, prop))
+        self._always = self._always & ~value.mask | bit
+        self._set_option(prop)
 
     def is_never(self, prop):
-        p = self._properties[prop]
-        p.is_never(prop)
+        value = self._options.values[prop]
+        bit = value.bits[prop]
+        if self._always & bit:
+            raise LogicalError('{0} can\'t never be {1}, as it\'s always {1}'.format(self.name, prop))
+        self._never |= bit
+        self._set_option(prop, False)
 
     def is_usually(self, prop):
-        p = self._properties[prop]
-        p.is_usually(prop)
+        self._set_option(prop)
+
 
 
 Kind.nothing = Kind('nothing', name_id=True)
@@ -223,94 +709,593 @@ _debug = False
 DEFAULT = 1
 VERBOSE = 2
 
-
-def debug_msg(*args, **kwargs):
-    if not _debug:
+#debugging subsystems, which can each have their own level
+RULES = 'rules'
+OBJECTS = 'objects'
+MAP = 'map'
+ACTIONS = 'actions'
+_levels = {}
+
+
+def set_debug_level(level, subsystem=None):
+    """
+    Set the debug level (False, DEFAULT or VERBOSE) for everything, or just for one subsystem.
+    """
+    global _debug
+    if subsystem is None:
+        _debug = level
+    else:
+        _levels[subsystem] = level
+
+
+def debug_enabled(subsystem=None, verbose=DEFAULT):
+    """
+    Check whether a debug message would be shown, so the work of building one can be skipped when it won't be.
+    """
+    level = _levels.get(subsystem, _debug)
+    return bool(level) and level >= verbose
+
+
+def debug_msg(msg, *args, subsystem=None, verbose=DEFAULT):
+    """
+    Show a debug message. If msg has {} fields it's formatted with args, but only if it's going to be shown;
+    otherwise args are shown after it, as print would (which is how debug_msg used to be called).
+    """
+    if not _debug and not _levels:
         return
-    if len(kwargs) == 0:
-        kwargs['verbose'] = DEFAULT
-    if _debug >= kwargs['verbose']:
-        print('DEBUG:', *args)
+    if debug_enabled(subsystem, verbose):
+        if args and type(msg) is str and any(field is not None for _, field, _, _ in _formatter.parse(msg)):
+            print('DEBUG:', msg.format(*args))
+        else:
+            print('DEBUG:', msg, *args)
 
 
 class World:
-    def __init__(self):
+    def __init__(self, message_log_size=100):
         self.kinds = {}
+        #kind name -> the name of the kind it's a kind of, or None
+        self.kind_parents = {}
+        #kind name -> names of its subkinds, made when first needed
+        self._kind_descendants = None
         self.objects = {}
+        #kind name -> {id: object} for every object of that kind, including those of its subkinds
+        self.kind_index = {}
+        #objects by handle, and for each handle the object directly holding it and {handle: object} of everything
+        #it directly holds (or None)
+        self.handles = []
+        self.holders = []
+        self.contents = []
+        self._id_counts = {}
         self.variables = {}
         self.rulebooks = {}
         self.directions = {}
         self.actions = {}
-        self.message_log = []
+        #only the most recent messages are kept, for last_message()
+        self.message_log = collections.deque(maxlen=message_log_size)
+        self.output = output.StdoutSink()
+        #messages said during an action are held back until it's finished
+        self._pending = []
+        self._output_depth = 0
         self.player = None
         self.action_processing = None
+        self.pipelines = {}
+        self.profiler = None
         self.first_room_made = None
+        #property name -> functions called with (object, property) when it changes on an object in this world
+        self.watchers = {}
+        #made when routes are first asked for (see routes.py)
+        self.routes = None
+        #made when the first command is parsed (see parsing.py)
+        self.parser = None
+        #made when anyone's scope is first needed (see visibility.py)
+        self.visibility = None
+        #object -> options changed since batch() started, or None outside of one
+        self._batch = None
+        #made when the first event is scheduled (see scheduling.py)
+        self.scheduler = None
+        #name -> relation (see relations.py)
+        self.relations = {}
+
+    def add_kind(self, name, kind):
+        self.kinds[name] = kind
+        parent = kind.__bases__[0]
+        self.kind_parents[name] = None if parent is Kind else parent.__name__
+        self._kind_descendants = None
+
+    def add_relation(self, relation):
+        if relation.name in self.relations:
+            raise LogicalError('Relation {0} already exists'.format(relation.name))
+        self.relations[relation.name] = relation
+        return relation
+
+    def relation(self, name):
+        """
+        The relation called name, e.g. 'carrying' or one made with pyif.relation.
+        """
+        relation = self.relations.get(name)
+        if relation is None:
+            raise LogicalError('Relation {0} does not exist'.format(name))
+        return relation
+
+    def kind_descendants(self, kind):
+        """
+        The names of every kind that's a kind of kind (not including kind itself), as a set.
+        """
+        if self._kind_descendants is None:
+            descendants = {name: set() for name in self.kinds}
+            for name, k in self.kinds.items():
+                for ancestor in k.kind_names()[1:]:
+                    descendants.setdefault(ancestor, set()).add(name)
+            self._kind_descendants = {name: frozenset(names) for name, names in descendants.items()}
+        return self._kind_descendants.get(kind if type(kind) is str else kind.__name__, frozenset())
+
+    def kind_ancestors(self, kind):
+        """
+        The names of every kind that kind is a kind of (not including kind itself), nearest first.
+        """
+        return (self.kinds[kind] if type(kind) is str else kind).kind_names()[1:]
 
     def get_ap_rulebook(self):
         if self.action_processing is None:
             self.action_processing = self.rulebooks['action processing rules']
         return self.action_processing
 
+    def get_pipeline(self, action):
+        pipeline = self.pipelines.get(action.id)
+        if pipeline is None:
+            pipeline = self.pipelines[action.id] = ActionPipeline(self, action)
+        return pipeline
+
+    def start_profiling(self):
+        """
+        Start timing every rule that's followed. Returns the profiler, which has the results.
+        """
+        import profiling
+        self.profiler = profiling.Profiler()
+        return self.profiler
+
+    def stop_profiling(self):
+        profiler = self.profiler
+        self.profiler = None
+        return profiler
+
+    def watch(self, prop, callback):
+        """
+        Call callback(obj, prop) whenever prop is set on an object in this world (or, for an either/or property, the
+        object becomes or stops being prop). Watching 'location' calls it when an object is put somewhere as it's
+        added, and both just before and just after it's moved.
+        """
+        self.watchers.setdefault(prop, []).append(callback)
+
+    def _changed(self, obj, prop):
+        for callback in self.watchers[prop]:
+            callback(obj, prop)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Change a lot of either/or properties at once, e.g.
+
+            with world.batch():
+                for box in boxes:
+                    box.is_now('locked')
+
+        Implications are followed (and watchers told) once for each object, when the batch ends.
+        """
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = {}
+        try:
+            yield self
+        finally:
+            batch = self._batch
+            self._batch = None
+            for obj, changed in batch.items():
+                obj._settle(changed)
+
+    def get_scheduler(self):
+        if self.scheduler is None:
+            import scheduling
+            self.scheduler = scheduling.Scheduler(self)
+        return self.scheduler
+
+    def schedule_in(self, turns, event):
+        """
+        Follow event (a rule or a function taking the world) at the end of the turn turns turns from now. Returns a
+        number that cancel_event takes.
+        """
+        return self.get_scheduler().in_turns(turns, event)
+
+    def schedule_at(self, when, event):
+        """
+        Follow event at a time of day, given as e.g. '5:00 PM' or in minutes since midnight.
+        """
+        return self.get_scheduler().at(when, event)
+
+    def cancel_event(self, number):
+        self.get_scheduler().cancel(number)
+
+    def get_routes(self):
+        if self.routes is None:
+            import routes
+            self.routes = routes.RouteFinder(self)
+        return self.routes
+
+    def best_route(self, fro, to, using_doors=False, even_locked=False, region=None):
+        """
+        The directions to go in, in order, to get from room fro to room to by the shortest route, or None if there
+        isn't one. Rooms can be given as objects or ids. Routes only go through doors if using_doors is set, and then
+        only through unlocked ones unless even_locked is set too; with a region, they only go through rooms in it.
+        """
+        return self.get_routes().route(fro, to, using_doors, even_locked, region)
+
+    def route_distance(self, fro, to, using_doors=False, even_locked=False, region=None):
+        """
+        How many moves it takes to get from fro to to (0 if they're the same room), or None if it can't be done.
+        """
+        return self.get_routes().distance(fro, to, using_doors, even_locked, region)
+
+    def next_step(self, fro, to, using_doors=False, even_locked=False, region=None):
+        """
+        The direction to go in from fro to get to to, or None if there's no route (or they're the same room).
+        """
+        return self.get_routes().next_step(fro, to, using_doors, even_locked, region)
+
+    def get_parser(self):
+        if self.parser is None:
+            import parsing
+            self.parser = parsing.Parser(self)
+        return self.parser
+
+    def parse(self, text, actor=None):
+        """
+        Work out what a typed command means for actor (the player by default), as (action, nouns). Raises a
+        parsing.ParseError saying what the problem is if it can't.
+        """
+        return self.get_parser().parse(text, self.get_player() if actor is None else actor)
+
+    def get_visibility(self):
+        if self.visibility is None:
+            import visibility
+            self.visibility = visibility.Visibility(self)
+        return self.visibility
+
+    def scope_of(self, actor):
+        """
+        What actor can see and touch, kept until something near it changes (see visibility.py).
+        """
+        return self.get_visibility().scope(actor)
+
+    def can_see(self, actor, obj):
+        return obj.id in self.get_visibility().scope(actor).visible
+
+    def can_touch(self, actor, obj):
+        return obj.id in self.get_visibility().scope(actor).touchable(self)
+
+    def in_darkness(self, actor):
+        return not self.get_visibility().scope(actor).lit
+
+    def visibility_ceiling(self, actor):
+        """
+        The outermost thing actor can see out to: normally the room it's in.
+        """
+        return self.get_visibility().scope(actor).ceiling
+
+    def save(self, f):
+        """
+        Save the state of the world (see saving.py).
+        """
+        import saving
+        saving.save(self, f)
+
+    def restore(self, f):
+        import saving
+        saving.restore(self, f)
+        #the restored properties were written directly, so nothing watching them has noticed
+        if self.routes is not None:
+            self.routes.clear()
+        if self.parser is not None:
+            self.parser.rebuild()
+        if self.visibility is not None:
+            self.visibility.clear()
+
     def get_player(self):
         if self.player is None:
             self.player = self.objects['yourself']
         return self.player
 
+    def instances_of(self, kind):
+        """
+        Get every object of a kind (including its subkinds) as an id -> object dictionary. Don't modify it.
+        """
+        return self.kind_index.get(kind, {})
+
     def things(self):
-        for k, v in self.objects.items():
-            if v.type == 'thing':
-                yield k, v
+        return self.instances_of('thing').items()
 
     def say(self, msg, *args):
         formatted = msg.format(*args)
-        print(formatted)
         self.message_log.append(formatted)
+        self._pending.append(formatted)
+        if self._output_depth == 0:
+            self.flush()
+
+    def set_output(self, sink):
+        """
+        Send everything said from now on to sink (see output.py) instead.
+        """
+        self.flush()
+        self.output = sink
+
+    def flush(self):
+        if self._pending:
+            pending = self._pending
+            self._pending = []
+            self.output.write(pending)
 
     def last_message(self):
         return "" if len(self.message_log) == 0 else self.message_log[-1]
 
     def go(self):
-        self.rulebooks['when play begins rules'].follow()
+        self._output_depth += 1
+        try:
+            self.rulebooks['when play begins rules'].follow()
+        finally:
+            self._output_depth -= 1
+            if self._output_depth == 0:
+                self.flush()
+
+    def allocate_id(self, name):
+        """
+        Make a new id for an object called name. Ids are counted per world, so the same story always gives its
+        objects the same ids.
+        """
+        prefix = generate_id(name, '')
+        count = self._id_counts.get(prefix, 0)
+        while True:
+            count += 1
+            obj_id = prefix + str(count)
+            if obj_id not in self.objects:
+                self._id_counts[prefix] = count
+                return obj_id
 
     def add(self, obj):
-        debug_msg('added {0} (a {2}) with id {1}'.format(obj, obj.id, obj.type))
-        self.objects[obj.id] = obj
-        if obj.type == 'action':
-            self.actions[obj.id] = obj
-        elif obj.type == 'direction':
-            self.directions[obj.id] = obj
-        elif obj.type == 'room' and self.first_room_made is None:
-            self.first_room_made = obj
+        self.add_all((obj,))
+
+    def add_all(self, objs):
+        """
+        Add a lot of objects at once, e.g. from loading.Loader. It's the same as adding them one at a time, except
+        what's needed from each kind is only looked up once. Raises AlreadyExistsError if an object's id is taken.
+        """
+        objects = self.objects
+        handles = self.handles
+        holders = self.holders
+        contents = self.contents
+        debugging = debug_enabled(OBJECTS)
+        watched = 'location' in self.watchers
+        parser = self.parser
+        setattr = object.__setattr__
+        #kind -> (the indexes it goes in, the table of actions/directions/rooms it goes in, whether it's a room)
+        kinds = {}
+        for obj in objs:
+            props = obj._properties
+            if props['id'] is not None and props['id'] in objects:
+                raise AlreadyExistsError('An object with the id {0} already exists'.format(props['id']))
+            location = props.get('location')
+            if type(location) is str and location != 'nowhere':
+                #the same as move() does with an id
+                holder = objects.get(location)
+                if holder is None:
+                    raise LogicalError('{0} can\'t be in {1}, which isn\'t in the world'.format(obj.name, location))
+                location = holder
+                obj._write('location', holder)
+                props = obj._properties
+            obj_id = props['id']
+            obj_id = sys.intern(self.allocate_id(props['name']) if obj_id is None else obj_id)
+            obj._write('id', obj_id)
+            if debugging:
+                debug_msg('added {0} (a {2}) with id {1}', obj, obj_id, obj.type, subsystem=OBJECTS)
+            objects[obj_id] = obj
+            setattr(obj, '_world', self)
+            setattr(obj, '_handle', len(handles))
+            handles.append(obj)
+            holders.append(None)
+            contents.append(None)
+            if isinstance(location, Kind):
+                self._place(obj, location)
+                if watched:
+                    self._changed(obj, 'location')
+            kind = type(obj)
+            found = kinds.get(kind)
+            if found is None:
+                found = kinds[kind] = self._kind_tables(kind)
+            indexes, table, is_room = found
+            for index in indexes:
+                index[obj_id] = obj
+            if parser is not None:
+                parser.add(obj)
+            if table is not None:
+                table[obj_id] = obj
+            if is_room:
+                if self.first_room_made is None:
+                    self.first_room_made = obj
+                if self.routes is not None and props['map connections']:
+                    self.routes.connections_changed(obj)
+
+    def _kind_tables(self, kind):
+        indexes = []
+        for name in kind.kind_names():
+            index = self.kind_index.get(name)
+            if index is None:
+                index = self.kind_index[name] = {}
+            indexes.append(index)
+        names = kind.kind_set()
+        table = None
+        if 'action' in names:
+            table = self.actions
+        elif 'direction' in names:
+            table = self.directions
+        return indexes, table, table is None and 'room' in names
+
+    def fork(self):
+        """
+        Make an independent copy of the world, e.g. to try an action and see what happens. Each object's properties
+        are shared with this world until one side sets one, or gets a list, dict or set (e.g. map connections), which
+        could be changed in place; then that object's properties are copied, including its lists, dicts and sets.
+        That's one level deep: a list inside a list is still shared. Variables are copied straight away, the same way.
+        Rulebooks are copied, but not the rules in them.
+
+        An object stored in a property (e.g. a door's other side) is looked up in the world of the object it's a
+        property of when it's got, so each world only ever hands out its own objects. Objects inside lists or dicts,
+        or captured by a rule, are still this world's, so look them up again (world[obj.id]) before changing them in
+        the fork.
+        """
+        child = World.__new__(World)
+        child.__dict__.update(self.__dict__)
+        objects = child.objects = {obj_id: obj._twin(child) for obj_id, obj in self.objects.items()}
+
+        def twin(obj):
+            return objects[obj.id] if isinstance(obj, Kind) and self.objects.get(obj.id) is obj else obj
+
+        child.kind_index = {kind: {obj_id: objects[obj_id] for obj_id in index}
+                            for kind, index in self.kind_index.items()}
+        child.handles = [objects[obj._properties['id']] for obj in self.handles]
+        handles = child.handles
+        child.holders = [None if holder is None else handles[holder._handle] for holder in self.holders]
+        child.contents = [None if held is None else {handle: handles[handle] for handle in held}
+                          for held in self.contents]
+        child._id_counts = self._id_counts.copy()
+        child.kinds = self.kinds.copy()
+        child.kind_parents = self.kind_parents.copy()
+        child.variables = {key: val.copy() if isinstance(val, _mutable) else twin(val)
+                           for key, val in self.variables.items()}
+        child.directions = {obj_id: objects[obj_id] for obj_id in self.directions}
+        child.actions = {obj_id: objects[obj_id] for obj_id in self.actions}
+        child.player = twin(self.player)
+        child.first_room_made = twin(self.first_room_made)
+        child.rulebooks = {name: rulebook._copy(child) for name, rulebook in self.rulebooks.items()}
+        for action in child.actions.values():
+            for key, val in action._properties.items():
+                if isinstance(val, Rulebook):
+                    action._write(key, child.rulebooks[val.name])
+        child.action_processing = None
+        child.pipelines = {}
+        child.profiler = None
+        #anything watching this world works on this world's objects, so the fork starts again
+        child.watchers = {}
+        child.routes = None
+        child.parser = None
+        child.visibility = None
+        child._batch = None
+        child.scheduler = None if self.scheduler is None else self.scheduler.copy(child)
+        child.relations = {name: relation.copy(child) for name, relation in self.relations.items()}
+        child.message_log = collections.deque(self.message_log, maxlen=self.message_log.maxlen)
+        child.output = output.BufferSink()
+        child._pending = []
+        child._output_depth = 0
+        return child
 
     def add_rulebook(self, name, rulebook):
         self.rulebooks[name] = rulebook
         return rulebook
 
-    def add_rule(self, rulebook, name, rule, before=False):
-        self.rulebooks[rulebook].add_rule(name, rule, before)
+    def add_rule(self, rulebook, name, rule, before=False, after=None):
+        self.rulebooks[rulebook].add_rule(name, rule, before, after)
 
     def move(self, obj, new_loc):
-        debug_msg('moved {0} from {1} to {2}'.format(obj.name, obj.location, new_loc))
-        obj.location = new_loc
+        """
+        Move an object into, onto or into the hands of new_loc (an object or its id). This is the only way an object's
+        location changes; moving it to None or 'nowhere' takes it out of play.
+        """
+        if type(new_loc) is str and new_loc != 'nowhere':
+            new_loc = self[new_loc]
+        if debug_enabled(OBJECTS):
+            debug_msg('moved {0} from {1} to {2}', obj.name, obj.location, new_loc, subsystem=OBJECTS)
+        if isinstance(new_loc, Kind) and (new_loc is obj or self.encloses(obj, new_loc)):
+            raise LogicalError('can\'t move {0} inside itself'.format(obj.name))
+        watched = 'location' in self.watchers
+        if watched:
+            self._changed(obj, 'location')
+        handle = obj._handle
+        old_loc = self.holders[handle]
+        if old_loc is not None:
+            del self.contents[old_loc._handle][handle]
+            self.holders[handle] = None
+        if isinstance(new_loc, Kind):
+            self._place(obj, new_loc)
+        obj._write('location', new_loc)
+        #anything worn is taken off when it goes somewhere else (see the wearing relation)
+        if old_loc is not None and obj._state & obj._options.bits.get('worn', 0):
+            obj['worn'] = False
+        if watched:
+            self._changed(obj, 'location')
+
+    def _place(self, obj, holder):
+        self.holders[obj._handle] = holder
+        held = self.contents[holder._handle]
+        if held is None:
+            held = self.contents[holder._handle] = {}
+        held[obj._handle] = obj
+
+    def holder_of(self, obj):
+        """
+        The object directly holding obj, or None if it isn't anywhere.
+        """
+        return None if obj._handle is None else self.holders[obj._handle]
+
+    def contents_of(self, holder):
+        """
+        Everything directly in, on or carried by holder.
+        """
+        held = None if holder._handle is None else self.contents[holder._handle]
+        return () if held is None else held.values()
+
+    def all_contents_of(self, holder):
+        """
+        Everything in holder, including things inside the things in it.
+        """
+        contents = self.contents
+        stack = [] if holder._handle is None else [holder._handle]
+        while stack:
+            held = contents[stack.pop()]
+            if held is not None:
+                for handle, obj in held.items():
+                    yield obj
+                    stack.append(handle)
+
+    def encloses(self, holder, obj):
+        """
+        Whether obj is somewhere inside holder, however indirectly.
+        """
+        loc = self.holder_of(obj)
+        while loc is not None:
+            if loc is holder:
+                return True
+            loc = self.holders[loc._handle]
+        return False
+
+    def room_of(self, obj):
+        """
+        The outermost object holding obj (normally the room it's in), or obj itself if nothing holds it.
+        """
+        loc = self.holder_of(obj)
+        while loc is not None:
+            obj = loc
+            loc = self.holders[obj._handle]
+        return obj
 
     def __getitem__(self, key):
+        reads = _reads.get()
+        if reads is not None and key in self.variables:
+            reads.append((self, key))
         try:
-            prop = self.variables[key]
-            if isinstance(prop, Value):
-                return prop.options[key]
-            else:
-                return prop
+            return self.variables[key]
         except KeyError:
             return self.objects[key]
 
     def __setitem__(self, key, val):
-        try:
-            item = self.variables[key]
-            if isinstance(item, Value):
-                item[key] = val
-            self.variables[key] = val
-        except KeyError:
-            self.variables[key] = val
+        self.variables[key] = val
 
     def __getattr__(self, name):
         return self[name.replace('_', ' ')]
@@ -319,111 +1304,448 @@ class World:
         self['title'] = title
 
     def try_action(self, actor, action, nouns=[]):
-        debug_msg('{0} is trying to do {1}'.format('the player' if actor.name == 'yourself' else actor.name, action))
-        #print(nouns)
-        outcome = self.get_ap_rulebook().follow(actor=actor, action=self.actions[action], nouns=nouns)
-        if outcome is not None:
-            debug_msg('outcome of {0} trying to do {1} is {2}'.format('the player' if actor.name == 'yourself' else
-                                                                   actor.name, action, outcome))
-        debug_msg('{0} has finished trying to perform the action {1}'.format('the player' if actor.name == 'yourself'
-                                                                            else actor.name, action))
+        self._output_depth += 1
+        try:
+            return self._try_action(actor, action, nouns)
+        finally:
+            self._output_depth -= 1
+            if self._output_depth == 0:
+                self.flush()
+
+    def play_turn(self, action, nouns=[], actor=None):
+        """
+        Have actor (the player by default) try an action, then end the turn.
+        """
+        self._output_depth += 1
+        try:
+            outcome = self._try_action(self.get_player() if actor is None else actor, action, nouns)
+            self.end_turn()
+            return outcome
+        finally:
+            self._output_depth -= 1
+            if self._output_depth == 0:
+                self.flush()
+
+    def play_command(self, text):
+        """
+        Have the player try a typed command and end the turn. A command that isn't understood doesn't take a turn.
+        """
+        import parsing
+        self._output_depth += 1
+        try:
+            player = self.get_player()
+            try:
+                action, nouns = self.parse(text, player)
+            except parsing.ParseError as e:
+                self.say(str(e))
+                return None
+            outcome = self._try_action(player, action.id, nouns)
+            self.end_turn()
+            return outcome
+        finally:
+            self._output_depth -= 1
+            if self._output_depth == 0:
+                self.flush()
+
+    def end_turn(self):
+        """
+        Follow the turn sequence rules: the every turn rules, any timed events that are due, and moving the turn count
+        and time of day on.
+        """
+        self._output_depth += 1
+        try:
+            self.rulebooks['turn sequence rules'].follow()
+        finally:
+            self._output_depth -= 1
+            if self._output_depth == 0:
+                self.flush()
+
+    def try_command(self, text, actor=None):
+        """
+        Have actor (the player by default) try to do what a typed command says. If it can't be understood, the reason
+        is said instead.
+        """
+        import parsing
+        if actor is None:
+            actor = self.get_player()
+        self._output_depth += 1
+        try:
+            try:
+                action, nouns = self.parse(text, actor)
+            except parsing.ParseError as e:
+                self.say(str(e))
+                return None
+            return self._try_action(actor, action.id, nouns)
+        finally:
+            self._output_depth -= 1
+            if self._output_depth == 0:
+                self.flush()
+
+    def _try_action(self, actor, action, nouns):
+        debugging = debug_enabled(ACTIONS)
+        if debugging:
+            who = 'the player' if actor.name == 'yourself' else actor.name
+            debug_msg('{0} is trying to do {1}', who, action, subsystem=ACTIONS)
+        action = self.actions[action]
+        if self.profiler is not None or debug_enabled(RULES):
+            #follow the rulebooks one by one so the debug output and profile show them all
+            outcome = self.get_ap_rulebook().follow(actor=actor, action=action, nouns=nouns)
+        else:
+            outcome = self.get_pipeline(action).run(actor=actor, action=action, nouns=nouns)
+        if debugging:
+            if outcome is not None:
+                debug_msg('outcome of {0} trying to do {1} is {2}', who, action, outcome, subsystem=ACTIONS)
+            debug_msg('{0} has finished trying to perform the action {1}', who, action, subsystem=ACTIONS)
         return outcome
 
 
 class Rule:
-    def __init__(self, name, rule):
+    def __init__(self, name, rule, placeholder=False):
         self.name = name
         self.rule = rule
+        #placeholders are rules we know about (from Inform) but don't do anything yet
+        self.placeholder = placeholder
+        #work out which variables the rule takes once, up front, rather than guessing every time it's followed
+        self.takes_all = False
+        self.params = ()
+        try:
+            params = list(inspect.signature(rule).parameters.values())[1:]
+        except (TypeError, ValueError):
+            self.takes_all = True
+            return
+        self.takes_all = any(p.kind is p.VAR_KEYWORD for p in params)
+        self.params = tuple(p.name for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
 
     def evaluate(self, story, **kwargs):
-        return self.rule(story, **kwargs)
+        return self._evaluate(story, kwargs)
+
+    def _evaluate(self, story, kwargs):
+        #only pass on the variables the rule asks for
+        if self.takes_all:
+            return self.rule(story, **kwargs)
+        if not self.params:
+            return self.rule(story)
+        return self.rule(story, **{key: kwargs[key] for key in self.params if key in kwargs})
+
+
+class FollowRule(Rule):
+    """
+    A rule that follows another rulebook, e.g. the check stage rule. The rulebook is either the name of one of the
+    world's rulebooks or a function that gets it from the current action. passes is the names of the variables to
+    hand on to it (None for all of them).
+    """
+
+    def __init__(self, name, rulebook, passes=None):
+        super(FollowRule, self).__init__(name, self._follow)
+        self.rulebook = rulebook
+        self.passes = None if passes is None else tuple(passes)
+        self.takes_all = True
+
+    def target(self, story, action):
+        if isinstance(self.rulebook, str):
+            return story.rulebooks[self.rulebook]
+        return self.rulebook(action)
+
+    def _follow(self, story, **kwargs):
+        rulebook = self.target(story, kwargs.get('action'))
+        if self.passes is None:
+            return rulebook.follow(**kwargs)
+        return rulebook.follow(**{key: kwargs[key] for key in self.passes if key in kwargs})
+
+
+class ActionPipeline:
+    """
+    The action processing rules for a single action, flattened into one list. Rules that follow another rulebook are
+    replaced by that rulebook's rules and placeholders are dropped, so trying the action is just one loop. It's
+    recompiled the next time it's run if any of the rulebooks it was built from get a new rule.
+    """
+
+    def __init__(self, world, action):
+        self.world = world
+        self.action = action
+        self.steps = None
+
+    def invalidate(self):
+        self.steps = None
+
+    def compile(self):
+        self.steps = []
+        self._flatten(self.world.get_ap_rulebook(), None)
+        return self.steps
+
+    def _flatten(self, rulebook, passes):
+        rulebook.dependents.add(self)
+        for rule in rulebook.ordered_rules():
+            if rule.placeholder:
+                continue
+            if isinstance(rule, FollowRule):
+                inner = rule.passes
+                if passes is not None:
+                    inner = passes if inner is None else tuple(key for key in inner if key in passes)
+                self._flatten(rule.target(self.world, self.action), inner)
+            else:
+                self.steps.append((rule, passes))
+
+    def run(self, **kwargs):
+        steps = self.steps
+        if steps is None:
+            steps = self.compile()
+        world = self.world
+        #each distinct set of variables is only built once per run
+        views = {None: kwargs}
+        for rule, passes in steps:
+            view = views.get(passes)
+            if view is None:
+                view = views[passes] = {key: kwargs[key] for key in passes if key in kwargs}
+            result = rule._evaluate(world, view)
+            if result is not None:
+                debug_msg('Rule outcome for \'{1}\' was {0}', result, rule.name, subsystem=RULES)
+                return result
+        return None
 
 
 class Rulebook:
+    FIRST, MIDDLE, LAST = 0, 1, 2
 
     def __init__(self, name, world, default_outcome=None):
         self.name = name
         self.default_outcome = default_outcome
+        #the resolved order of the rules; rebuilt from the placements below whenever the rulebook changes
         self.first_rules = []
         self.rules = []
         self.last_rules = []
         self.variables = {}
         self.world = world
+        #name -> rule, and name -> (segment, before, after, sequence number)
+        self._index = {}
+        self._placements = {}
+        #old name -> new name
+        self._replacements = {}
+        self._removed = set()
+        self._added = 0
+        self.frozen = True
+        #action pipelines that include this rulebook and need recompiling when it changes
+        self.dependents = set()
 
     def __getitem__(self, key):
         if key.endswith(' rule'):
             return self.get_rule(key)
-        prop = self.variables[key]
-        if isinstance(prop, Value):
-            return prop.options[key]
-        else:
-            return prop
+        return self.variables[key]
 
     def __setitem__(self, key, val):
         if key.endswith(' rule'):
             self.add_rule(key)
             return
-        try:
-            item = self.variables[key]
-            if isinstance(item, Value):
-                item[key] = val
-            self.variables[key] = val
-        except KeyError:
-            self.variables[key] = val
+        self.variables[key] = val
 
     def get_rule(self, rule):
-        rule = next((x for x in self.first_rules if x.name == rule), None)
-        if rule is None:
-            rule = next((x for x in self.rules if x.name == rule), None)
-            if rule is None:
-                rule = next((x for x in self.rules if x.name == rule), None)
-                if rule is None:
-                    raise KeyError('rule {0} not found in rulebook {1}'.format(rule, self.name))
-
-    def add_rule(self, name, func=None, before=False):
-        self._add(name, func, self.rules, before)
-
-    def _add(self, name, func, rulebook, before):
+        """
+        The rule listed under the name rule, which is whatever replaced it if it's been replaced.
+        """
+        name = rule
+        seen = set()
+        while name in self._replacements and name not in seen:
+            seen.add(name)
+            name = self._replacements[name]
+        if name in self._index and name not in self._removed:
+            return self._index[name]
+        raise KeyError('rule {0} not found in rulebook {1}'.format(rule, self.name))
+
+    def add_rule(self, name, func=None, before=False, after=None):
+        """
+        Add a rule to the rulebook. before is either True (to put it at the start) or the name of a rule it should
+        be listed before; after is the name of a rule it should be listed after.
+        """
+        self._add(name, func, Rulebook.MIDDLE, before, after)
+
+    def _add(self, name, func, segment, before, after=None):
         if func is not None:
             name = Rule(name, func)
         if type(name) is str and func is None:
-            name = Rule(name, lambda s: debug_msg('not implemented {0}'.format(name.name), verbose=VERBOSE))
-        debug_msg('added rule {0}'.format(name.name))
-        if before:
-            rulebook.insert(0, name)
-        else:
-            rulebook.append(name)
-
-    def add_rule_first(self, name, func=None, before=False):
-        self._add(name, func, self.first_rules, before)
+            name = Rule(name, lambda s: debug_msg('not implemented {0}', name.name, subsystem=RULES, verbose=VERBOSE),
+                        True)
+        if not name.name:
+            #rules don't need a name, but they're listed by one, so each unnamed rule gets its own
+            number = self._added
+            while not name.name or name.name in self._placements:
+                number += 1
+                name.name = 'unnamed rule {0}'.format(number)
+        debug_msg('added rule {0}', name.name, subsystem=RULES)
+        if name.name in self._placements:
+            raise LogicalError('Rulebook {0} already has the rule {1}'.format(self.name, name.name))
+        self._added += 1
+        self._index[name.name] = name
+        self._placements[name.name] = (segment, before, after, self._added)
+        self._changed()
+
+    def add_rule_first(self, name, func=None, before=False, after=None):
+        self._add(name, func, Rulebook.FIRST, before, after)
+
+    def add_rule_last(self, name, func=None, before=False, after=None):
+        self._add(name, func, Rulebook.LAST, before, after)
+
+    def replace_rule(self, old, name, func=None):
+        """
+        List a rule in place of another one, which doesn't have to have been added yet.
+        """
+        self._replacements[old] = name if type(name) is str else name.name
+        self._add(name, func, Rulebook.MIDDLE, False)
+
+    def remove_rule(self, name):
+        """
+        Stop a rule (which doesn't have to have been added yet) from being listed in this rulebook.
+        """
+        self._removed.add(name)
+        self._changed()
+
+    def _changed(self):
+        self.frozen = False
+        for pipeline in self.dependents:
+            pipeline.invalidate()
+
+    def freeze(self):
+        """
+        Work out the final order of the rules. This is done once, when the rulebook is first followed after a
+        change, rather than every time a rule is added.
+        """
+        if self.frozen:
+            return
+        placements = {name: placement for name, placement in self._placements.items() if name not in self._removed}
+        #a replacement takes over the position of the rule it replaces
+        for old, new in self._replacements.items():
+            if old in placements and new in placements:
+                placements[new] = placements.pop(old)
+
+        def target(name):
+            while name not in placements and name in self._replacements:
+                name = self._replacements[name]
+            if name in placements:
+                return name
+            if name in self._removed:
+                #listed relative to a rule that's been taken out, so just fall back to the normal order
+                return None
+            raise LogicalError('rule {0} not found in rulebook {1}'.format(name, self.name))
+
+        for name, (segment, before, after, added) in placements.items():
+            if before is not True:
+                before = target(before) if before else None
+            if after is not None:
+                after = target(after)
+            placements[name] = (segment, before, after, added)
+
+        keys = {}
+        segments = {}
+
+        def key(name, seen=()):
+            #rules listed relative to another rule sort just before/after it, in the order they were added
+            if name in keys:
+                return keys[name]
+            if name in seen:
+                raise LogicalError('rules {0} can\'t all be listed before/after each other in {1}'
+                                   .format(', '.join(seen), self.name))
+            segment, before, after, added = placements[name]
+            if before is True:
+                k = (-added, 1)
+            elif before is not None:
+                k = key(before, seen + (name,))[:-1] + (0, added, 1)
+                segment = segments[before]
+            elif after is not None:
+                k = key(after, seen + (name,))[:-1] + (2, added, 1)
+                segment = segments[after]
+            else:
+                k = (added, 1)
+            keys[name] = k
+            segments[name] = segment
+            return k
+
+        for name in placements:
+            key(name)
+
+        #then sort each segment topologically, so that a rule can be listed both before one rule and after another
+        edges = {name: [] for name in placements}
+        waiting = dict.fromkeys(placements, 0)
+        for name, (segment, before, after, added) in placements.items():
+            for earlier, later in ((name, before), (after, name)):
+                if earlier is None or later is None or later is True:
+                    continue
+                if segments[earlier] > segments[later]:
+                    raise LogicalError('rule {0} can\'t be listed before {1} in {2}'.format(earlier, later, self.name))
+                if segments[earlier] == segments[later]:
+                    edges[earlier].append(later)
+                    waiting[later] += 1
+        ordered = ([], [], [])
+        ready = [(keys[name], name) for name, count in waiting.items() if count == 0]
+        heapq.heapify(ready)
+        while ready:
+            _, name = heapq.heappop(ready)
+            ordered[segments[name]].append(self._index[name])
+            for later in edges[name]:
+                waiting[later] -= 1
+                if waiting[later] == 0:
+                    heapq.heappush(ready, (keys[later], later))
+        if sum(len(rules) for rules in ordered) != len(placements):
+            raise LogicalError('rules in {0} can\'t all be listed before/after each other'.format(self.name))
+        self.first_rules, self.rules, self.last_rules = ordered
+        self.frozen = True
+
+    def _copy(self, world):
+        rulebook = Rulebook.__new__(Rulebook)
+        rulebook.__dict__.update(self.__dict__)
+        rulebook.world = world
+        rulebook.variables = self.variables.copy()
+        rulebook._index = self._index.copy()
+        rulebook._placements = self._placements.copy()
+        rulebook._replacements = self._replacements.copy()
+        rulebook._removed = self._removed.copy()
+        rulebook.dependents = set()
+        return rulebook
 
-    def add_rule_last(self, name, func=None, before=False):
-        self._add(name, func, self.last_rules, before)
+    def ordered_rules(self):
+        self.freeze()
+        return self.first_rules + self.rules + self.last_rules
 
     def follow(self, **kwargs):
-        debug_msg('following the {0} rulebook'.format(self.name))
-        #print(kwargs)
+        debug_msg('following the {0} rulebook', self.name, subsystem=RULES)
+        if not self.frozen:
+            self.freeze()
+        profiler = self.world.profiler
+        if profiler is not None:
+            return self._profile(profiler, kwargs)
         res = self._follow_ruleset(self.first_rules, **kwargs)
         if res is None:
             res = self._follow_ruleset(self.rules, **kwargs)
             if res is None:
                 res = self._follow_ruleset(self.last_rules, **kwargs)
-        debug_msg('finished following the {0} rulebook'.format(self.name))
+        debug_msg('finished following the {0} rulebook', self.name, subsystem=RULES)
+        return res
+
+    def _profile(self, profiler, kwargs):
+        #the same as following the rulebook normally, but timing each rule as we go
+        profiler.enter_rulebook(self)
+        res = None
+        try:
+            for rule in self.ordered_rules():
+                profiler.enter_rule(rule)
+                try:
+                    res = rule._evaluate(self.world, kwargs)
+                finally:
+                    profiler.exit_rule(self, rule, res)
+                if res is not None:
+                    debug_msg('Rule outcome for \'{1}\' was {0}', res, rule.name, subsystem=RULES)
+                    break
+        finally:
+            profiler.exit_rulebook(self)
+        debug_msg('finished following the {0} rulebook', self.name, subsystem=RULES)
         return res
 
     def _follow_ruleset(self, ruleset, **kwargs):
         for rule in ruleset:
             #debug_msg('following \'{0}\' rule in {1} rulebook'.format(rule.name, self.name))
-            #print('following ' + rule.name)
-            try:
-                result = rule.evaluate(self.world, **kwargs)
-            except TypeError as e:
-                #print(rule.name, e)
-                result = rule.evaluate(self.world)
+            result = rule._evaluate(self.world, kwargs)
             if result is None:
                 continue
             else:
-                debug_msg('Rule outcome for \'{1}\' was {0}'.format(result, rule.name))
+                debug_msg('Rule outcome for \'{1}\' was {0}', result, rule.name, subsystem=RULES)
                 return result
         return None
 